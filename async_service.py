@@ -0,0 +1,311 @@
+from exception import ConnectionRefusedException, NotAvailableException,\
+    UnknownServiceException, TerminationConnectionException, TimeoutException
+from sending_service import EmailService
+from codec import encode_data
+from reply import Reply, ReplyParser, get_reply_error
+from capabilities import CAPABILITY_CACHE
+from collections import deque
+import metrics
+import asynchat
+import asyncore
+import errno
+import socket
+import sys
+
+
+class AsyncEmailService(asynchat.async_chat):
+    # Non-blocking counterpart of EmailService for the asyncore event loop.
+    # It walks through the same SMTP replies as establish_connection and
+    # send_message. Results and exceptions cannot be raised inside the
+    # loop, so they are handed to callbacks as callback(result, error):
+    # result is what EmailService.send_message would return and error is
+    # None or an instance of one of the exceptions from exception.py.
+    # A reply that does not come within timeout seconds fails the session
+    # with TimeoutException; asyncore has no timers, so whoever runs the
+    # loop calls check_deadline() on each pass (send_all does).
+    LINESEP = '\r\n'
+    TIMEOUT = 30
+    ac_in_buffer_size = 16384
+    ac_out_buffer_size = 65536
+
+    def __init__(self, smtp_host, smtp_port, callback=None, map=None,
+                 timeout=TIMEOUT):
+        asynchat.async_chat.__init__(self, map=map)
+        self.set_terminator(None)  # replies are framed by the parser
+        self.parser = ReplyParser()
+        self.handler = self.on_greeting
+        self.connect_callback = callback
+        self.host_key = (smtp_host, smtp_port)
+        self.extensions = {}
+        self.queue = deque()  # messages waiting for the connection
+        self.current = None  # message of the open MAIL transaction
+        self.ready = False
+        self.closing = False
+        self.quit_callback = None
+        self.in_transaction = False
+        self.timeout = timeout
+        # monotonic time by which the awaited reply must come, None while
+        # no reply is awaited
+        self.deadline = None
+        self.set_deadline()  # for the greeting
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((smtp_host, smtp_port))
+        except socket.gaierror:
+            self.close()
+            raise UnknownServiceException
+
+    # public interface
+
+    def send_email(self, sender, recipient, subject, msg, callback):
+        # queue one MAIL transaction; callback(result, error) is called
+        # when the server accepted or refused the message
+        self.queue.append({'sender': sender, 'recipient': recipient,
+                           'subject': subject, 'msg': msg,
+                           'callback': callback})
+        if self.ready and self.current is None:
+            self.start_next()
+
+    def quit(self, callback=None):
+        # say QUIT once all queued messages are sent
+        self.closing = True
+        self.quit_callback = callback
+        if self.ready and self.current is None:
+            self.start_next()
+
+    # asynchat plumbing
+
+    def set_deadline(self):
+        if self.timeout is not None:
+            self.deadline = metrics.monotonic() + self.timeout
+
+    def check_deadline(self, now=None):
+        if self.deadline is None:
+            return
+        if (now if now is not None else metrics.monotonic()) >= self.deadline:
+            self.fail(TimeoutException('TIMEOUT error. No reply in %s s' %
+                                       self.timeout, self.host_key))
+
+    def collect_incoming_data(self, data):
+        for reply in self.parser.feed(data):
+            # the handler sets a new deadline when it sends a command
+            self.deadline = None
+            self.handler(reply.code, reply.lines)
+
+    def handle_connect(self):
+        # replies wait for small command writes, do not let Nagle's
+        # algorithm hold them back
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle_close(self):
+        self.fail(TerminationConnectionException('Connection closed by '
+                                                 'remote host'))
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.gaierror):
+            self.fail(UnknownServiceException())
+        elif (isinstance(error, socket.error) and
+                error.errno == errno.ECONNREFUSED):
+            self.fail(ConnectionRefusedException())
+        else:
+            self.fail(TerminationConnectionException(error))
+
+    def get_error(self, expect_value, lines):
+        # the exception for an unexpected reply, with its text
+        return get_reply_error(expect_value, Reply(expect_value, lines))
+
+    def sendline(self, line):
+        self.push(line + self.LINESEP)
+        self.set_deadline()
+
+    # reply handlers, one per step of the SMTP conversation
+
+    def on_greeting(self, expect_value, lines):
+        if expect_value == EmailService.SERVICE_READY:
+            self.sendline(EmailService.EHLO.format(
+                hostname=socket.gethostname()))
+            self.handler = self.on_ehlo
+        else:
+            self.fail(self.get_error(expect_value, lines))
+
+    def on_ehlo(self, expect_value, lines):
+        if expect_value == EmailService.COMPLETED:
+            self.extensions = CAPABILITY_CACHE.get_extensions(self.host_key,
+                                                              lines)
+            self.on_ready()
+        elif expect_value in (EmailService.SYNTAX_ERROR,
+                              EmailService.NOT_IMPLEMENTED):
+            self.sendline(EmailService.HELO.format(
+                hostname=socket.gethostname()))
+            self.handler = self.on_helo
+        else:
+            self.fail(self.get_error(expect_value, lines))
+
+    def on_helo(self, expect_value, lines):
+        if expect_value == EmailService.COMPLETED:
+            self.on_ready()
+        else:
+            self.fail(self.get_error(expect_value, lines))
+
+    def on_ready(self):
+        self.ready = True
+        if self.connect_callback is not None:
+            self.connect_callback(self, None)
+        self.start_next()
+
+    def start_next(self):
+        if self.in_transaction:  # previous transaction was not finished
+            self.sendline(EmailService.RSET)
+            self.handler = self.on_rset
+        elif self.queue:
+            self.current = self.queue.popleft()
+            recipient = self.current['recipient']
+            if isinstance(recipient, basestring):
+                self.current['recipients'] = [recipient]
+                self.current['strict'] = True
+            else:
+                self.current['recipients'] = list(recipient)
+                self.current['strict'] = False
+            self.current['results'] = {}
+            self.in_transaction = True
+            self.sendline(EmailService.MAIL_FROM.format(
+                sender=self.current['sender']))
+            self.handler = self.on_mail
+        elif self.closing:
+            self.sendline(EmailService.QUIT)
+            self.handler = self.on_quit
+
+    def on_rset(self, expect_value, lines):
+        if expect_value == EmailService.COMPLETED:
+            self.in_transaction = False
+            self.start_next()
+        else:
+            self.fail(self.get_error(expect_value, lines))
+
+    def on_mail(self, expect_value, lines):
+        if expect_value == EmailService.COMPLETED:
+            self.send_next_recipient()
+        else:
+            self.finish(None, self.get_error(expect_value, lines))
+
+    def send_next_recipient(self):
+        recipients = self.current['recipients']
+        recipient = recipients[len(self.current['results'])]
+        self.sendline(EmailService.RECIPIENT.format(recipient=recipient))
+        self.handler = self.on_rcpt
+
+    def on_rcpt(self, expect_value, lines):
+        current = self.current
+        recipient = current['recipients'][len(current['results'])]
+        current['results'][recipient] = expect_value
+        if current['strict'] and expect_value not in (
+                EmailService.COMPLETED, EmailService.WILL_FORWARD):
+            self.finish(None, self.get_error(expect_value, lines))
+        elif len(current['results']) < len(current['recipients']):
+            self.send_next_recipient()
+        elif not [value for value in current['results'].values()
+                  if value in (EmailService.COMPLETED,
+                               EmailService.WILL_FORWARD)]:
+            self.finish(current['results'], None)
+        else:
+            self.sendline('DATA')
+            self.handler = self.on_data
+
+    def on_data(self, expect_value, lines):
+        if expect_value == EmailService.START_MAIL_INPUT:
+            self.sendline(EmailService.SUBJECT.format(
+                subject=self.current['subject']))
+            self.push(encode_data(self.current['msg']))
+            self.handler = self.on_body
+        else:
+            self.finish(None, self.get_error(expect_value, lines))
+
+    def on_body(self, expect_value, lines):
+        if expect_value == EmailService.COMPLETED:
+            self.in_transaction = False
+            if self.current['strict']:
+                self.finish(EmailService.SEND_COMPLETED, None)
+            else:
+                self.finish(self.current['results'], None)
+        else:
+            self.finish(None, self.get_error(expect_value, lines))
+
+    def on_quit(self, expect_value, lines):
+        self.handler = self.on_closed
+        self.deadline = None
+        self.close()
+        callback, self.quit_callback = self.quit_callback, None
+        if callback is None:
+            return
+        if expect_value == EmailService.SERVICE_CLOSING:
+            callback(EmailService.SEND_COMPLETED, None)
+        else:
+            callback(None, self.get_error(expect_value, lines))
+
+    def finish(self, result, error):
+        current, self.current = self.current, None
+        current['callback'](result, error)
+        if isinstance(error, NotAvailableException):
+            # 421: the server is closing the transmission channel
+            self.fail(error)
+        else:
+            self.start_next()
+
+    def fail(self, error):
+        # connection is lost: every message still waiting fails with error
+        if self.handler == self.on_closed:
+            return
+        self.handler = self.on_closed
+        self.deadline = None
+        self.close()
+        if self.connect_callback is not None and not self.ready:
+            self.connect_callback(self, error)
+        self.ready = False
+        pending = list(self.queue)
+        self.queue.clear()
+        if self.current is not None:
+            pending.insert(0, self.current)
+            self.current = None
+        for message in pending:
+            message['callback'](None, error)
+        callback, self.quit_callback = self.quit_callback, None
+        if callback is not None:
+            callback(None, error)
+
+    def on_closed(self, expect_value, lines):
+        pass
+
+
+def send_all(messages, smtp_host, smtp_port, connections=10,
+             timeout=AsyncEmailService.TIMEOUT, on_done=None):
+    # deliver message dicts (sender, recipient, subject, msg) over a number
+    # of concurrent connections driven by one event loop; returns a list of
+    # (message, result, error) in the order the replies arrived, and calls
+    # on_done(message, result, error) as each one arrives. A session that
+    # waits more than timeout seconds for a reply fails its messages with
+    # TimeoutException.
+    socket_map = {}
+    results = []
+    sessions = []
+    for i in range(connections):
+        sessions.append(AsyncEmailService(smtp_host, smtp_port,
+                                          map=socket_map, timeout=timeout))
+    for i, message in enumerate(messages):
+        def callback(result, error, message=message):
+            results.append((message, result, error))
+            if on_done is not None:
+                on_done(message, result, error)
+        sessions[i % connections].send_email(
+            message['sender'], message['recipient'], message['subject'],
+            message['msg'], callback)
+    for session in sessions:
+        session.quit()
+    poll_timeout = 1 if timeout is None else min(1, timeout / 10.0)
+    while socket_map:
+        asyncore.loop(timeout=poll_timeout, use_poll=True, map=socket_map,
+                      count=1)
+        now = metrics.monotonic()
+        for session in sessions:
+            session.check_deadline(now)
+    return results
@@ -0,0 +1,149 @@
+from exception import ConnectionRefusedException, UnknownServiceException,\
+    NotAvailableException, TerminationConnectionException, TimeoutException
+import metrics
+import random
+import sys
+import threading
+
+
+DEFAULT_PORT = 25
+
+# the relay cannot take the message at all, another one may
+FAILOVER_ERRORS = (ConnectionRefusedException, UnknownServiceException,
+                   NotAvailableException)
+# count against the health of a relay; other errors are replies about the
+# message itself
+RELAY_ERRORS = FAILOVER_ERRORS + (TerminationConnectionException,
+                                  TimeoutException)
+
+
+def parse_relays(text, default_port=DEFAULT_PORT):
+    # 'mx1.example.com, mx2.example.com:2525' -> [(host, port), ...]
+    relays = []
+    for relay in text.split(','):
+        relay = relay.strip()
+        if not relay:
+            continue
+        host, sep, port = relay.rpartition(':')
+        if sep and port.isdigit():
+            relays.append((host, int(port)))
+        else:
+            relays.append((relay, default_port))
+    return relays
+
+
+class RelayStats():
+    def __init__(self):
+        # EWMA of send times in seconds, None until the first result
+        self.latency = None
+        self.error_rate = 0.0  # EWMA of relay errors, 0 .. 1
+        self.in_flight = 0
+        self.down_until = 0  # monotonic time, set after a failover error
+
+
+class RelayBalancer():
+    # Routes sends over several relays. Each relay keeps an exponentially
+    # weighted moving average of its send time and of its error rate; a
+    # send goes to the relay with the lowest expected cost: its latency,
+    # times the sends already in flight on it, divided by its success rate.
+    # A failed send counts as taking at least FAILURE_SECONDS, so a relay
+    # that keeps failing costs more than a healthy one however fast it
+    # fails. A relay without any result yet costs nothing, so every relay
+    # is tried early on. A relay that refuses connections or answers 421 is
+    # skipped for COOLDOWN seconds and the send fails over to the next one.
+    # Safe to share between threads.
+    ALPHA = 0.2  # weight of the newest sample in the averages
+    COOLDOWN = 30
+    FAILURE_SECONDS = 1.0
+
+    def __init__(self, relays, alpha=ALPHA, cooldown=COOLDOWN,
+                 failure_seconds=FAILURE_SECONDS):
+        if not relays:
+            raise ValueError('No SMTP relays given')
+        self.relays = list(relays)
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self.failure_seconds = failure_seconds
+        self.stats = dict((relay, RelayStats()) for relay in self.relays)
+        self.lock = threading.Lock()
+        self.random = random.Random()
+
+    def get_cost(self, stats):
+        if stats.latency is None:
+            return 0  # not tried yet
+        return stats.latency * (stats.in_flight + 1) / \
+            max(0.01, 1 - stats.error_rate)
+
+    def choose(self, exclude=()):
+        # the healthiest relay not in exclude, None when all were excluded;
+        # while every candidate is down the one back first is taken
+        with self.lock:
+            candidates = [relay for relay in self.relays
+                          if relay not in exclude]
+            if not candidates:
+                return None
+            now = metrics.monotonic()
+            up = [relay for relay in candidates
+                  if self.stats[relay].down_until <= now]
+            if not up:
+                return min(candidates,
+                           key=lambda relay: self.stats[relay].down_until)
+            costs = [(self.get_cost(self.stats[relay]), relay)
+                     for relay in up]
+            best = min(costs)[0]
+            # ties are broken at random, so idle relays share the load
+            return self.random.choice([relay for cost, relay in costs
+                                       if cost == best])
+
+    def started(self, relay):
+        with self.lock:
+            self.stats[relay].in_flight += 1
+
+    def finished(self, relay, seconds, error=None):
+        alpha = self.alpha
+        failed = isinstance(error, RELAY_ERRORS)
+        with self.lock:
+            stats = self.stats[relay]
+            stats.in_flight -= 1
+            stats.error_rate += alpha * (failed - stats.error_rate)
+            if failed:
+                seconds = max(seconds, self.failure_seconds)
+            stats.latency = seconds if stats.latency is None else \
+                stats.latency + alpha * (seconds - stats.latency)
+            if isinstance(error, FAILOVER_ERRORS):
+                stats.down_until = metrics.monotonic() + self.cooldown
+
+    def call(self, function):
+        # function(host, port) on the best relay, then on the next best one
+        # for as long as relays fail with FAILOVER_ERRORS; the last of those
+        # errors is raised when no relay is left
+        tried = []
+        while True:
+            relay = self.choose(tried)
+            if relay is None:
+                raise failure[0], failure[1], failure[2]
+            tried.append(relay)
+            self.started(relay)
+            start = metrics.monotonic()
+            try:
+                result = function(*relay)
+            except FAILOVER_ERRORS, opt:
+                self.finished(relay, metrics.monotonic() - start, opt)
+                failure = sys.exc_info()
+                continue
+            except Exception, opt:
+                self.finished(relay, metrics.monotonic() - start, opt)
+                raise
+            self.finished(relay, metrics.monotonic() - start)
+            return result
+
+    def get_summary(self):
+        # {'host:port': {'latency', 'error_rate', 'in_flight', 'down'}}
+        with self.lock:
+            now = metrics.monotonic()
+            return dict(('%s:%d' % relay,
+                         {'latency': stats.latency,
+                          'error_rate': round(stats.error_rate, 4),
+                          'in_flight': stats.in_flight,
+                          'down': stats.down_until > now})
+                        for relay, stats in self.stats.items())
@@ -0,0 +1,272 @@
+# Throughput and latency of the sending modes against the local SMTP sink.
+# Run from the repository root:
+#     python benchmarks/bench_smtp.py [--messages N] [--delay SECONDS] ...
+# Prints one JSON document (also written to --output when given) with
+# msgs/sec and p50/p99 latency per scenario, so runs can be compared.
+from optparse import OptionParser
+import distutils.spawn
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sending_service import EmailService
+from codec import CrlfFile
+from delivery import send_many
+from sharding import ShardedSender
+import async_service
+import metrics
+import smtp_sink
+
+SENDER = 'bench@example.com'
+SUBJECT = 'benchmark'
+BODY = 'Hello,\n\nthis is a benchmark message.\n' * 20
+PLAIN = ('SIZE 104857600', '8BITMIME')  # no PIPELINING and no CHUNKING
+HOST = '127.0.0.1'
+
+
+def get_messages(count, **fields):
+    for i in range(count):
+        message = {'sender': SENDER, 'recipient': 'user%d@example.com' % i,
+                   'subject': SUBJECT, 'msg': BODY}
+        message.update(fields)
+        yield message
+
+
+def get_timed_messages(count, started):
+    # get_messages that notes in started when each message is handed over,
+    # by recipient, which is unique and survives the way to a process
+    for message in get_messages(count):
+        started[message['recipient']] = metrics.monotonic()
+        yield message
+
+
+def record_done(histogram, started, message):
+    histogram.record(metrics.monotonic() - started.pop(message['recipient']))
+
+
+# Every scenario returns (messages, failed, latency histogram or None);
+# failures are counted, not raised, so reply codes can be injected.
+
+def single(port, options):
+    # a new connection for every message
+    histogram = metrics.Histogram()
+    count = max(1, options.messages // 10)
+    failed = 0
+    for message in get_messages(count):
+        start = metrics.monotonic()
+        try:
+            EmailService(HOST, port, '').send_email(
+                SENDER, message['recipient'], SUBJECT, BODY)
+        except Exception:
+            failed += 1
+        histogram.record(metrics.monotonic() - start)
+    return count, failed, histogram
+
+
+def session(port, options, transport=EmailService.SOCKET_TRANSPORT):
+    # one connection, one MAIL transaction after another
+    histogram = metrics.Histogram()
+    failed = 0
+    con = EmailService(HOST, port, '', transport)
+    try:
+        for message in get_messages(options.messages):
+            start = metrics.monotonic()
+            try:
+                con.send_message(SENDER, message['recipient'], SUBJECT, BODY)
+            except Exception:
+                failed += 1
+            histogram.record(metrics.monotonic() - start)
+    finally:
+        con.child.close(True)
+    return options.messages, failed, histogram
+
+
+def telnet_session(port, options):
+    return session(port, options, EmailService.TELNET_TRANSPORT)
+
+
+def pooled(port, options):
+    failed = 0
+    for message, result, error in send_many(
+            get_messages(options.messages), options.workers, HOST, port,
+            max_per_host=options.workers):
+        failed += error is not None
+    return options.messages, failed, None
+
+
+def sharded(port, options):
+    # latency is from handing a message to the shards until its result is
+    # back in this process, batching of the results included
+    sender = ShardedSender(options.processes, HOST, port, options.workers,
+                           max_per_host=options.workers)
+    histogram = metrics.Histogram()
+    started = {}
+    failed = 0
+    for shard, message, status, result in sender.send(
+            get_timed_messages(options.messages, started)):
+        record_done(histogram, started, message)
+        failed += status != 'completed'
+    return options.messages, failed, histogram
+
+
+def async_loop(port, options):
+    # send_all returns when every message is done, each one is timed as
+    # its reply arrives
+    histogram = metrics.Histogram()
+    started = {}
+    failed = 0
+    for message, result, error in async_service.send_all(
+            get_timed_messages(options.messages, started), HOST, port,
+            options.workers, on_done=lambda message, result, error:
+            record_done(histogram, started, message)):
+        failed += error is not None
+    return options.messages, failed, histogram
+
+
+def large(port, options):
+    # file bodies of options.body_size bytes, DATA or BDAT depending on
+    # what the sink offers
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'body.eml')
+        body = open(path, 'wb')
+        line = 'x' * 76 + '\r\n'
+        for i in range(options.body_size // len(line)):
+            body.write(line)
+        body.close()
+        histogram = metrics.Histogram()
+        failed = 0
+        con = EmailService(HOST, port, '')
+        try:
+            for i in range(options.large_messages):
+                # the body has CRLF line endings, BDAT sends it as it is
+                msg = CrlfFile(open(path, 'rb'))
+                start = metrics.monotonic()
+                try:
+                    con.send_message(SENDER, 'user@example.com', SUBJECT,
+                                     msg)
+                except Exception:
+                    failed += 1
+                finally:
+                    msg.close()
+                histogram.record(metrics.monotonic() - start)
+        finally:
+            con.child.close(True)
+        return options.large_messages, failed, histogram
+    finally:
+        shutil.rmtree(directory)
+
+
+# name -> (function, extensions the sink advertises)
+SCENARIOS = [
+    ('single', single, PLAIN),
+    ('session', session, PLAIN),
+    ('session-pipelining', session, smtp_sink.EXTENSIONS),
+    ('telnet-session', telnet_session, PLAIN),
+    ('pooled', pooled, smtp_sink.EXTENSIONS),
+    ('sharded', sharded, smtp_sink.EXTENSIONS),
+    ('async', async_loop, smtp_sink.EXTENSIONS),
+    ('large-data', large, PLAIN),
+    ('large-bdat', large, smtp_sink.EXTENSIONS),
+]
+
+
+def run(name, function, extensions, options):
+    # the SMTP sink runs in processes of its own, so it does not compete
+    # with the client for the GIL
+    server = smtp_sink.SmtpSink(latency=options.delay, codes=options.codes,
+                                extensions=extensions)
+    server.start_processes(options.sink_processes)
+    sink = metrics.set_sink(metrics.HistogramSink())
+    try:
+        start = time.time()
+        count, failed, histogram = function(server.port, options)
+        elapsed = time.time() - start
+    finally:
+        metrics.set_sink(None)
+        server.stop()
+    phases = sink.get_summary()
+    if histogram is None and 'message' in phases:
+        # pooled sends are timed by EmailService itself
+        latency = phases['message']
+    elif histogram is not None:
+        latency = histogram.get_summary()
+    else:
+        latency = {}
+    return {'scenario': name, 'messages': count, 'failed': failed,
+            'seconds': round(elapsed, 4),
+            'msgs_per_sec': round(count / max(elapsed, 1e-9), 1),
+            'p50_ms': to_ms(latency.get('p50')),
+            'p99_ms': to_ms(latency.get('p99')),
+            'phases': phases}
+
+
+def to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def get_options():
+    parser = OptionParser()
+    parser.add_option('--messages', type='int', default=2000,
+                      help='messages per scenario')
+    parser.add_option('--workers', type='int', default=8,
+                      help='connections for pooled, sharded and async')
+    parser.add_option('--processes', type='int', default=2,
+                      help='processes for sharded')
+    parser.add_option('--delay', type='float', default=0,
+                      help='seconds the sink waits before each reply')
+    parser.add_option('--sink-processes', type='int', default=1,
+                      help='processes serving the SMTP sink')
+    parser.add_option('--code', dest='code_list', action='append',
+                      default=[], help='VERB=CODE[:RATE] reply override, '
+                      'e.g. RCPT=451:0.1')
+    parser.add_option('--body-size', type='int', default=10 * 1024 * 1024,
+                      help='bytes per message in the large scenarios')
+    parser.add_option('--large-messages', type='int', default=5)
+    parser.add_option('--scenario', dest='scenarios', action='append',
+                      help='run only these scenarios')
+    parser.add_option('--output', help='also write the results here')
+    options, args = parser.parse_args()
+    options.codes = smtp_sink.parse_codes(options.code_list)
+    return options
+
+
+def main():
+    options = get_options()
+    results = []
+    for name, function, extensions in SCENARIOS:
+        if options.scenarios and name not in options.scenarios:
+            continue
+        if (function is telnet_session and
+                not distutils.spawn.find_executable('telnet')):
+            results.append({'scenario': name, 'skipped': 'no telnet'})
+            continue
+        results.append(run(name, function, extensions, options))
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'options': {'messages': options.messages,
+                          'workers': options.workers,
+                          'processes': options.processes,
+                          'sink_processes': options.sink_processes,
+                          'delay': options.delay, 'codes': options.codes,
+                          'body_size': options.body_size},
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        output = open(options.output, 'w')
+        try:
+            output.write(text + '\n')
+        finally:
+            output.close()
+    print text
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+from reply import parse_extensions
+import threading
+import time
+
+
+SIZE = 'SIZE'
+PIPELINING = 'PIPELINING'
+EIGHT_BIT_MIME = '8BITMIME'
+CHUNKING = 'CHUNKING'
+STARTTLS = 'STARTTLS'
+
+
+def get_size(extensions):
+    # largest message the server takes in bytes, None when it names no limit
+    size = extensions.get(SIZE, '')
+    if size.isdigit() and int(size):
+        return int(size)
+    return None
+
+
+class CapabilityCache():
+    # EHLO extensions per (host, port). A server sends the same EHLO reply
+    # on every connection, so while an entry is fresh and the reply lines
+    # did not change, the parsed extensions are shared instead of parsed
+    # again. Entries expire after ttl seconds so a reconfigured server is
+    # noticed. The extension dicts handed out must not be modified.
+    TTL = 300  # seconds
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        self.entries = {}  # key -> (expires, reply lines, extensions)
+        self.lock = threading.Lock()
+
+    def get_extensions(self, key, lines):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] > now and entry[1] == lines:
+            return entry[2]
+        extensions = parse_extensions(lines)
+        with self.lock:
+            self.entries[key] = (now + self.ttl, list(lines), extensions)
+        return extensions
+
+
+CAPABILITY_CACHE = CapabilityCache()
@@ -0,0 +1,83 @@
+class DataEncoder():
+    # Encodes a message body for the SMTP DATA command, chunk by chunk: every
+    # line ending (CRLF, bare LF or bare CR) becomes linesep, a '.' starting
+    # a line is doubled (dot-stuffing) and finish() closes the body with the
+    # '.' line. Whole chunks are processed with str.replace, so there is no
+    # Python loop over lines; the only state carried between chunks is a
+    # trailing '\r' and whether the output stopped at the start of a line.
+    # Without dot_stuffing only the line endings are changed, as BDAT needs.
+
+    def __init__(self, linesep='\r\n', dot_stuffing=True):
+        self.linesep = linesep
+        self.dot_stuffing = dot_stuffing
+        self.carry = ''  # '\r' at the end of a chunk may start a '\r\n'
+        self.at_line_start = True
+
+    def encode(self, chunk):
+        data = self.carry + chunk if self.carry else chunk
+        self.carry = ''
+        if not data:
+            return ''
+        if data[-1] == '\r':
+            self.carry = '\r'
+            data = data[:-1]
+            if not data:
+                return ''
+        if '\r' in data:
+            data = data.replace('\r\n', '\n').replace('\r', '\n')
+        if self.dot_stuffing:
+            if '\n.' in data:
+                data = data.replace('\n.', '\n..')
+            if self.at_line_start and data[0] == '.':
+                data = '.' + data
+        self.at_line_start = data[-1] == '\n'
+        if self.linesep != '\n':
+            data = data.replace('\n', self.linesep)
+        return data
+
+    def flush(self):
+        # a '\r' held back at the end of the body, as a line ending
+        if not self.carry:
+            return ''
+        self.carry = ''
+        self.at_line_start = True
+        return self.linesep
+
+    def finish(self):
+        data = self.flush()
+        if not self.at_line_start:
+            data = self.linesep
+        self.at_line_start = True
+        return data + '.' + self.linesep
+
+
+def encode_data(msg, linesep='\r\n'):
+    # whole body in DATA form, terminator included
+    encoder = DataEncoder(linesep)
+    return encoder.encode(msg) + encoder.finish()
+
+
+def encode_utf8(value):
+    # unicode text from JSON as UTF-8 str, also in lists and dicts, so it
+    # can go into SMTP commands and the message as it is
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [encode_utf8(item) for item in value]
+    if isinstance(value, dict):
+        return dict((encode_utf8(key), encode_utf8(item))
+                    for key, item in value.items())
+    return value
+
+
+class CrlfFile():
+    # A file body whose line endings are CRLF already. EmailService sends
+    # it over BDAT exactly as it is read, any other file body has its line
+    # endings normalized first.
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def __getattr__(self, name):
+        # read, readinto, seek, close ... of the file
+        return getattr(self.fileobj, name)
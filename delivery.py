@@ -0,0 +1,201 @@
+from sending_service import EmailService
+from pool import ConnectionPool
+from mime import MimeMessage
+from collections import deque
+import heapq
+import itertools
+import metrics
+import threading
+import Queue
+
+
+DEFAULT_PORT = 25
+DEFAULT_WORKERS = 4
+MAX_PER_HOST = 4
+IDLE_WAIT = 0.1  # seconds to wait for a result when the input has nothing
+ACCEPTED = (EmailService.COMPLETED, EmailService.WILL_FORWARD)
+
+
+def is_delivered(result):
+    # result of a send without error: a multi-recipient transaction is a
+    # {recipient: reply code} dict and delivered only if one was accepted
+    if isinstance(result, dict):
+        return bool([recipient for recipient, expect_value in result.items()
+                     if expect_value in ACCEPTED])
+    return True
+
+
+def get_mime_message(msg, attachments):
+    # text of msg (a string or a file, which is closed) with the files at
+    # the attachments paths, read and encoded while the message is sent
+    if not isinstance(msg, basestring):
+        msg_file = msg
+        try:
+            msg = msg_file.read()
+        finally:
+            msg_file.close()
+    message = MimeMessage(msg)
+    for path in attachments:
+        message.attach(path)
+    return message
+
+
+def deliver(pool, message, smtp_host, smtp_port, balancer=None,
+            limiter=None):
+    # message body is given inline as msg or as a path to a file, which is
+    # streamed from disk instead of being read into memory. Without an
+    # smtp_host of its own the message goes to the relay the balancer picks
+    # and fails over to the others. The limiter holds it back while the
+    # relay is over its rate.
+    if not message.get('sender'):
+        raise ValueError('Message has no sender')
+    msg = message.get('msg')
+    if msg is None:
+        if not message.get('msg_path'):
+            raise ValueError('Message has neither msg nor msg_path')
+        msg = open(message['msg_path'], 'rb')
+    if message.get('attachments'):
+        msg = get_mime_message(msg, message['attachments'])
+
+    def send(smtp_host, smtp_port):
+        if limiter is not None:
+            limiter.wait_relay(smtp_host, smtp_port)
+        if hasattr(msg, 'seek'):
+            msg.seek(0)  # a failed relay may have read part of it
+        return pool.send_message(smtp_host, smtp_port, message['sender'],
+                                 message['recipient'], message['subject'],
+                                 msg)
+
+    try:
+        if balancer is not None and 'smtp_host' not in message:
+            return balancer.call(send)
+        return send(message.get('smtp_host', smtp_host),
+                    message.get('smtp_port', smtp_port))
+    finally:
+        if hasattr(msg, 'close'):
+            msg.close()
+
+
+def send_many(messages, workers=DEFAULT_WORKERS, smtp_host=None,
+              smtp_port=DEFAULT_PORT, max_per_host=MAX_PER_HOST,
+              log_path='', transport=EmailService.SOCKET_TRANSPORT,
+              pool=None, balancer=None, limiter=None):
+    # Delivers message dicts (sender, recipient, subject, msg or msg_path and
+    # optionally smtp_host/smtp_port) on a pool of worker threads. At most
+    # max_per_host messages are in flight per SMTP host, so a relay is not
+    # pushed into answering 421. With a balancer.RelayBalancer messages
+    # without their own smtp_host are spread over its relays. With a
+    # ratelimit.RateLimiter a message whose recipient domain is over its
+    # rate waits here, not in a worker, so the workers go on with other
+    # domains meanwhile. Yields (message, result, error) as soon as each
+    # message is done; messages are read lazily, so the input can be a
+    # generator of any length. A None in the input means nothing is ready
+    # yet: results are waited for a moment before it is read again.
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool(log_path, transport, max_per_host=max_per_host)
+    tasks = Queue.Queue()
+    done = Queue.Queue()
+
+    def worker():
+        while True:
+            message = tasks.get()
+            if message is None:
+                return
+            try:
+                result = deliver(pool, message, smtp_host, smtp_port,
+                                 balancer, limiter)
+                done.put((message, result, None))
+            except Exception, opt:
+                done.put((message, None, opt))
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    def get_host(message):
+        # None for the messages the balancer routes
+        if balancer is not None and 'smtp_host' not in message:
+            return None
+        return (message.get('smtp_host', smtp_host),
+                message.get('smtp_port', smtp_port))
+
+    def get_limit(host):
+        if host is None:
+            return max_per_host * len(balancer.relays)
+        return max_per_host
+
+    def dispatch(message):
+        host = get_host(message)
+        if in_flight.get(host, 0) < get_limit(host):
+            in_flight[host] = in_flight.get(host, 0) + 1
+            tasks.put(message)
+        else:
+            waiting.setdefault(host, deque()).append(message)
+
+    window = workers * 4  # messages read ahead of the results
+    in_flight = {}  # host -> number of messages handed to workers
+    waiting = {}  # host -> messages held back by max_per_host
+    delayed = []  # (due, sequence, message) held back by the limiter
+    sequence = itertools.count()
+    pending = 0
+    messages = iter(messages)
+    exhausted = False
+    try:
+        while True:
+            idle = False
+            while not exhausted and pending < window:
+                try:
+                    message = messages.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                if message is None:
+                    idle = True
+                    break
+                pending += 1
+                wait = 0
+                if limiter is not None:
+                    wait = limiter.reserve_recipients(message['recipient'])
+                if wait > 0:
+                    heapq.heappush(delayed, (metrics.monotonic() + wait,
+                                             next(sequence), message))
+                else:
+                    dispatch(message)
+            if not pending and exhausted:
+                return
+            timeout = None
+            while delayed:
+                timeout = delayed[0][0] - metrics.monotonic()
+                if timeout > 0:
+                    break
+                dispatch(heapq.heappop(delayed)[2])
+                timeout = None
+            if idle:
+                timeout = IDLE_WAIT if timeout is None else \
+                    min(timeout, IDLE_WAIT)
+            try:
+                message, result, error = done.get(timeout=timeout)
+            except Queue.Empty:
+                continue  # a delayed message is due or the input is ready
+            pending -= 1
+            host = get_host(message)
+            if waiting.get(host):
+                tasks.put(waiting[host].popleft())
+            else:
+                in_flight[host] -= 1
+            yield message, result, error
+    finally:
+        # when the caller stops early, drop the messages not started yet
+        try:
+            while True:
+                tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in threads:
+            tasks.put(None)
+        if own_pool:
+            for thread in threads:
+                thread.join()
+            pool.close()
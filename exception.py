@@ -20,3 +20,7 @@ class RequestedActionAbortedException(Exception):
 
 class SyntaxErrorException(Exception):
     pass
+
+
+class TimeoutException(Exception):
+    pass
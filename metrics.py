@@ -0,0 +1,207 @@
+import ctypes
+import ctypes.util
+import functools
+import sys
+import threading
+import time
+
+
+OK = 'ok'
+
+
+def get_monotonic():
+    # time.time can jump with the wall clock; Python 2 has no monotonic
+    # clock of its own, so ask the C library for CLOCK_MONOTONIC on Linux
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        timespec = Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+            return time.time()
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    return monotonic
+
+
+monotonic = get_monotonic()
+
+
+class Histogram():
+    # HDR-style histogram of durations in microseconds: values below
+    # 2 ** SUB_BUCKET_BITS are counted exactly, larger ones in buckets
+    # whose width grows with the value, so every recorded value is known to
+    # within 1 / 2 ** (SUB_BUCKET_BITS - 1) (under 1%) whatever its range.
+    # Only buckets that were hit are stored.
+    SUB_BUCKET_BITS = 8
+
+    def __init__(self):
+        self.counts = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def get_index(self, value):
+        bits = self.SUB_BUCKET_BITS
+        if value < 1 << bits:
+            return value
+        shift = value.bit_length() - bits
+        half = 1 << (bits - 1)
+        return (1 << bits) + (shift - 1) * half + (value >> shift) - half
+
+    def get_value(self, index):
+        # highest value that falls into the bucket
+        bits = self.SUB_BUCKET_BITS
+        if index < 1 << bits:
+            return index
+        half = 1 << (bits - 1)
+        shift, top = divmod(index - (1 << bits), half)
+        shift += 1
+        return ((top + half + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1000000))
+        index = self.get_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def get_percentile(self, percentile):
+        # in seconds, None while nothing is recorded
+        if not self.count:
+            return None
+        rank = max(1, int(round(self.count * percentile / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.get_value(index), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def get_summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'min': self.min / 1000000.0,
+                'mean': self.total / 1000000.0 / self.count,
+                'p50': self.get_percentile(50),
+                'p90': self.get_percentile(90),
+                'p99': self.get_percentile(99),
+                'max': self.max / 1000000.0}
+
+
+class HistogramSink():
+    # default sink: a histogram and outcome counters per phase, in memory
+    def __init__(self):
+        self.histograms = {}  # phase -> Histogram
+        self.outcomes = {}  # phase -> {outcome: count}
+        self.lock = threading.Lock()
+
+    def record(self, phase, seconds, outcome):
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram()
+                self.outcomes[phase] = {}
+            histogram.record(seconds)
+            outcomes = self.outcomes[phase]
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    def get_summary(self):
+        # {phase: {'count', 'min', 'mean', 'p50', 'p90', 'p99', 'max' in
+        # seconds and 'outcomes': {outcome: count}}}
+        with self.lock:
+            summary = {}
+            for phase, histogram in self.histograms.items():
+                summary[phase] = histogram.get_summary()
+                summary[phase]['outcomes'] = dict(self.outcomes[phase])
+            return summary
+
+
+class CallbackSink():
+    # hands every measurement to callback(phase, seconds, outcome), e.g.
+    # to feed an exporter; the callback runs on the sending thread
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, phase, seconds, outcome):
+        self.callback(phase, seconds, outcome)
+
+
+# where measurements go; with None nothing is measured at all
+sink = None
+
+
+def set_sink(new_sink):
+    global sink
+    sink = new_sink
+    return new_sink
+
+
+class Timer():
+    # times a with block and records it with its outcome: the name of the
+    # exception that left the block, else outcome, which the block may set
+    # (to a reply code, say) and which defaults to OK
+    def __init__(self, sink, phase):
+        self.sink = sink
+        self.phase = phase
+        self.start = None
+        self.outcome = OK
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        outcome = self.outcome if exc_type is None else exc_type.__name__
+        self.sink.record(self.phase, monotonic() - self.start, outcome)
+        return False
+
+
+class NullTimer():
+    outcome = OK
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(phase):
+    current = sink
+    if current is None:
+        return NULL_TIMER
+    return Timer(current, phase)
+
+
+def timed(phase):
+    # decorator timing every call of a function as phase
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            current = sink
+            if current is None:
+                return function(*args, **kwargs)
+            with Timer(current, phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
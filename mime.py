@@ -0,0 +1,96 @@
+import binascii
+import mimetypes
+import os
+import uuid
+
+
+LINESEP = '\r\n'
+BASE64_LINE = 57  # input bytes per 76 character base64 line
+BASE64_BLOCK = BASE64_LINE * 1024  # read from disk at once, about 57 KB
+DEFAULT_TYPE = 'application/octet-stream'
+
+
+def encode_base64(data):
+    # base64 in 76 character lines; data is a whole number of lines except
+    # at the end of a file
+    encoded = binascii.b2a_base64(data)[:-1]
+    return LINESEP.join(encoded[start:start + 76]
+                        for start in xrange(0, len(encoded), 76)) + LINESEP
+
+
+def iter_base64(attachment):
+    # base64 of a file read BASE64_BLOCK bytes at a time, so memory use
+    # does not depend on the file size
+    rest = ''
+    while True:
+        data = attachment.read(BASE64_BLOCK)
+        if not data:
+            break
+        if rest:
+            data = rest + data
+        # a short read must not split a line, keep its tail for the next one
+        cut = len(data) - len(data) % BASE64_LINE
+        data, rest = data[:cut], data[cut:]
+        if data:
+            yield encode_base64(data)
+    if rest:
+        yield encode_base64(rest)
+
+
+class MimeMessage():
+    # multipart/mixed message with a text part and file attachments. It is
+    # not built in memory: iterating over it yields the message piece by
+    # piece, attachments are read from disk and base64 encoded as they are
+    # sent. Every iteration starts from the beginning, so a message can be
+    # sent again. The Subject header is written by EmailService.
+
+    def __init__(self, text='', subtype='plain', charset='utf-8'):
+        self.text = text
+        self.subtype = subtype
+        self.charset = charset
+        self.attachments = []  # (path, content type, file name)
+        self.boundary = '==' + uuid.uuid4().hex
+
+    def attach(self, path, content_type=None, filename=None):
+        if content_type is None:
+            content_type = mimetypes.guess_type(path)[0] or DEFAULT_TYPE
+        if filename is None:
+            filename = os.path.basename(path)
+        filename = filename.replace('"', '')
+        self.attachments.append((path, content_type, filename))
+
+    def get_headers(self):
+        return ('MIME-Version: 1.0' + LINESEP +
+                'Content-Type: multipart/mixed; boundary="%s"' %
+                self.boundary + LINESEP + LINESEP)
+
+    def get_text_part(self):
+        text = self.text
+        if isinstance(text, unicode):
+            text = text.encode(self.charset)
+        return ('--' + self.boundary + LINESEP +
+                'Content-Type: text/%s; charset="%s"' % (self.subtype,
+                                                         self.charset) +
+                LINESEP +
+                'Content-Transfer-Encoding: quoted-printable' + LINESEP +
+                LINESEP + binascii.b2a_qp(text) + LINESEP)
+
+    def get_attachment_headers(self, content_type, filename):
+        return ('--' + self.boundary + LINESEP +
+                'Content-Type: %s; name="%s"' % (content_type, filename) +
+                LINESEP +
+                'Content-Disposition: attachment; filename="%s"' % filename +
+                LINESEP +
+                'Content-Transfer-Encoding: base64' + LINESEP + LINESEP)
+
+    def __iter__(self):
+        yield self.get_headers() + self.get_text_part()
+        for path, content_type, filename in self.attachments:
+            yield self.get_attachment_headers(content_type, filename)
+            attachment = open(path, 'rb')
+            try:
+                for chunk in iter_base64(attachment):
+                    yield chunk
+            finally:
+                attachment.close()
+        yield '--' + self.boundary + '--' + LINESEP
@@ -0,0 +1,188 @@
+from exception import NotAvailableException, TerminationConnectionException
+from sending_service import EmailService
+from reply import get_error_code
+from contextlib import contextmanager
+import logging
+import sys
+import threading
+import time
+
+
+class ConnectionPool():
+    # Keeps warm, already greeted EmailService connections per
+    # (smtp_host, smtp_port) so that a message does not pay for connect and
+    # the 220 greeting. Safe to share between threads.
+    MAX_PER_HOST = 4
+    IDLE_TTL = 60  # seconds an idle connection is kept open
+    NOOP_AFTER = 5  # idle seconds after which a connection is checked
+    RETRIES = 1  # fresh connections tried when a pooled one turns out dead
+    EVICT_INTERVAL = 5  # seconds between two checks of every idle connection
+
+    def __init__(self, log_path='', transport=EmailService.SOCKET_TRANSPORT,
+                 max_per_host=MAX_PER_HOST, idle_ttl=IDLE_TTL,
+                 noop_after=NOOP_AFTER, evict_interval=EVICT_INTERVAL):
+        self.log_path = log_path
+        self.transport = transport
+        self.max_per_host = max_per_host
+        self.idle_ttl = idle_ttl
+        self.noop_after = noop_after
+        self.evict_interval = evict_interval
+        self.evicted_at = time.time()
+        self.lock = threading.Condition()
+        self.idle = {}  # (host, port) -> [(connection, released at), ...]
+        self.opened = {}  # (host, port) -> number of open connections
+        self.closed = False
+
+    def connect(self, smtp_host, smtp_port):
+        return EmailService(smtp_host, smtp_port, self.log_path,
+                            self.transport)
+
+    def acquire(self, smtp_host, smtp_port, timeout=None):
+        self.evict_if_due()
+        key = (smtp_host, smtp_port)
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise ValueError('Connection pool is closed')
+                idle = self.idle.get(key)
+                if idle:
+                    # the most recently used connection is the warmest one
+                    con, released = idle.pop()
+                    break
+                if self.opened.get(key, 0) < self.max_per_host:
+                    self.opened[key] = self.opened.get(key, 0) + 1
+                    con = None
+                    break
+                if deadline is None:
+                    self.lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise NotAvailableException('No free connection to '
+                                                    '%s:%s' % key)
+                    self.lock.wait(remaining)
+
+        if con is not None:
+            idle_time = time.time() - released
+            if idle_time > self.idle_ttl:
+                self.close_connection(con)
+                con = None
+            elif idle_time > self.noop_after and not self.is_alive(con):
+                self.close_connection(con, quit=False)
+                con = None
+        if con is None:
+            # the slot is already counted in self.opened
+            try:
+                con = self.connect(smtp_host, smtp_port)
+            except:
+                self.forget(key)
+                raise
+        con.pool_key = key
+        return con
+
+    def release(self, con):
+        with self.lock:
+            closed = self.closed
+            if not closed:
+                self.idle.setdefault(con.pool_key, []).append(
+                    (con, time.time()))
+                self.lock.notify()
+        if closed:
+            self.discard(con, con.pool_key)
+        else:
+            self.evict_if_due()
+
+    def discard(self, con, key, quit=True):
+        self.close_connection(con, quit)
+        self.forget(key)
+
+    def close_connection(self, con, quit=True):
+        try:
+            if quit:
+                con.close()
+            else:
+                con.child.close(True)
+        except Exception, opt:
+            logging.debug(u'Failed to close SMTP connection: %s' % opt)
+
+    def forget(self, key):
+        with self.lock:
+            self.opened[key] -= 1
+            self.lock.notify()
+
+    def is_reusable(self, error):
+        # after any reply but 421 the session is still usable for the next
+        # message; 421, transport errors and timeouts end it
+        code = get_error_code(error)
+        return code is not None and code != EmailService.SERVICE_NOT_AVAILABLE
+
+    def is_alive(self, con):
+        try:
+            return con.child.isalive() and con.noop()
+        except Exception:
+            return False
+
+    def evict_idle(self):
+        # close connections that stayed idle longer than idle_ttl
+        now = time.time()
+        expired = []
+        with self.lock:
+            for key, idle in self.idle.items():
+                fresh = [(con, released) for con, released in idle
+                         if now - released <= self.idle_ttl]
+                expired.extend((con, key) for con, released in idle
+                               if now - released > self.idle_ttl)
+                self.idle[key] = fresh
+        for con, key in expired:
+            self.discard(con, key)
+        return len(expired)
+
+    def evict_if_due(self):
+        # acquire only looks at the most recent idle connection of a host,
+        # the older ones are closed here once they expire
+        with self.lock:
+            if time.time() - self.evicted_at < self.evict_interval:
+                return
+            self.evicted_at = time.time()
+        self.evict_idle()
+
+    @contextmanager
+    def connection(self, smtp_host, smtp_port, timeout=None):
+        con = self.acquire(smtp_host, smtp_port, timeout)
+        try:
+            yield con
+        except:
+            if self.is_reusable(sys.exc_info()[1]):
+                self.release(con)
+            else:
+                self.discard(con, con.pool_key, quit=False)
+            raise
+        else:
+            self.release(con)
+
+    def send_message(self, smtp_host, smtp_port, sender, recipient, subject,
+                     msg):
+        attempt = 0
+        while True:
+            try:
+                with self.connection(smtp_host, smtp_port) as con:
+                    return con.send_message(sender, recipient, subject, msg)
+            except TerminationConnectionException:
+                # the server dropped a pooled connection, use a new one
+                if attempt >= self.RETRIES:
+                    raise
+                if hasattr(msg, 'seek'):
+                    msg.seek(0)
+                elif iter(msg) is msg:
+                    raise  # a one-shot iterator cannot be sent again
+                attempt += 1
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, {}
+            self.lock.notify_all()
+        for key, connections in idle.items():
+            for con, released in connections:
+                self.discard(con, key)
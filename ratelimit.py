@@ -0,0 +1,187 @@
+from balancer import parse_relays, DEFAULT_PORT
+import errno
+import fcntl
+import metrics
+import os
+import struct
+import threading
+import time
+import urllib
+
+
+ANY_DOMAIN = '*'  # limit for the domains without one of their own
+BUCKET = struct.Struct('dd')  # tokens, monotonic time of the last update
+
+
+def parse_limit(text):
+    # 'RATE[:BURST]' in messages per second -> (rate, burst); the burst
+    # defaults to one second worth of messages
+    rate, sep, burst = text.partition(':')
+    rate = float(rate)
+    burst = float(burst) if burst else max(1.0, rate)
+    if rate <= 0 or burst < 1:
+        raise ValueError('Bad rate limit: %s' % text)
+    return rate, burst
+
+
+def parse_limits(values):
+    # ['example.com=10:20', '*=50'] -> {'example.com': (10.0, 20.0), ...}
+    limits = {}
+    for value in values:
+        for item in value.split(','):
+            if item.strip():
+                key, sep, limit = item.strip().rpartition('=')
+                if not sep:
+                    raise ValueError('Bad rate limit: %s' % item)
+                limits[key.strip().lower()] = parse_limit(limit)
+    return limits
+
+
+def reserve(tokens, updated, now, rate, burst, count):
+    # token bucket: refill for the time since the last update, then take
+    # count tokens even if that leaves the bucket in debt; the debt is how
+    # long the caller has to wait. Taking first and waiting afterwards keeps
+    # the callers in order and the limit used to the full without polling.
+    # The monotonic clock starts again at boot, so a bucket kept in a file
+    # can be updated "later" than now; that time is not refilled, it does
+    # not stall the sender either.
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate) - count
+    wait = 0.0 if tokens >= 0 else -tokens / rate
+    return tokens, wait
+
+
+class MemoryStore():
+    # buckets of one process, shared between its threads
+    def __init__(self):
+        self.buckets = {}  # key -> [tokens, updated]
+        self.lock = threading.Lock()
+
+    def reserve(self, key, rate, burst, count):
+        with self.lock:
+            now = metrics.monotonic()
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now]
+            bucket[0], wait = reserve(bucket[0], bucket[1], now, rate, burst,
+                                      count)
+            bucket[1] = now
+            return wait
+
+
+class FileStore():
+    # buckets in small files under directory, one per key, updated under
+    # an fcntl lock, so all the processes of the host that use the same
+    # directory share them. fcntl locks do not exclude the threads of one
+    # process from each other, a thread lock does that.
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, opt:
+                if opt.errno != errno.EEXIST:
+                    raise
+        self.files = {}  # (key, process id) -> file descriptor
+        self.lock = threading.Lock()
+
+    def get_file(self, key):
+        # opened once per process, a forked process opens its own
+        fd = self.files.get((key, os.getpid()))
+        if fd is None:
+            name = key.encode('utf-8') if isinstance(key, unicode) else key
+            path = os.path.join(self.directory, urllib.quote(name, safe=''))
+            fd = self.files[(key, os.getpid())] = os.open(
+                path, os.O_RDWR | os.O_CREAT, 0644)
+        return fd
+
+    def reserve(self, key, rate, burst, count):
+        with self.lock:
+            fd = self.get_file(key)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                now = metrics.monotonic()
+                os.lseek(fd, 0, os.SEEK_SET)
+                data = os.read(fd, BUCKET.size)
+                if len(data) == BUCKET.size:
+                    tokens, updated = BUCKET.unpack(data)
+                else:
+                    tokens, updated = burst, now
+                tokens, wait = reserve(tokens, updated, now, rate, burst,
+                                       count)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, BUCKET.pack(tokens, now))
+                return wait
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+
+    def close(self):
+        with self.lock:
+            for (key, pid), fd in self.files.items():
+                if pid == os.getpid():
+                    os.close(fd)
+            self.files = {}
+
+
+class RateLimiter():
+    # Token buckets per recipient domain and per relay, so that bursts stay
+    # under what receivers accept instead of coming back as 421 and 451.
+    # domain_limits maps domains (ANY_DOMAIN for all the others) and
+    # relay_limits 'host[:port]' to (messages per second, burst). A message
+    # takes one token per recipient from each of its domains. With a
+    # directory the buckets are kept in files there and shared between
+    # processes, else in memory. The arguments are plain data, so a
+    # limiter can be rebuilt in another process from the same ones.
+
+    def __init__(self, domain_limits=None, relay_limits=None,
+                 directory=None):
+        self.domain_limits = dict((domain.lower(), limit) for domain, limit
+                                  in (domain_limits or {}).items())
+        self.relay_limits = {}
+        for relay, limit in (relay_limits or {}).items():
+            if isinstance(relay, basestring):
+                relay = parse_relays(relay, DEFAULT_PORT)[0]
+            # host names are not case sensitive, like the domains
+            self.relay_limits[(relay[0].lower(), relay[1])] = limit
+        self.store = FileStore(directory) if directory else MemoryStore()
+
+    def get_domain_limit(self, domain):
+        return self.domain_limits.get(domain,
+                                      self.domain_limits.get(ANY_DOMAIN))
+
+    def reserve_recipients(self, recipient):
+        # seconds to wait before a message to recipient (one address or a
+        # list) may go out; the tokens are taken already
+        if not self.domain_limits:
+            return 0.0
+        if isinstance(recipient, basestring):
+            recipient = [recipient]
+        counts = {}
+        for address in recipient:
+            domain = address.rpartition('@')[2].strip(' >').lower()
+            counts[domain] = counts.get(domain, 0) + 1
+        wait = 0.0
+        for domain, count in counts.items():
+            limit = self.get_domain_limit(domain)
+            if limit is not None:
+                wait = max(wait, self.store.reserve('domain-' + domain,
+                                                    limit[0], limit[1],
+                                                    count))
+        return wait
+
+    def reserve_relay(self, smtp_host, smtp_port):
+        smtp_host = smtp_host.lower()
+        limit = self.relay_limits.get((smtp_host, smtp_port))
+        if limit is None:
+            return 0.0
+        return self.store.reserve('relay-%s:%d' % (smtp_host, smtp_port),
+                                  limit[0], limit[1], 1)
+
+    def wait_recipients(self, recipient):
+        wait = self.reserve_recipients(recipient)
+        if wait > 0:
+            time.sleep(wait)
+
+    def wait_relay(self, smtp_host, smtp_port):
+        wait = self.reserve_relay(smtp_host, smtp_port)
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,126 @@
+from exception import NotAvailableException, RequestedActionAbortedException,\
+    SyntaxErrorException
+
+
+# reply code -> exception raised when that code comes instead of the
+# expected one; any other code raises Exception(OTHER_ERROR, code)
+REPLY_ERRORS = {
+    '421': NotAvailableException,
+    '451': RequestedActionAbortedException,
+    '500': SyntaxErrorException,
+}
+OTHER_ERROR = 'Some another error'
+
+
+def get_reply_error(expect_value, smtp_reply=None):
+    # smtp_reply is the Reply that brought the code, if there is one: its
+    # enhanced status code and text go into the exception args for
+    # diagnostics, after the code
+    args = ()
+    if smtp_reply is not None and smtp_reply.code == expect_value:
+        args = (expect_value, smtp_reply.enhanced_code,
+                smtp_reply.get_text())
+    error = REPLY_ERRORS.get(expect_value)
+    if error is not None:
+        return error(*args)
+    return Exception(OTHER_ERROR, *(args or (expect_value,)))
+
+
+def check_reply(expect_value, expected, smtp_reply=None):
+    if expect_value != expected:
+        raise get_reply_error(expect_value, smtp_reply)
+
+
+def get_error_code(error):
+    # reply code of an exception made by get_reply_error, None for any
+    # other exception
+    for code, reply_error in REPLY_ERRORS.items():
+        if type(error) is reply_error:
+            return code
+    if len(error.args) > 1 and error.args[0] == OTHER_ERROR:
+        return error.args[1]
+    return None
+
+
+def get_enhanced_code(text):
+    # RFC 3463 status code such as 5.1.1 at the start of the text or None
+    status = text.split(' ', 1)[0]
+    parts = status.split('.')
+    if (len(parts) == 3 and parts[0] in ('2', '4', '5') and
+            parts[1].isdigit() and parts[2].isdigit()):
+        return status
+    return None
+
+
+def parse_extensions(lines):
+    # EHLO reply text lines -> {keyword: parameters}; the first line only
+    # greets us, every other one names an extension
+    extensions = {}
+    for line in lines[1:]:
+        extension = line.strip().split(None, 1)
+        if extension:
+            extensions[extension[0].upper()] = ' '.join(extension[1:])
+    return extensions
+
+
+class Reply():
+    # One complete SMTP reply: its code, the enhanced status code if the
+    # server sent one and the text of every line without the code. group()
+    # answers like the match object of pexpect.expect for
+    # EmailService.COMMAND_CODE_REGEXP, so code written for the telnet
+    # transport reads it the same way.
+
+    def __init__(self, code, lines):
+        self.code = code
+        self.lines = lines
+        self.enhanced_code = get_enhanced_code(lines[0]) if lines else None
+
+    def __repr__(self):
+        return 'Reply(%r, %r)' % (self.code, self.lines)
+
+    def get_text(self):
+        return '\n'.join(self.lines)
+
+    def get_before(self):
+        # the lines in front of the last one as they came from the server
+        return ''.join('%s-%s\r\n' % (self.code, line)
+                       for line in self.lines[:-1])
+
+    def group(self, name=0):
+        if name == 'code':
+            return self.code
+        elif name == 'other':
+            return ' ' + self.lines[-1]
+        return '%s %s' % (self.code, self.lines[-1])
+
+
+class ReplyParser():
+    # Incremental reply parser: feed() takes raw bytes as they arrive, in
+    # pieces of any size, and returns the replies completed by them. Lines
+    # are split with str.find on the buffer, no regular expressions.
+
+    def __init__(self):
+        self.buffer = ''
+        self.lines = []  # lines of the reply being read
+
+    def feed(self, data):
+        buffer = self.buffer + data if self.buffer else data
+        replies = []
+        start = 0
+        while True:
+            end = buffer.find('\n', start)
+            if end < 0:
+                break
+            line = buffer[start:end]
+            start = end + 1
+            if line.endswith('\r'):
+                line = line[:-1]
+            separator = line[3:4]
+            if not line[:3].isdigit() or separator not in ('', ' ', '-'):
+                raise Exception('Unexpected SMTP reply', line)
+            self.lines.append(line[4:])
+            if separator != '-':
+                replies.append(Reply(line[:3], self.lines))
+                self.lines = []
+        self.buffer = buffer[start:]
+        return replies
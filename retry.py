@@ -0,0 +1,159 @@
+from exception import NotAvailableException, \
+    RequestedActionAbortedException, TerminationConnectionException, \
+    TimeoutException
+from reply import get_error_code
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+# 421 and 451 (and any other 4xx) only mean "not now"; a dropped connection
+# or a server that was too slow is worth another try as well. Everything
+# else, 5xx included, is final.
+TRANSIENT_ERRORS = (NotAvailableException, RequestedActionAbortedException,
+                    TerminationConnectionException, TimeoutException)
+
+
+def is_transient_code(expect_value):
+    return (isinstance(expect_value, basestring) and len(expect_value) == 3
+            and expect_value.startswith('4'))
+
+
+def is_transient(error):
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    # other replies come as Exception('Some another error', code, ...)
+    return is_transient_code(get_error_code(error))
+
+
+def get_retry(message, result, error):
+    # message to send again for a (message, result, error) outcome or None
+    if error is not None:
+        return message if is_transient(error) else None
+    if isinstance(result, dict):
+        # multi-recipient transaction: retry only the deferred recipients
+        deferred = [recipient for recipient, expect_value in result.items()
+                    if is_transient_code(expect_value)]
+        if deferred:
+            retry = dict(message)
+            retry['recipient'] = deferred
+            return retry
+    return None
+
+
+class RetryScheduler():
+    # Holds messages that failed with a transient reply until their next
+    # attempt is due. Due times live in a heap, so finding what is due is
+    # O(log n) no matter how many messages are deferred, and nothing needs
+    # to poll the whole set.
+    BASE_DELAY = 30  # seconds before the first retry
+    MAX_DELAY = 3600
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 max_attempts=MAX_ATTEMPTS):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.heap = []  # (due time, sequence number, message)
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def get_delay(self, attempt):
+        # exponential backoff with jitter: half of the delay is fixed, the
+        # other half random, so deferred messages do not come back in waves
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def schedule(self, message):
+        # returns False when the message used up its attempts
+        attempt = message.get('attempt', 0)
+        if attempt >= self.max_attempts:
+            return False
+        retry = dict(message)
+        retry['attempt'] = attempt + 1
+        due = time.time() + self.get_delay(attempt)
+        with self.lock:
+            heapq.heappush(self.heap, (due, self.sequence.next(), retry))
+        return True
+
+    def pop_due(self, now=None):
+        if now is None:
+            now = time.time()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap)[2])
+        return due
+
+    def next_due(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def wait(self):
+        # sleep until the earliest deferred message is due
+        next_due = self.next_due()
+        if next_due is not None:
+            time.sleep(max(0, next_due - time.time()))
+
+
+def send_with_retries(messages, send, scheduler):
+    # send is a function taking an iterable of message dicts and yielding
+    # (message, result, error), e.g. delivery.send_many. It is called once:
+    # transient failures are deferred in scheduler and fed into the same
+    # stream when due, in between the new messages and after them, so its
+    # connections and workers serve the retries as well. When nothing is
+    # due while messages are still out, the stream gives None, which send
+    # must take as "nothing ready yet" like send_many does. This yields
+    # the final outcome of every attempt that will not be retried. A
+    # multi-recipient message whose deferred recipients are retried is held
+    # back until their last attempt and then yielded once, as it was
+    # given, with the latest reply code of every recipient.
+    held = {}  # retry id -> (message, {recipient: reply code})
+    retry_ids = itertools.count()
+    counts = {'sent': 0, 'done': 0}
+
+    def feed():
+        for message in messages:
+            counts['sent'] += 1
+            yield message
+            for retry in scheduler.pop_due():
+                counts['sent'] += 1
+                yield retry
+        while True:
+            for retry in scheduler.pop_due():
+                counts['sent'] += 1
+                yield retry
+            if counts['done'] < counts['sent']:
+                # their outcomes may bring more retries
+                yield None
+            elif not len(scheduler):
+                return
+            else:
+                scheduler.wait()
+
+    for message, result, error in send(feed()):
+        retry_id = message.get('retry_id')
+        if retry_id is not None and isinstance(result, dict):
+            held[retry_id][1].update(result)
+        retry = get_retry(message, result, error)
+        if retry is not None:
+            if retry_id is None and error is None:
+                retry_id = retry['retry_id'] = retry_ids.next()
+                held[retry_id] = (message, dict(result))
+            if scheduler.schedule(retry):
+                # done only now that the retry is scheduled, so the feed
+                # cannot end in between
+                counts['done'] += 1
+                continue
+        counts['done'] += 1
+        if retry_id is not None:
+            # the recipients that were accepted before count as well
+            message, result = held.pop(retry_id)
+            error = None
+        yield message, result, error
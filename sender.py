@@ -1,15 +1,36 @@
 from optparse import OptionParser
 import sys
 import ConfigParser
+import csv
+import json
 import os
+import shutil
+import tempfile
+import time
 from sending_service import EmailService
+from codec import encode_utf8
+from delivery import send_many, get_mime_message, is_delivered
+from sharding import ShardedSender
+from balancer import RelayBalancer, parse_relays
+from ratelimit import RateLimiter, parse_limits
+from spool import Spool
+from retry import RetryScheduler, send_with_retries, is_transient
+from template import Template
+from timeouts import Timeouts, set_default_timeouts
+import transcript
 from exception import ConnectionRefusedException, NotAvailableException,\
     UnknownServiceException, RequestedActionAbortedException,\
     TerminationConnectionException, SyntaxErrorException
 
 
 DEFAULT_PORT = 25
+DEFAULT_WORKERS = 4
+DEFAULT_PROCESSES = 1
+DEFAULT_RETRIES = 0
+DEFAULT_RESULTS_PATH = 'results.jsonl'
 SEND_COMPLETED = 'completed'
+SEND_FAILED = 'failed'
+ACCEPTED = (EmailService.COMPLETED, EmailService.WILL_FORWARD)
 
 
 def get_config_from_file(conf_file_path):
@@ -22,24 +43,119 @@ def get_config_from_file(conf_file_path):
     if 'log_path' in config.options('SectionOne'):
         log_path = config.get('SectionOne', 'log_path')
         conf_dict['log_path'] = log_path
+    for name in ('rate_limits', 'relay_rate_limits'):
+        if name in config.options('SectionOne'):
+            conf_dict[name] = [config.get('SectionOne', name)]
+    if 'rate_limit_dir' in config.options('SectionOne'):
+        conf_dict['rate_limit_dir'] = config.get('SectionOne',
+                                                 'rate_limit_dir')
+    for name, get in (('log_max_bytes', config.getint),
+                      ('log_backup_count', config.getint),
+                      ('log_sample_rate', config.getfloat),
+                      ('log_redact_body', config.getboolean),
+                      ('connect_timeout', config.getfloat),
+                      ('greeting_timeout', config.getfloat),
+                      ('command_timeout', config.getfloat),
+                      ('body_timeout', config.getfloat),
+                      ('message_timeout', config.getfloat),
+                      ('adaptive_timeouts', config.getboolean)):
+        if name in config.options('SectionOne'):
+            conf_dict[name] = get('SectionOne', name)
     return conf_dict
 
 
+def configure_transcript(conf_dict):
+    # log_max_bytes, log_backup_count, log_sample_rate and log_redact_body
+    # from the config file go to the transcript loggers
+    transcript.configure(**dict((name[len('log_'):], conf_dict[name])
+                                for name in ('log_max_bytes',
+                                             'log_backup_count',
+                                             'log_sample_rate',
+                                             'log_redact_body')
+                                if name in conf_dict))
+
+
+def configure_timeouts(conf_dict):
+    # connect_timeout, greeting_timeout, command_timeout, body_timeout and
+    # message_timeout (seconds) and adaptive_timeouts from the config file
+    names = ('connect', 'greeting', 'command', 'body', 'message')
+    options = dict((name, conf_dict[name + '_timeout']) for name in names
+                   if name + '_timeout' in conf_dict)
+    if options or conf_dict.get('adaptive_timeouts'):
+        set_default_timeouts(Timeouts(
+            adaptive=conf_dict.get('adaptive_timeouts', False), **options))
+
+
 def get_info_from_console():
     parser = OptionParser()
     parser.add_option("--sender", help="sender email address",
                       dest="sender", type="string")
     parser.add_option("-r", "--recipient", help="email address to "
-                       "deliver the message to", dest="recipient",
-                      type="string")
+                       "deliver the message to, may be given several "
+                       "times or as a comma separated list",
+                      dest="recipient", type="string", action="append")
     parser.add_option("-s", "--subject", help="subject of message",
                       dest="subject", type="string")
-    parser.add_option("--host", help="host", dest="smtp_host")
+    parser.add_option("--host", help="smtp relay as host or host:port, "
+                      "may be given several times or as a comma separated "
+                      "list to balance over several relays",
+                      dest="smtp_host", action="append")
     parser.add_option("-p", "--path", help="path to config file",
                       dest="conf_file_path")
     parser.add_option("-m", "--msg", help="path to file with message",
                       dest="msg_path")
+    parser.add_option("-a", "--attach", help="file to attach to the "
+                      "message, may be given several times",
+                      dest="attachments", action="append")
+    parser.add_option("-t", "--transport", help="how to talk to smtp "
+                      "server: socket (default) or telnet",
+                      dest="transport", type="choice",
+                      choices=list(EmailService.TRANSPORTS))
+    parser.add_option("--manifest", help="send every message listed in a "
+                      "JSONL or CSV file with sender, recipient, subject, "
+                      "msg_path and optional attachments fields",
+                      dest="manifest")
+    parser.add_option("--template", help="path to a message template in "
+                      "manifest mode, {field} is replaced with the field of "
+                      "the same name from each --data row, the same goes "
+                      "for --subject", dest="template")
+    parser.add_option("--data", help="JSONL or CSV file with a recipient "
+                      "field and the template fields for every message; a "
+                      "sender field there overrides --sender",
+                      dest="data")
+    parser.add_option("-w", "--workers", help="number of parallel "
+                      "connections in manifest mode", dest="workers",
+                      type="int", default=DEFAULT_WORKERS)
+    parser.add_option("--processes", help="number of sender processes in "
+                      "manifest mode, messages are split between them by "
+                      "recipient domain", dest="processes", type="int",
+                      default=DEFAULT_PROCESSES)
+    parser.add_option("--spool", help="journal file that keeps manifest "
+                      "messages until they are sent; run again with only "
+                      "--spool to resume after a crash", dest="spool")
+    parser.add_option("--results", help="file to write per-message results "
+                      "of manifest mode to", dest="results_path",
+                      default=DEFAULT_RESULTS_PATH)
+    parser.add_option("--retries", help="how many times to retry a message "
+                      "after a temporary (4xx) failure", dest="retries",
+                      type="int", default=DEFAULT_RETRIES)
+    parser.add_option("--retry-delay", help="seconds before the first retry, "
+                      "doubled for every next one", dest="retry_delay",
+                      type="float", default=RetryScheduler.BASE_DELAY)
+    parser.add_option("--rate-limit", help="DOMAIN=RATE[:BURST], at most "
+                      "RATE messages per second to recipients at DOMAIN "
+                      "with bursts of BURST, * for the other domains; may "
+                      "be given several times", dest="rate_limits",
+                      action="append")
+    parser.add_option("--relay-rate-limit", help="HOST[:PORT]=RATE[:BURST],"
+                      " the same for a relay", dest="relay_rate_limits",
+                      action="append")
+    parser.add_option("--rate-limit-dir", help="directory that keeps the "
+                      "rate limits, so that every sender process on this "
+                      "host that uses it shares them", dest="rate_limit_dir")
     (options, args) = parser.parse_args(sys.argv)
+    if options.manifest or options.spool or options.template:
+        return get_bulk_options(options)
     missing_options = []
     if not options.sender:
         missing_options.append('sender')
@@ -50,15 +166,24 @@ def get_info_from_console():
     if missing_options:
         raise ValueError('Please specify the following options: %s'
                          % (','.join(missing_options)))
+    recipients = [recipient.strip() for option in options.recipient
+                  for recipient in option.split(',') if recipient.strip()]
     console_options = {
         'sender': options.sender,
-        'recipient': options.recipient,
+        'recipient': recipients[0] if len(recipients) == 1 else recipients,
         'subject': options.subject,
+        'retries': options.retries,
+        'retry_delay': options.retry_delay,
     }
     if options.smtp_host:
-        console_options['smtp_host'] = options.smtp_host
+        console_options['smtp_host'] = ','.join(options.smtp_host)
     if options.conf_file_path:
         console_options['conf_file_path'] = options.conf_file_path
+    if options.transport:
+        console_options['transport'] = options.transport
+    get_rate_limit_options(options, console_options)
+    if options.attachments:
+        console_options['attachments'] = options.attachments
     if options.msg_path:
         console_options['msg_path'] = options.msg_path
     else:
@@ -67,6 +192,272 @@ def get_info_from_console():
     return console_options
 
 
+def get_bulk_options(options):
+    console_options = {
+        'workers': options.workers,
+        'processes': options.processes,
+        'retries': options.retries,
+        'retry_delay': options.retry_delay,
+        'results_path': options.results_path,
+    }
+    for name in ('manifest', 'spool', 'conf_file_path', 'transport',
+                 'template', 'data', 'sender', 'subject'):
+        if getattr(options, name):
+            console_options[name] = getattr(options, name)
+    if options.smtp_host:
+        console_options['smtp_host'] = ','.join(options.smtp_host)
+    get_rate_limit_options(options, console_options)
+    if options.template:
+        missing_options = [name for name in ('data', 'subject')
+                           if not getattr(options, name)]
+        if missing_options:
+            raise ValueError('Please specify the following options: %s'
+                             % (','.join(missing_options)))
+    return console_options
+
+
+def get_rate_limit_options(options, console_options):
+    for name in ('rate_limits', 'relay_rate_limits', 'rate_limit_dir'):
+        if getattr(options, name):
+            console_options[name] = getattr(options, name)
+
+
+def get_rate_limits(conf_dict):
+    # RateLimiter arguments, None when no limits are set
+    domain_limits = parse_limits(conf_dict.get('rate_limits', []))
+    relay_limits = parse_limits(conf_dict.get('relay_rate_limits', []))
+    if not domain_limits and not relay_limits:
+        return None
+    return {'domain_limits': domain_limits, 'relay_limits': relay_limits,
+            'directory': conf_dict.get('rate_limit_dir')}
+
+
+def read_records(path):
+    # yields one dict per record, .csv files are read as CSV with a header
+    # line, anything else as JSON lines
+    records_file = open(path, 'r')
+    try:
+        if path.endswith('.csv'):
+            records = csv.DictReader(records_file)
+        else:
+            records = (json.loads(line) for line in records_file
+                       if line.strip())
+        for record in records:
+            yield record
+    finally:
+        records_file.close()
+
+
+def get_recipient(record):
+    recipient = record['recipient']
+    if isinstance(recipient, basestring) and ',' in recipient:
+        recipient = [address.strip() for address in recipient.split(',')]
+    return recipient
+
+
+def read_manifest(manifest_path):
+    # a record without a msg or a msg_path fails when it is sent
+    for index, record in enumerate(read_records(manifest_path)):
+        record = encode_utf8(record)
+        message = {
+            'index': index,
+            'sender': record['sender'],
+            'recipient': get_recipient(record),
+            'subject': record['subject'],
+        }
+        if record.get('msg'):
+            message['msg'] = record['msg']
+        elif record.get('msg_path'):
+            # an empty msg column of a CSV manifest reads as ''
+            message['msg_path'] = record['msg_path']
+        attachments = record.get('attachments')
+        if attachments:
+            if isinstance(attachments, basestring):
+                attachments = [path.strip()
+                               for path in attachments.split(',')]
+            message['attachments'] = attachments
+        yield message
+
+
+def read_merge(template_path, data_path, subject, sender=None):
+    # renders the subject and the body template for every data row; both
+    # are parsed only once. A row without a sender column takes sender,
+    # without either it fails when it is sent
+    template_file = open(template_path, 'rb')
+    try:
+        body = Template(template_file.read())
+    finally:
+        template_file.close()
+    subject = Template(subject)
+    for index, record in enumerate(read_records(data_path)):
+        record = encode_utf8(record)
+        yield {
+            'index': index,
+            'sender': record.get('sender') or sender,
+            'recipient': get_recipient(record),
+            'subject': subject.render(record),
+            'msg': body.render(record),
+        }
+
+
+def get_relays(conf_dict):
+    # default_smtp or --host: one relay or a comma separated list of them
+    return parse_relays(conf_dict['smtp_host'], DEFAULT_PORT)
+
+
+def send_sharded(messages, processes, relays, log_path, transport, workers,
+                 rate_limits=None):
+    sharded = ShardedSender(processes, None, DEFAULT_PORT, workers,
+                            max_per_host=workers, log_path=log_path,
+                            transport=transport, relays=relays,
+                            rate_limits=rate_limits)
+    for shard, message, status, result in sharded.send(messages):
+        if isinstance(result, Exception):
+            yield message, None, result
+        else:
+            yield message, result, None
+
+
+def get_error_detail(error):
+    # the args of error as text; unicode args and reply text that is not
+    # UTF-8 must not fail the whole run
+    return u' '.join(arg if isinstance(arg, unicode) else
+                     str(arg).decode('utf-8', 'replace')
+                     for arg in error.args if arg is not None)
+
+
+def send_bulk(messages, relays, log_path, transport, workers, results_path,
+              processes=DEFAULT_PROCESSES, spool=None, scheduler=None,
+              rate_limits=None):
+    # messages are spread over the relays, see balancer.RelayBalancer, and
+    # held to rate_limits, see ratelimit.RateLimiter
+    balancer = RelayBalancer(relays)
+    limiter = None
+    directory = None
+    if rate_limits is not None:
+        if processes > 1 and not rate_limits['directory']:
+            # the processes share the limits through files
+            directory = tempfile.mkdtemp()
+            rate_limits = dict(rate_limits, directory=directory)
+        limiter = RateLimiter(**rate_limits)
+
+    def send(messages):
+        if processes > 1:
+            return send_sharded(messages, processes, relays, log_path,
+                                transport, workers, rate_limits)
+        return send_many(messages, workers, max_per_host=workers,
+                         log_path=log_path, transport=transport,
+                         balancer=balancer, limiter=limiter)
+
+    if scheduler is not None:
+        outcomes = send_with_retries(messages, send, scheduler)
+    else:
+        outcomes = send(messages)
+    if spool is not None:
+        outcomes = spool.track(outcomes)
+    results = open(results_path, 'w')
+    counters = {SEND_COMPLETED: 0, SEND_FAILED: 0}
+    start = time.time()
+    try:
+        for message, reply, error in outcomes:
+            result = {'index': message['index'],
+                      'recipient': message['recipient']}
+            if error is None:
+                # failed when no recipient was accepted
+                result['status'] = SEND_COMPLETED if is_delivered(reply) \
+                    else SEND_FAILED
+                if isinstance(reply, dict):
+                    result['recipients'] = reply
+            else:
+                result['status'] = SEND_FAILED
+                result['error'] = type(error).__name__
+                if error.args:
+                    # reply errors carry the code, the enhanced status code
+                    # (None when the server sent none) and the reply text
+                    result['detail'] = get_error_detail(error)
+            counters[result['status']] += 1
+            results.write(json.dumps(result) + '\n')
+    finally:
+        results.close()
+        if directory is not None:
+            shutil.rmtree(directory)
+    counters['elapsed'] = time.time() - start
+    return counters
+
+
+def get_scheduler(conf_dict):
+    if not conf_dict.get('retries'):
+        return None
+    return RetryScheduler(conf_dict['retry_delay'],
+                          max_attempts=conf_dict['retries'])
+
+
+def send_email_with_retries(balancer, log_path, transport, sender, recipient,
+                            subject, msg, scheduler, limiter=None):
+    def send(smtp_host, smtp_port):
+        if limiter is not None:
+            limiter.wait_relay(smtp_host, smtp_port)
+        if hasattr(msg, 'seek'):
+            msg.seek(0)  # a relay that failed may have read part of it
+        con = EmailService(smtp_host, smtp_port, log_path, transport)
+        try:
+            return con.send_email(sender, recipient, subject, msg)
+        finally:
+            # after QUIT or a failure, the next relay gets a new connection
+            con.child.close(True)
+
+    attempt = 0
+    while True:
+        try:
+            if limiter is not None:
+                limiter.wait_recipients(recipient)
+            # fails over to the other relays before it counts as a failure
+            return balancer.call(send)
+        except Exception, opt:
+            if (scheduler is None or attempt >= scheduler.max_attempts or
+                    not is_transient(opt)):
+                raise
+            delay = scheduler.get_delay(attempt)
+            print 'Temporary failure (%s), retrying in %.1f s' % (
+                type(opt).__name__, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def run_bulk(conf_dict):
+    spool = None
+    messages = None
+    if 'manifest' in conf_dict:
+        messages = read_manifest(conf_dict['manifest'])
+    elif 'template' in conf_dict:
+        messages = read_merge(conf_dict['template'], conf_dict['data'],
+                              conf_dict['subject'], conf_dict.get('sender'))
+    if 'spool' in conf_dict:
+        spool = Spool(conf_dict['spool'])
+        if messages is not None:
+            # journaled while the messages from before are going out
+            spool.feed(messages)
+        messages = spool.take()
+    try:
+        counters = send_bulk(messages, get_relays(conf_dict),
+                             conf_dict.get('log_path', ''),
+                             conf_dict.get('transport',
+                                           EmailService.SOCKET_TRANSPORT),
+                             conf_dict['workers'], conf_dict['results_path'],
+                             conf_dict['processes'], spool,
+                             get_scheduler(conf_dict),
+                             get_rate_limits(conf_dict))
+    finally:
+        if spool is not None:
+            spool.close()
+    total = counters[SEND_COMPLETED] + counters[SEND_FAILED]
+    elapsed = counters['elapsed']
+    print 'Sent %d of %d messages in %.2f s (%.1f msgs/sec), ' \
+          'results are in %s' % (counters[SEND_COMPLETED], total,
+                                 elapsed, total / max(elapsed, 1e-6),
+                                 conf_dict['results_path'])
+
+
 def main():
     DEFAULT_PATH_CONFIG = os.path.join("config/smtp_config.ini")
     try:
@@ -78,29 +469,48 @@ def main():
     config_path = console_options.get('conf_file_path', DEFAULT_PATH_CONFIG)
     conf_dict = get_config_from_file(config_path)
     conf_dict.update(console_options)
+    configure_transcript(conf_dict)
+    configure_timeouts(conf_dict)
 
-    if not 'msg' in conf_dict:
-        msg_path = console_options['msg_path']
-        file = open(msg_path, 'r')
-        try:
-            msg = file.read()
-            conf_dict['msg'] = msg
-        finally:
-            file.close()
+    if ('manifest' in conf_dict or 'spool' in conf_dict or
+            'template' in conf_dict):
+        run_bulk(conf_dict)
+        return
 
     log_path = conf_dict.get('log_path', '')
-    smtp_host = conf_dict['smtp_host']
-    smtp_port = DEFAULT_PORT
+    balancer = RelayBalancer(get_relays(conf_dict))
+    rate_limits = get_rate_limits(conf_dict)
+    limiter = None if rate_limits is None else RateLimiter(**rate_limits)
+    transport = conf_dict.get('transport', EmailService.SOCKET_TRANSPORT)
     sender = conf_dict['sender']
     recipient = conf_dict['recipient']
     subject = conf_dict['subject']
-    msg = conf_dict['msg']
 
     try:
-        con = EmailService(smtp_host, smtp_port, log_path)
-        result = con.send_email(sender, recipient, subject, msg)
+        if 'msg' in conf_dict:
+            msg = conf_dict['msg']
+        else:
+            # the body is streamed from the file while it is sent
+            msg = open(conf_dict['msg_path'], 'rb')
+        if 'attachments' in conf_dict:
+            msg = get_mime_message(msg, conf_dict['attachments'])
+        try:
+            result = send_email_with_retries(balancer, log_path, transport,
+                                             sender, recipient, subject, msg,
+                                             get_scheduler(conf_dict),
+                                             limiter)
+        finally:
+            if hasattr(msg, 'close'):
+                msg.close()
         if result == SEND_COMPLETED:
             print 'Send mail action okay, completed'
+        elif isinstance(result, dict):
+            for address in recipient:
+                if result[address] in ACCEPTED:
+                    print '%s: send mail action okay, completed' % address
+                else:
+                    print '%s: rejected with reply code %s' % (
+                        address, result[address])
     except ConnectionRefusedException:
         print ' Unable to connect to remote host: Connection refused'
     except UnknownServiceException:
@@ -1,13 +1,23 @@
 from exception import ConnectionRefusedException, NotAvailableException,\
-    UnknownServiceException, RequestedActionAbortedException, \
-    TerminationConnectionException, SyntaxErrorException
+    UnknownServiceException, TerminationConnectionException, TimeoutException
+from codec import CrlfFile, DataEncoder
+from capabilities import CAPABILITY_CACHE
+import capabilities
+import metrics
+import reply
+import transcript
+import transport
+from timeouts import BODY, COMMAND, CONNECT, GREETING, get_default_timeouts
 import pexpect
+import functools
 import logging
+import socket
 
 
 class EmailService():
     SERVICE_READY = '220'
     COMPLETED = '250'
+    WILL_FORWARD = '251'
     SERVICE_NOT_AVAILABLE = '421'
     CONNECTION_REFUSED = 'Connection refused'
     UNKNOWN_SERVICE = 'Name or service not known'
@@ -15,46 +25,107 @@ class EmailService():
     START_MAIL_INPUT = '354'
     SERVICE_CLOSING = '221'
     SYNTAX_ERROR = '500'
+    NOT_IMPLEMENTED = '502'
 
     TEL_COMMAND = 'telnet {host} {port}'
     MAIL_FROM = 'mail from: {sender}'
     RECIPIENT = 'rcpt to: {recipient}'
-    MSG = '{msg}\n.'
+    EHLO = 'ehlo {hostname}'
+    HELO = 'helo {hostname}'
+    PIPELINING = capabilities.PIPELINING
+    CHUNKING = capabilities.CHUNKING
+    BDAT = 'bdat {size}'
+    BDAT_LAST = 'bdat {size} last'
+    RSET = 'rset'
+    NOOP = 'noop'
+    QUIT = 'quit'
     SUBJECT = 'Subject:{subject}'
     COMMAND_CODE_REGEXP = '(?P<code>\d{3})(?P<other>.+$)'
+    # last line of a possibly multiline reply, for the EHLO reply on telnet
+    LAST_LINE_REGEXP = '(?P<code>\d{3})(?P<other> [^\r\n]*)\r*\n'
     SEND_COMPLETED = 'completed'
     CONNECT = 'Connected to {host}'
+    CHUNK_SIZE = 65536
+    BDAT_CHUNK_SIZE = 1048576
+    SOCKET_TRANSPORT = 'socket'
+    TELNET_TRANSPORT = 'telnet'
+    TRANSPORTS = (SOCKET_TRANSPORT, TELNET_TRANSPORT)
 
-    def __init__(self, smtp_host, smtp_port, log_path):
+    def __init__(self, smtp_host, smtp_port, log_path,
+                 transport=SOCKET_TRANSPORT, timeouts=None):
+        if transport not in self.TRANSPORTS:
+            raise ValueError('Unknown transport: %s' % transport)
+        self.transport = transport
+        self.host_key = (smtp_host, smtp_port)
+        # timeouts.Timeouts for every phase, None keeps the defaults of the
+        # transport (30 s)
+        self.timeouts = timeouts if timeouts is not None else \
+            get_default_timeouts()
+        # monotonic times by which the current message and body must be done
+        self.deadline = None
+        self.body_deadline = None
+        # True while a MAIL transaction is open on the connection
+        self.in_transaction = False
+        # reply.Reply of every reply read by the last expect_replies
+        self.last_replies = []
+        # ESMTP extensions advertised in the EHLO reply: keyword -> params
+        self.extensions = {}
+        # transcript of this connection when log_path is given and it is
+        # sampled
+        self.transcript = transcript.NULL_SESSION
         self.child = self.establish_connection(smtp_host,
                                                 log_path, smtp_port)
 
-    def establish_connection(self, smtp_host, log_path, smtp_port):
-        CONNECT_TO = self.CONNECT.format(host=smtp_host)
+    def __enter__(self):
+        return self
 
-        command = self.TEL_COMMAND.format(host=smtp_host, port=smtp_port)
-        child = pexpect.spawn(command)  # connect to smtp server
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
+    def set_logfile(self, child, log_path):
+        # connections to the same log_path share one transcript logger that
+        # writes in the background, see transcript.configure for its options.
+        # With telnet the terminal echoes what is sent, so a redacted body
+        # still shows up among what is read.
         if log_path != '':
             try:
-                log_output = open(log_path, 'w')
-                child.logfile = log_output
+                session = transcript.get_logger(log_path).open_session()
             except IOError, opt:
                 logging.basicConfig(level=logging.DEBUG)
                 logging.warning(u'Failed to open pexpect log file: %s' % opt)
+                return
+            child.logfile_send = session.sent
+            child.logfile_read = session.received
+            self.transcript = session
+
+    def establish_connection(self, smtp_host, log_path, smtp_port):
+        if self.transport == self.SOCKET_TRANSPORT:
+            return self.establish_socket_connection(smtp_host, log_path,
+                                                    smtp_port)
+        CONNECT_TO = self.CONNECT.format(host=smtp_host)
 
         expect_options = [self.CONNECTION_REFUSED, CONNECT_TO,
                           self.UNKNOWN_SERVICE, pexpect.EOF, pexpect.TIMEOUT]
         smtp_con_option = [self.COMMAND_CODE_REGEXP, pexpect.EOF,
                            pexpect.TIMEOUT]
 
-        i = child.expect(expect_options)
+        with metrics.timer('connect'):
+            command = self.TEL_COMMAND.format(host=smtp_host, port=smtp_port)
+            child = pexpect.spawn(command)  # connect to smtp server
+            self.set_logfile(child, log_path)
+            i = self.expect(child, expect_options, CONNECT)
         if expect_options[i] == CONNECT_TO:
-            k = child.expect(smtp_con_option)
+            with metrics.timer('greeting'):
+                k = self.expect(child, smtp_con_option, GREETING)
 
             if smtp_con_option[k] == self.COMMAND_CODE_REGEXP:
                 expect_value = self.get_expect_smtp_reply_code(child)
                 if expect_value == self.SERVICE_READY:
+                    try:
+                        self.ehlo(child)
+                    except:
+                        child.close(True)
+                        raise
                     return child
                 elif expect_value == self.SERVICE_NOT_AVAILABLE:
                     child.close(True)
@@ -63,8 +134,8 @@ class EmailService():
                 raise Exception('EOF error.SMTP could not connect.'
                                 ' Here is what SMTP said:', child.before)
             elif smtp_con_option[k] == pexpect.TIMEOUT:
-                raise Exception('TIMEOUT error. Here is what SMTP said:',
-                                child.before)
+                raise TimeoutException('TIMEOUT error. Here is what SMTP '
+                                       'said:', child.before)
 
         elif expect_options[i] == self.CONNECTION_REFUSED:
             child.close(True)
@@ -76,75 +147,466 @@ class EmailService():
             raise Exception('EOF error. Telnet could not connect.'
                             ' Here is what telnet said:', child.before)
         elif expect_options[i] == pexpect.TIMEOUT:
-            raise Exception('TIMEOUT error. Here is what telnet said:',
-                            child.before)
+            raise TimeoutException('TIMEOUT error. Here is what telnet '
+                                   'said:', child.before)
+
+    def establish_socket_connection(self, smtp_host, log_path, smtp_port):
+        timeout = self.get_timeout(
+            CONNECT, default=transport.SocketTransport.CONNECT_TIMEOUT)
+        with metrics.timer('connect'):
+            start = metrics.monotonic()
+            if timeout is None:
+                child = transport.SocketTransport(smtp_host, smtp_port)
+            else:
+                child = transport.SocketTransport(smtp_host, smtp_port,
+                                                  timeout)
+            if self.timeouts is not None:
+                self.timeouts.observe(self.host_key, CONNECT,
+                                      metrics.monotonic() - start)
+        self.set_logfile(child, log_path)
+
+        with metrics.timer('greeting'):
+            self.expect(child, self.COMMAND_CODE_REGEXP, GREETING)
+            # get greeting (SMTP reply code) from smtp server
+            expect_value = self.get_expect_smtp_reply_code(child)
+            if expect_value != self.SERVICE_READY:
+                child.close(True)
+                raise reply.get_reply_error(expect_value,
+                                            self.get_reply(child))
+        try:
+            self.ehlo(child)
+        except:
+            child.close(True)
+            raise
+        return child
 
     def get_expect_smtp_reply_code(self, child):
         m = child.match.group('code')
         return m
 
+    @metrics.timed('ehlo')
+    def ehlo(self, child):
+        hostname = socket.gethostname()
+        child.sendline(self.EHLO.format(hostname=hostname))
+
+        self.expect(child, self.LAST_LINE_REGEXP)
+        # get answer (SMTP reply code) from smtp command EHLO
+        expect_value = self.get_expect_smtp_reply_code(child)
+        if expect_value == self.COMPLETED:
+            # parsed once per host while the cache entry is fresh
+            self.extensions = CAPABILITY_CACHE.get_extensions(
+                self.host_key, self.get_reply_lines(child))
+            return self.extensions
+        elif expect_value in (self.SYNTAX_ERROR, self.NOT_IMPLEMENTED):
+            # server does not know ESMTP, fall back to plain SMTP
+            child.sendline(self.HELO.format(hostname=hostname))
+        else:
+            self.check_reply(expect_value, self.COMPLETED,
+                             self.get_reply(child))
+
+        self.expect(child, self.LAST_LINE_REGEXP)
+        # get answer (SMTP reply code) from smtp command HELO
+        expect_value = self.get_expect_smtp_reply_code(child)
+        self.check_reply(expect_value, self.COMPLETED, self.get_reply(child))
+        self.extensions = {}
+        return self.extensions
+
+    def get_timeout(self, phase, adaptive=True, default=None):
+        # seconds to wait in phase, at most what is left of the message and
+        # body deadlines; None when no timeouts are configured. Without
+        # adaptive only the configured limit and the deadlines count.
+        # default is the transport's own timeout, the most an adaptive
+        # timeout may be when phase has no configured limit.
+        if self.timeouts is None:
+            return None
+        if adaptive:
+            timeout = self.timeouts.get(self.host_key, phase, default)
+        else:
+            timeout = self.timeouts.get_limit(phase)
+        for deadline in (self.deadline,
+                         self.body_deadline if phase == BODY else None):
+            if deadline is None:
+                continue
+            remaining = deadline - metrics.monotonic()
+            if remaining <= 0:
+                self.child.close(True)
+                raise TimeoutException('TIMEOUT error. Deadline of the %s '
+                                       'passed' % ('message' if deadline is
+                                                   self.deadline else BODY))
+            timeout = remaining if timeout is None else min(timeout,
+                                                            remaining)
+        return timeout
+
+    def expect(self, child, pattern, phase=COMMAND):
+        # child.expect with the timeout of phase, or the child's own timeout
+        # when none is configured; a reply that does not come in time leaves
+        # the session in an unknown state, so it is dropped either way
+        timeout = self.get_timeout(phase, default=(
+            child.timeout if self.timeouts is not None else None))
+        start = metrics.monotonic()
+        try:
+            if timeout is None:
+                i = child.expect(pattern)
+            else:
+                i = child.expect(pattern, timeout=timeout)
+        except (pexpect.TIMEOUT, TimeoutException):
+            child.close(True)
+            raise TimeoutException('TIMEOUT error. No %s reply in time' %
+                                   phase, self.host_key)
+        if self.timeouts is not None and (not isinstance(pattern, list) or
+                                          pattern[i] is not pexpect.TIMEOUT):
+            self.timeouts.observe(self.host_key, phase,
+                                  metrics.monotonic() - start)
+        return i
+
+    def send_data(self, data):
+        # body data goes out within what is left of the body deadline; how
+        # long replies took says nothing about how long a write may take
+        if self.timeouts is None:
+            self.child.send(data)
+            return
+        timeout = self.child.timeout
+        body_timeout = self.get_timeout(BODY, adaptive=False)
+        if body_timeout is not None:
+            # without a body limit or deadline the transport's own timeout
+            # still guards the write
+            self.child.timeout = body_timeout
+        try:
+            self.child.send(data)
+        finally:
+            self.child.timeout = timeout
+
+    def get_reply_lines(self, child):
+        # text lines of the last reply without the reply codes
+        if isinstance(child.match, reply.Reply):
+            return child.match.lines
+        # pexpect: continuation lines are in front of the match
+        return [line[4:] for line in child.before.splitlines()
+                if line[3:4] == '-'] + [child.match.group('other')[1:]]
+
+    def supports(self, extension):
+        return extension in self.extensions
+
+    def get_max_size(self):
+        # SIZE limit of the server in bytes or None
+        return capabilities.get_size(self.extensions)
+
+    def get_reply(self, child):
+        # the last reply as a reply.Reply, so errors can carry its text
+        match = child.match
+        if isinstance(match, reply.Reply):
+            return match
+        if hasattr(match, 'group'):  # pexpect
+            return reply.Reply(match.group('code'),
+                               self.get_reply_lines(child))
+        return None
+
+    def check_reply(self, expect_value, expected, smtp_reply=None):
+        # smtp_reply defaults to the reply read last
+        if expect_value != expected:
+            if smtp_reply is None:
+                smtp_reply = self.get_reply(self.child)
+            reply.check_reply(expect_value, expected, smtp_reply)
+
     def send_email(self, sender, recipient, subject, msg):
+        result = self.send_message(sender, recipient, subject, msg)
+        self.quit()
+        return result
+
+    @metrics.timed('message')
+    def send_message(self, sender, recipient, subject, msg):
+        # one MAIL transaction; the connection stays open for the next one.
+        # recipient is either one address, then any rejection raises, or a
+        # list of addresses, then a dict {address: RCPT reply code} is
+        # returned and the message goes to every accepted address.
+        if self.timeouts is not None and self.timeouts.message is not None:
+            self.deadline = metrics.monotonic() + self.timeouts.message
+        try:
+            return self.send_transaction(sender, recipient, subject, msg)
+        finally:
+            self.deadline = self.body_deadline = None
+
+    def send_transaction(self, sender, recipient, subject, msg):
         if not self.child.isalive():  # check is child alive
             raise TerminationConnectionException
-        # sending line to smtp server with info about sender
-        self.child.sendline(self.MAIL_FROM.format(sender=sender))
-
-        self.child.expect(self.COMMAND_CODE_REGEXP)
-        # get answer (SMTP reply code) from smtp command MAIL TO
-        expect_value = self.get_expect_smtp_reply_code(self.child)
-        if expect_value == self.COMPLETED:
-            self.child.sendline(self.RECIPIENT.format(recipient=recipient))
-        elif expect_value == self.REQUEST_ABORTED:
-            raise RequestedActionAbortedException
-        elif expect_value == self.SYNTAX_ERROR:
-            raise SyntaxErrorException
+        if self.in_transaction:  # previous transaction was not finished
+            self.reset()
+        self.in_transaction = True
+        self.transcript.next_message()
+        if isinstance(recipient, basestring):
+            recipients, strict = [recipient], True
+        else:
+            recipients, strict = list(recipient), False
+        chunked = self.can_chunk(msg)
+        if self.can_pipeline():
+            results = self.send_pipelined_envelope(sender, recipients, strict,
+                                                   not chunked)
         else:
-            raise Exception('Some another error', expect_value)
+            results = self.send_envelope(sender, recipients, strict,
+                                         not chunked)
+        if not self.accepted(results):
+            return results
+        with metrics.timer('body'):
+            self.transcript.start_body()
+            self.start_body_deadline()
+            try:
+                if chunked:
+                    self.send_chunked_body(subject, msg)
+                else:
+                    self.child.sendline(self.SUBJECT.format(subject=subject))
+                    if isinstance(msg, basestring):
+                        msg = [msg]
+                    self.send_body(msg)
+            finally:
+                self.transcript.end_body()
+            if not chunked:
+                self.expect(self.child, self.COMMAND_CODE_REGEXP, BODY)
+                # get answer (SMTP reply code)  from sending message
+                expect_value = self.get_expect_smtp_reply_code(self.child)
+                self.check_reply(expect_value, self.COMPLETED)
+        self.in_transaction = False
+        return self.SEND_COMPLETED if strict else results
 
-        self.child.expect(self.COMMAND_CODE_REGEXP)
-        # get answer (SMTP reply code) from smtp command RCPT
-        expect_value = self.get_expect_smtp_reply_code(self.child)
-        if expect_value == self.COMPLETED:
+    def start_body_deadline(self):
+        # the configured limit, the upload of a large body may take it all
+        if self.timeouts is not None:
+            timeout = self.timeouts.get_limit(BODY)
+            if timeout is not None:
+                self.body_deadline = metrics.monotonic() + timeout
+
+    def send_envelope(self, sender, recipients, strict=True, data=True):
+        with metrics.timer('mail'):
+            # sending line to smtp server with info about sender
+            self.child.sendline(self.MAIL_FROM.format(sender=sender))
+
+            self.expect(self.child, self.COMMAND_CODE_REGEXP)
+            # get answer (SMTP reply code) from smtp command MAIL TO
+            expect_value = self.get_expect_smtp_reply_code(self.child)
+            self.check_reply(expect_value, self.COMPLETED)
+
+        results = {}
+        for recipient in recipients:
+            with metrics.timer('rcpt') as phase:
+                self.child.sendline(self.RECIPIENT.format(
+                    recipient=recipient))
+
+                self.expect(self.child, self.COMMAND_CODE_REGEXP)
+                # get answer (SMTP reply code) from smtp command RCPT
+                expect_value = self.get_expect_smtp_reply_code(self.child)
+                results[recipient] = phase.outcome = expect_value
+                if strict:
+                    self.check_rcpt_reply(expect_value)
+        if not self.accepted(results) or not data:
+            return results
+        with metrics.timer('data'):
             self.child.sendline('DATA')
-        elif expect_value == self.REQUEST_ABORTED:
-            raise RequestedActionAbortedException
-        elif expect_value == self.SYNTAX_ERROR:
-            raise SyntaxErrorException
-        else:
-            raise Exception('Some another error', expect_value)
 
-        self.child.expect(self.COMMAND_CODE_REGEXP)
-        # get answer (SMTP reply code) from smtp command DATA
+            self.expect(self.child, self.COMMAND_CODE_REGEXP)
+            # get answer (SMTP reply code) from smtp command DATA
+            expect_value = self.get_expect_smtp_reply_code(self.child)
+            self.check_reply(expect_value, self.START_MAIL_INPUT)
+        return results
+
+    def accepted(self, results):
+        return [recipient for recipient, expect_value in results.items()
+                if expect_value in (self.COMPLETED, self.WILL_FORWARD)]
+
+    def check_rcpt_reply(self, expect_value, smtp_reply=None):
+        # 251 accepts the recipient as well as 250 does
+        if expect_value != self.WILL_FORWARD:
+            self.check_reply(expect_value, self.COMPLETED, smtp_reply)
+
+    def can_pipeline(self):
+        # the telnet transport cannot tell pipelined replies apart
+        return (self.supports(self.PIPELINING) and
+                self.transport == self.SOCKET_TRANSPORT)
+
+    @metrics.timed('envelope')
+    def send_pipelined_envelope(self, sender, recipients, strict=True,
+                                data=True):
+        commands = [self.MAIL_FROM.format(sender=sender)]
+        commands.extend(self.RECIPIENT.format(recipient=recipient)
+                        for recipient in recipients)
+        if data:
+            commands.append('DATA')
+        linesep = transport.SocketTransport.LINESEP
+        # write MAIL FROM, every RCPT TO and DATA at once, then read their
+        # replies in the same order
+        self.child.send(''.join(command + linesep for command in commands))
+        replies = self.expect_replies(len(commands))
+        if len(replies) < len(commands):
+            # 421 came and the server closed the connection, the replies to
+            # the other commands never come
+            self.child.close(True)
+            raise reply.get_reply_error(replies[-1], self.last_replies[-1])
+        replies_read = self.last_replies
+        mail_reply = replies[0]
+        data_reply = replies[-1] if data else None
+        results = dict(zip(recipients, replies[1:len(recipients) + 1]))
+        if data_reply == self.START_MAIL_INPUT and (
+                mail_reply != self.COMPLETED or not self.accepted(results)):
+            if self.accepted(results):
+                # ending the message would deliver it empty to the accepted
+                # recipients, the session is dropped instead
+                self.child.close(True)
+            else:
+                # DATA was accepted although the envelope was not: end the
+                # empty message and let the server reject it
+                self.child.sendline('.')
+                self.expect(self.child, self.COMMAND_CODE_REGEXP)
+                self.get_expect_smtp_reply_code(self.child)
+        self.check_reply(mail_reply, self.COMPLETED, replies_read[0])
+        if strict:
+            self.check_rcpt_reply(results[recipients[0]], replies_read[1])
+        if data and self.accepted(results):
+            self.check_reply(data_reply, self.START_MAIL_INPUT,
+                             replies_read[-1])
+        return results
+
+    def expect_replies(self, count, phase=COMMAND):
+        # replies to count pipelined commands; reading stops at a 421, the
+        # server closes the connection after it (RFC 5321, 3.8). The whole
+        # replies are kept in self.last_replies for the errors.
+        replies = []
+        self.last_replies = []
+        for i in range(count):
+            self.expect(self.child, self.COMMAND_CODE_REGEXP, phase)
+            expect_value = self.get_expect_smtp_reply_code(self.child)
+            replies.append(expect_value)
+            self.last_replies.append(self.get_reply(self.child))
+            if expect_value == self.SERVICE_NOT_AVAILABLE:
+                break
+        return replies
+
+    def can_chunk(self, msg):
+        # BDAT is used for file bodies, sent as they are read; string bodies
+        # are small and go through DATA and its encoder
+        return (self.supports(self.CHUNKING) and hasattr(msg, 'read') and
+                self.transport == self.SOCKET_TRANSPORT)
+
+    def read_chunks(self, msg):
+        # (chunk, last) for BDAT_CHUNK_SIZE chunks of a file body, each one
+        # is sent before the next one is read. A codec.CrlfFile that is a
+        # real file is read into one reused buffer and handed out as
+        # memoryviews; other bodies get CRLF line endings, without the
+        # dot-stuffing of DATA.
+        if not isinstance(msg, CrlfFile):
+            encoder = DataEncoder(dot_stuffing=False)
+            while True:
+                data = msg.read(self.BDAT_CHUNK_SIZE)
+                last = len(data) < self.BDAT_CHUNK_SIZE
+                chunk = encoder.encode(data)
+                if last:
+                    yield chunk + encoder.flush(), True
+                    return
+                yield chunk, False
+        if not hasattr(msg, 'readinto'):
+            while True:
+                chunk = msg.read(self.BDAT_CHUNK_SIZE)
+                last = len(chunk) < self.BDAT_CHUNK_SIZE
+                yield chunk, last
+                if last:
+                    return
+        buffer = bytearray(self.BDAT_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            size = 0
+            while size < len(buffer):
+                read = msg.readinto(view[size:])
+                if not read:
+                    break
+                size += read
+            last = size < len(buffer)
+            yield view[:size], last
+            if last:
+                return
+
+    def send_chunked_body(self, subject, msg):
+        # BDAT (RFC 3030): the body goes out in sized chunks as it is read,
+        # without dot-stuffing or a final '.' line. With PIPELINING the
+        # chunks are not held up by the replies, which are read after the
+        # last one.
+        linesep = transport.SocketTransport.LINESEP
+        header = self.SUBJECT.format(subject=subject) + linesep
+        pipelined = self.can_pipeline()
+        waiting = 0  # BDAT commands sent without reading their reply
+        for chunk, last in self.read_chunks(msg):
+            command = self.BDAT_LAST if last else self.BDAT
+            self.send_data(command.format(size=len(header) + len(chunk)) +
+                           linesep + header)
+            if len(chunk):
+                self.send_data(chunk)
+            header = ''
+            waiting += 1
+            if last or not pipelined:
+                replies = self.expect_replies(waiting, BODY)
+                for expect_value, smtp_reply in zip(replies,
+                                                    self.last_replies):
+                    self.check_reply(expect_value, self.COMPLETED,
+                                     smtp_reply)
+                waiting = 0
+
+    def get_linesep(self):
+        if self.transport == self.SOCKET_TRANSPORT:
+            return transport.SocketTransport.LINESEP
+        return '\n'  # telnet turns it into CRLF itself
+
+    def iter_chunks(self, msg):
+        if hasattr(msg, 'read'):
+            return iter(functools.partial(msg.read, self.CHUNK_SIZE), '')
+        return iter(msg)
+
+    def send_body(self, msg):
+        # stream a string list, file-like or iterable body in chunks through
+        # the DATA encoder, ending it with the final '.' line. A chunk is
+        # held back until the next one arrives, so the last one goes out in
+        # one write together with the terminator.
+        encoder = DataEncoder(self.get_linesep())
+        pending = ''
+        for chunk in self.iter_chunks(msg):
+            data = encoder.encode(chunk)
+            if not data:
+                continue
+            if pending:
+                self.send_data(pending)
+            pending = data
+        self.send_data(pending + encoder.finish())
+
+    @metrics.timed('rset')
+    def reset(self):
+        self.child.sendline(self.RSET)
+
+        self.expect(self.child, self.COMMAND_CODE_REGEXP)
+        # get answer (SMTP reply code) from smtp command RSET
         expect_value = self.get_expect_smtp_reply_code(self.child)
-        if expect_value == self.START_MAIL_INPUT:
-            self.child.sendline(self.SUBJECT.format(subject=subject))
-            self.child.sendline(self.MSG.format(msg=msg))
-        elif expect_value == self.REQUEST_ABORTED:
-            raise RequestedActionAbortedException
-        elif expect_value == self.SYNTAX_ERROR:
-            raise SyntaxErrorException
-        else:
-            raise Exception('Some another error', expect_value)
+        self.check_reply(expect_value, self.COMPLETED)
+        self.in_transaction = False
+
+    @metrics.timed('noop')
+    def noop(self):
+        self.child.sendline(self.NOOP)
 
-        self.child.expect(self.COMMAND_CODE_REGEXP)
-        # get answer (SMTP reply code)  from sending message
+        self.expect(self.child, self.COMMAND_CODE_REGEXP)
+        # get answer (SMTP reply code) from smtp command NOOP
         expect_value = self.get_expect_smtp_reply_code(self.child)
-        if expect_value == self.COMPLETED:
-            self.child.sendline('quit')
-        elif expect_value == self.REQUEST_ABORTED:
-            raise RequestedActionAbortedException
-        elif expect_value == self.SYNTAX_ERROR:
-            raise SyntaxErrorException
-        else:
-            raise Exception('Some another error', expect_value)
+        self.check_reply(expect_value, self.COMPLETED)
+        return True
 
-        self.child.expect(self.COMMAND_CODE_REGEXP)
+    @metrics.timed('quit')
+    def quit(self):
+        self.child.sendline(self.QUIT)
+
+        self.expect(self.child, self.COMMAND_CODE_REGEXP)
         # get answer (SMTP reply code) from smtp command quit
         expect_value = self.get_expect_smtp_reply_code(self.child)
-        if expect_value == self.SERVICE_CLOSING:
-            return self.SEND_COMPLETED
-        if expect_value == self.SYNTAX_ERROR:
-            raise SyntaxErrorException
-        # if not expect_value == self.SERVICE_CLOSING:
-        else:
-            raise Exception('Some another error', expect_value)
+        self.check_reply(expect_value, self.SERVICE_CLOSING)
+        return self.SEND_COMPLETED
+
+    def close(self):
+        # end the session: say QUIT if the server still listens, then drop
+        # the connection
+        try:
+            if self.child.isalive():
+                return self.quit()
+        finally:
+            self.child.close(True)
@@ -0,0 +1,235 @@
+from sending_service import EmailService
+from delivery import send_many, is_delivered, DEFAULT_PORT, DEFAULT_WORKERS,\
+    MAX_PER_HOST, IDLE_WAIT
+from balancer import RelayBalancer
+from ratelimit import RateLimiter
+import multiprocessing
+import sys
+import threading
+import zlib
+import Queue
+
+
+SHARD_BY_DOMAIN = 'domain'
+SHARD_BY_HASH = 'hash'
+SEND_COMPLETED = 'completed'
+SEND_FAILED = 'failed'
+BATCH_SIZE = 100  # results sent back to the parent at once
+BATCH_INTERVAL = 1.0  # seconds at most between two batches
+
+
+def get_shard_key(message, shard_by):
+    recipient = message['recipient']
+    if not isinstance(recipient, basestring):
+        recipient = recipient[0]
+    if shard_by == SHARD_BY_DOMAIN:
+        # all mail for one domain goes through one process and its
+        # connections
+        return recipient.rpartition('@')[2].lower()
+    return recipient.lower()
+
+
+class ResultBatch():
+    # results of a shard on their way to the parent. They go out when
+    # size of them are together and, from a background thread, every
+    # interval seconds, so a slow campaign is reported (and spooled by the
+    # parent) as it goes.
+
+    def __init__(self, shard, results, size=BATCH_SIZE,
+                 interval=BATCH_INTERVAL):
+        self.shard = shard
+        self.results = results
+        self.size = size
+        self.interval = interval
+        self.items = []
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, item):
+        with self.lock:
+            self.items.append(item)
+            if len(self.items) >= self.size:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.items:
+                self.results.put(('results', self.shard, self.items))
+                self.items = []
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+
+def read_tasks(tasks):
+    # what the parent puts on tasks until None arrives; while the queue is
+    # empty it gives None, so send_many hands out the results it has
+    while True:
+        try:
+            message = tasks.get(timeout=IDLE_WAIT)
+        except Queue.Empty:
+            yield None
+            continue
+        if message is None:
+            return
+        yield message
+
+
+def run_shard(shard, tasks, results, options):
+    # body of a worker process: delivers what the parent puts on tasks
+    # until None arrives and reports back in batches
+    counters = {SEND_COMPLETED: 0, SEND_FAILED: 0}
+    batch = ResultBatch(shard, results)
+    options = dict(options)
+    relays = options.pop('relays')
+    if relays:
+        # every process balances over the relays on its own
+        options['balancer'] = RelayBalancer(relays)
+    rate_limits = options.pop('rate_limits')
+    if rate_limits:
+        # shared with the other processes through its directory
+        options['limiter'] = RateLimiter(**rate_limits)
+    for message, result, error in send_many(read_tasks(tasks), **options):
+        if error is None and is_delivered(result):
+            counters[SEND_COMPLETED] += 1
+            batch.add((message, SEND_COMPLETED, result))
+        elif error is None:
+            # every recipient was rejected, result has their reply codes
+            counters[SEND_FAILED] += 1
+            batch.add((message, SEND_FAILED, result))
+        else:
+            counters[SEND_FAILED] += 1
+            error_name = type(error).__name__
+            counters[error_name] = counters.get(error_name, 0) + 1
+            batch.add((message, SEND_FAILED, error))
+    batch.close()
+    results.put(('done', shard, counters))
+
+
+class ShardedSender():
+    # Spreads a campaign over several processes so that message formatting
+    # and reply parsing are not limited to one CPU. Messages are sharded by
+    # recipient domain (or by recipient hash) and streamed to the processes
+    # through bounded queues, so the parent never holds the whole list.
+    # Every process runs delivery.send_many with its own connections.
+
+    def __init__(self, processes, smtp_host, smtp_port=DEFAULT_PORT,
+                 workers=DEFAULT_WORKERS, max_per_host=MAX_PER_HOST,
+                 shard_by=SHARD_BY_DOMAIN, log_path='',
+                 transport=EmailService.SOCKET_TRANSPORT, relays=None,
+                 rate_limits=None):
+        if shard_by not in (SHARD_BY_DOMAIN, SHARD_BY_HASH):
+            raise ValueError('Unknown shard key: %s' % shard_by)
+        self.processes = processes
+        self.workers = workers
+        self.shard_by = shard_by
+        # rate_limits are the RateLimiter arguments, give it a directory so
+        # that the processes share the limits
+        self.options = {'workers': workers, 'smtp_host': smtp_host,
+                        'smtp_port': smtp_port, 'max_per_host': max_per_host,
+                        'log_path': log_path, 'transport': transport,
+                        'relays': relays, 'rate_limits': rate_limits}
+        self.counters = {}  # shard -> counters reported by its process
+        self.feed_error = None
+
+    def get_shard(self, message):
+        key = get_shard_key(message, self.shard_by)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) % self.processes
+
+    def send(self, messages):
+        # yields (shard, message, status, result or error) as the processes
+        # report them; a failed multi-recipient message comes with its
+        # result. self.counters holds the per-shard totals afterwards
+        tasks = [multiprocessing.Queue(self.workers * 4)
+                 for i in range(self.processes)]
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=run_shard, args=(shard, tasks[shard], results,
+                                    self.options))
+            for shard in range(self.processes)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+        self.counters = {}
+        self.feed_error = None  # set by the feeder, reset before it starts
+        stop = threading.Event()
+        feeder = threading.Thread(target=self.feed,
+                                  args=(messages, tasks, stop))
+        feeder.daemon = True
+        feeder.start()
+
+        try:
+            while len(self.counters) < self.processes:
+                try:
+                    kind, shard, payload = results.get(timeout=1)
+                except Queue.Empty:
+                    for shard, process in enumerate(processes):
+                        if not process.is_alive() and \
+                                shard not in self.counters:
+                            raise Exception('Shard process died', shard,
+                                            process.exitcode)
+                    continue
+                if kind == 'done':
+                    self.counters[shard] = payload
+                    continue
+                for message, status, result in payload:
+                    yield shard, message, status, result
+            if self.feed_error is not None:
+                raise self.feed_error[0], self.feed_error[1], \
+                    self.feed_error[2]
+        finally:
+            stop.set()
+            feeder.join()
+            for process in processes:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+
+    def feed(self, messages, tasks, stop):
+        try:
+            for message in messages:
+                if message is None:
+                    # nothing is ready yet, see delivery.send_many
+                    if stop.wait(IDLE_WAIT):
+                        return
+                    continue
+                queue = tasks[self.get_shard(message)]
+                while not stop.is_set():
+                    try:
+                        queue.put(message, timeout=1)
+                        break
+                    except Queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+        except Exception:
+            # reading the input failed, finish what was already queued
+            self.feed_error = sys.exc_info()
+        finally:
+            # a shard that died does not take its None, do not wait for it
+            # forever when its queue is full
+            for queue in tasks:
+                while not stop.is_set():
+                    try:
+                        queue.put(None, timeout=1)
+                        break
+                    except Queue.Full:
+                        continue
+
+    def totals(self):
+        totals = {}
+        for counters in self.counters.values():
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
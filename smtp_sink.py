@@ -0,0 +1,499 @@
+# Local SMTP server that accepts mail and keeps it in memory, writes it to a
+# maildir or just counts it. Latency and error replies can be injected per
+# command, which makes it a stand-in relay for tests and load tests:
+#     python smtp_sink.py --port 2525 --code RCPT=451:0.1 --maildir mail
+from optparse import OptionParser
+import errno
+import heapq
+import multiprocessing
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+
+MEMORY = 'memory'
+EXTENSIONS = ('PIPELINING', 'SIZE 104857600', '8BITMIME', 'CHUNKING')
+# verbs that latency and codes can name; CONNECT is the greeting and BODY
+# the reply after the message data
+VERBS = ('CONNECT', 'EHLO', 'HELO', 'MAIL', 'RCPT', 'DATA', 'BODY', 'BDAT',
+         'RSET', 'NOOP', 'QUIT')
+END_OF_DATA = '\r\n.\r\n'
+RECV_SIZE = 262144
+POLL_INTERVAL = 0.05  # seconds between checks for stop()
+
+if hasattr(select, 'epoll'):
+    POLL_IN, POLL_OUT = select.EPOLLIN, select.EPOLLOUT
+else:
+    POLL_IN, POLL_OUT = select.POLLIN, select.POLLOUT
+
+
+class Poller():
+    # select.epoll where there is one, select.poll elsewhere
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.scale = 1
+        else:
+            self.poller = select.poll()
+            self.scale = 1000  # poll() takes milliseconds
+        self.register = self.poller.register
+        self.modify = self.poller.modify
+        self.unregister = self.poller.unregister
+
+    def poll(self, timeout):
+        try:
+            return self.poller.poll(timeout * self.scale)
+        except (IOError, select.error), opt:
+            if opt.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self.poller, 'close'):
+            self.poller.close()
+
+
+class SinkSession():
+    # one client connection: parses commands out of the input buffer and
+    # queues replies; a reply with latency pauses the session until it is
+    # sent, so replies never overtake each other
+
+    def __init__(self, sink, sock):
+        self.sink = sink
+        self.sock = sock
+        self.input = ''
+        self.output = ''
+        self.paused = False
+        self.closing = False  # close once the output is written
+        self.state = self.read_command
+        self.reset()
+
+    def reset(self):
+        self.sender = None
+        self.recipients = []
+        self.parts = []
+        self.remaining = 0  # bytes of the current BDAT chunk
+        self.last = False  # the current BDAT chunk is the last one
+
+    def reply(self, verb, code, text, lines=''):
+        # code is the normal reply, lines go before it when it is sent as is;
+        # an injected code replaces both
+        injected = self.sink.get_code(verb, code)
+        if injected == code:
+            text = lines + '%s %s\r\n' % (code, text)
+        elif injected == '421':
+            text = '421 closing connection\r\n'
+            self.closing = True
+        else:
+            text = '%s injected error\r\n' % injected
+        delay = self.sink.get_latency(verb)
+        if delay:
+            self.paused = True
+            self.sink.schedule(time.time() + delay, self, text)
+        else:
+            self.output += text
+        return injected
+
+    def resume(self, line):
+        self.output += line
+        self.paused = False
+        self.process()
+
+    def process(self):
+        while not self.paused and not self.closing and self.state():
+            pass
+        self.sink.flush(self)
+
+    def read_command(self):
+        end = self.input.find('\n')
+        if end < 0:
+            return False
+        line = self.input[:end].rstrip('\r')
+        self.input = self.input[end + 1:]
+        verb = line[:4].upper()
+        handler = getattr(self, 'on_' + verb.lower(), None)
+        if handler is None or verb not in VERBS:
+            self.output += '502 command not implemented\r\n'
+        else:
+            handler(line)
+        return True
+
+    def on_ehlo(self, line):
+        self.reset()
+        self.reply('EHLO', '250', 'ok', ''.join(
+            '250-%s\r\n' % extension for extension in
+            (self.sink.hostname,) + self.sink.extensions))
+
+    def on_helo(self, line):
+        self.reset()
+        self.reply('HELO', '250', self.sink.hostname)
+
+    def get_address(self, line):
+        address = line.split(':', 1)[1].strip() if ':' in line else ''
+        if address.startswith('<'):
+            address = address[1:].split('>', 1)[0]
+        else:
+            address = address.split(' ', 1)[0]
+        return address
+
+    def on_mail(self, line):
+        if self.sender is not None:
+            self.output += '503 nested MAIL command\r\n'
+            return
+        if self.reply('MAIL', '250', 'sender ok') == '250':
+            self.sender = self.get_address(line)
+
+    def on_rcpt(self, line):
+        if self.sender is None:
+            self.output += '503 need MAIL before RCPT\r\n'
+            return
+        # an injected 251 (will forward) accepts the recipient as well
+        if self.reply('RCPT', '250', 'recipient ok') in ('250', '251'):
+            self.recipients.append(self.get_address(line))
+
+    def on_data(self, line):
+        if not self.recipients:
+            self.output += '554 no valid recipients\r\n'
+            return
+        if self.reply('DATA', '354', 'end data with <CR><LF>.<CR><LF>') \
+                == '354':
+            # the body may end right away with '.\r\n'
+            self.input = '\r\n' + self.input
+            self.state = self.read_data
+
+    def read_data(self):
+        end = self.input.find(END_OF_DATA)
+        if end < 0:
+            # keep what could be the start of the end marker
+            keep = len(END_OF_DATA) - 1
+            if len(self.input) > keep:
+                if self.sink.capture is not None:
+                    self.parts.append(self.input[:-keep])
+                self.input = self.input[-keep:]
+            return False
+        data = None
+        if self.sink.capture is not None:
+            self.parts.append(self.input[:end + 2])
+            data = ''.join(self.parts).replace('\r\n..', '\r\n.')[2:]
+        self.input = self.input[end + len(END_OF_DATA):]
+        self.state = self.read_command
+        self.finish_message(data, 'BODY')
+        return True
+
+    def on_bdat(self, line):
+        words = line.split()
+        if len(words) < 2 or not words[1].isdigit():
+            self.output += '501 syntax: BDAT size [LAST]\r\n'
+            return
+        self.remaining = int(words[1])
+        self.last = len(words) > 2 and words[2].upper() == 'LAST'
+        self.state = self.read_chunk
+
+    def read_chunk(self):
+        if self.remaining:
+            if not self.input:
+                return False
+            chunk = self.input[:self.remaining]
+            self.input = self.input[len(chunk):]
+            self.remaining -= len(chunk)
+            if self.sink.capture is not None:
+                self.parts.append(chunk)
+            if self.remaining:
+                return False
+        self.state = self.read_command
+        if not self.recipients:
+            self.output += '554 no valid recipients\r\n'
+            self.parts = []
+        elif self.last:
+            self.finish_message(''.join(self.parts), 'BDAT')
+        elif self.reply('BDAT', '250', 'chunk ok') != '250':
+            self.reset()
+        return True
+
+    def finish_message(self, data, verb):
+        if self.reply(verb, '250', 'message accepted') == '250':
+            self.sink.deliver(self.sender, self.recipients, data)
+        self.reset()
+
+    def on_rset(self, line):
+        self.reset()
+        self.reply('RSET', '250', 'ok')
+
+    def on_noop(self, line):
+        self.reply('NOOP', '250', 'ok')
+
+    def on_quit(self, line):
+        if self.reply('QUIT', '221', 'bye') == '221':
+            self.closing = True
+
+
+class SmtpSink():
+    # Event loop SMTP server (epoll where available) that serves any number
+    # of connections from one thread. latency is seconds before every reply
+    # or {verb: seconds}; codes is {verb: code} or {verb: (code, rate)} to
+    # answer a share of the commands with that code instead (421 also
+    # closes the connection). capture is None to only count messages,
+    # MEMORY to keep them in messages or the path of a maildir. For more
+    # throughput start_processes() runs several loops on the same socket.
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None, codes=None,
+                 capture=None, extensions=EXTENSIONS, seed=None):
+        self.latency = latency or 0
+        self.codes = {}
+        for verb, code in (codes or {}).items():
+            if verb.upper() not in VERBS:
+                raise ValueError('Unknown SMTP verb: %s' % verb)
+            if isinstance(code, basestring):
+                code = (code, 1.0)
+            self.codes[verb.upper()] = (str(code[0]), float(code[1]))
+        self.capture = capture
+        self.extensions = tuple(extensions)
+        self.hostname = socket.gethostname()
+        self.random = random.Random(seed)
+        self.messages = []  # (sender, recipients, data) with MEMORY
+        self.count = 0  # messages accepted by this process
+        self.received = multiprocessing.Value('L', 0)  # by all processes
+        self.timers = []  # (due, sequence, session, reply line)
+        self.sequence = 0
+        self.sessions = {}  # file descriptor -> SinkSession
+        self.stopped = threading.Event()
+        self.thread = None
+        self.processes = []
+        if capture not in (None, MEMORY):
+            for name in ('tmp', 'new', 'cur'):
+                if not os.path.isdir(os.path.join(capture, name)):
+                    os.makedirs(os.path.join(capture, name))
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1024)
+        self.listener.setblocking(False)
+        self.host, self.port = self.listener.getsockname()[:2]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    # what the sessions ask for
+
+    def get_code(self, verb, code):
+        injected = self.codes.get(verb)
+        if injected is not None and (injected[1] >= 1.0 or
+                                     self.random.random() < injected[1]):
+            return injected[0]
+        return code
+
+    def get_latency(self, verb):
+        if isinstance(self.latency, dict):
+            return self.latency.get(verb, 0)
+        return self.latency
+
+    def schedule(self, due, session, line):
+        self.sequence += 1
+        heapq.heappush(self.timers, (due, self.sequence, session, line))
+
+    def deliver(self, sender, recipients, data):
+        self.count += 1
+        with self.received.get_lock():
+            self.received.value += 1
+        if self.capture == MEMORY:
+            self.messages.append((sender, list(recipients), data))
+        elif self.capture is not None:
+            self.write_maildir(sender, data)
+
+    def write_maildir(self, sender, data):
+        # write to tmp and move to new, so readers never see half a message
+        name = '%.6f.%d_%d.%s' % (time.time(), os.getpid(), self.count,
+                                  self.hostname)
+        tmp_path = os.path.join(self.capture, 'tmp', name)
+        message = open(tmp_path, 'wb')
+        try:
+            message.write('Return-Path: <%s>\r\n' % sender)
+            message.write(data)
+        finally:
+            message.close()
+        os.rename(tmp_path, os.path.join(self.capture, 'new', name))
+
+    # event loop
+
+    def serve_forever(self):
+        self.poller = Poller()
+        self.poller.register(self.listener.fileno(), POLL_IN)
+        try:
+            while not self.stopped.is_set():
+                timeout = POLL_INTERVAL
+                if self.timers:
+                    timeout = max(0, min(timeout,
+                                         self.timers[0][0] - time.time()))
+                for fd, event in self.poller.poll(timeout):
+                    if fd == self.listener.fileno():
+                        self.accept()
+                        continue
+                    session = self.sessions.get(fd)
+                    if session is None:
+                        continue
+                    if event & POLL_IN:
+                        self.read(session)
+                    elif event & POLL_OUT:
+                        self.flush(session)
+                    else:
+                        self.close_session(session)
+                now = time.time()
+                while self.timers and self.timers[0][0] <= now:
+                    session, line = heapq.heappop(self.timers)[2:]
+                    if session.sock is not None:
+                        session.resume(line)
+        finally:
+            for session in self.sessions.values():
+                self.close_session(session)
+            self.poller.close()
+
+    def accept(self):
+        while True:
+            try:
+                sock = self.listener.accept()[0]
+            except socket.error, opt:
+                if opt.errno in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.ECONNABORTED):
+                    return
+                raise
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = SinkSession(self, sock)
+            self.sessions[sock.fileno()] = session
+            self.poller.register(sock.fileno(), POLL_IN)
+            session.reply('CONNECT', '220', self.hostname + ' ESMTP sink')
+            self.flush(session)
+
+    def read(self, session):
+        try:
+            data = session.sock.recv(RECV_SIZE)
+        except socket.error, opt:
+            if opt.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            self.close_session(session)
+            return
+        session.input += data
+        session.process()
+
+    def flush(self, session):
+        if session.sock is None:
+            return
+        if session.output:
+            try:
+                sent = session.sock.send(session.output)
+            except socket.error, opt:
+                if opt.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.close_session(session)
+                    return
+                sent = 0
+            session.output = session.output[sent:]
+        if session.output:
+            self.poller.modify(session.sock.fileno(), POLL_IN | POLL_OUT)
+        elif session.closing and not session.paused:
+            self.close_session(session)
+        else:
+            self.poller.modify(session.sock.fileno(), POLL_IN)
+
+    def close_session(self, session):
+        if session.sock is None:
+            return
+        fd = session.sock.fileno()
+        self.sessions.pop(fd, None)
+        try:
+            self.poller.unregister(fd)
+        except (IOError, KeyError, ValueError):
+            pass
+        session.sock.close()
+        session.sock = None
+
+    # running it
+
+    def start(self):
+        # serve from a background thread of this process
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def start_processes(self, processes):
+        # serve from several processes sharing the listening socket;
+        # captured messages are not shared, so MEMORY cannot be used
+        if self.capture == MEMORY:
+            raise ValueError('Memory capture needs a single process')
+        for i in range(processes):
+            process = multiprocessing.Process(target=self.serve_forever)
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = []
+        self.listener.close()
+
+
+def parse_codes(values):
+    # VERB=CODE or VERB=CODE:RATE
+    codes = {}
+    for value in values:
+        verb, code = value.split('=', 1)
+        code, rate = (code.split(':', 1) + ['1'])[:2]
+        codes[verb.upper()] = (code, float(rate))
+    return codes
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=2525)
+    parser.add_option('--processes', type='int', default=1)
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds before every reply')
+    parser.add_option('--code', dest='codes', action='append', default=[],
+                      help='VERB=CODE[:RATE] to answer VERB with CODE, '
+                      'e.g. RCPT=451:0.1')
+    parser.add_option('--maildir', help='write the messages to a maildir')
+    parser.add_option('--seed', type='int')
+    options, args = parser.parse_args()
+    sink = SmtpSink(options.host, options.port, options.latency,
+                    parse_codes(options.codes), options.maildir,
+                    seed=options.seed)
+    print 'Listening on %s:%d' % (sink.host, sink.port)
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if options.processes > 1:
+            sink.start_processes(options.processes)
+            while True:
+                time.sleep(1)
+        else:
+            sink.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        received = sink.received.value
+        sink.stop()
+        print 'Received %d messages' % received
+
+
+if __name__ == '__main__':
+    main()
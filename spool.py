@@ -0,0 +1,234 @@
+from delivery import is_delivered
+from codec import encode_utf8
+from collections import OrderedDict, deque
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+
+ENQUEUE = 'enqueue'
+DONE = 'done'
+SEND_COMPLETED = 'completed'
+SEND_FAILED = 'failed'
+
+
+class Spool():
+    # Crash-safe message queue backed by an append-only journal. Every
+    # enqueued message and every delivery outcome is one JSON line; the
+    # journal is fsynced after sync_every records or sync_interval seconds,
+    # whichever comes first, so producers are not slowed down by one fsync
+    # per message. On start the journal is replayed and only messages
+    # without an outcome are delivered again. Only the journal offsets of
+    # pending messages are kept in memory, a message is read back from the
+    # journal when it is handed out.
+    SYNC_EVERY = 100
+    SYNC_INTERVAL = 1.0  # seconds
+    COMPACT_AFTER = 10000  # outcomes kept before the journal is rewritten
+
+    def __init__(self, path, sync_every=SYNC_EVERY,
+                 sync_interval=SYNC_INTERVAL, compact_after=COMPACT_AFTER):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+        self.lock = threading.RLock()
+        # take() waits on it while a feeder may still enqueue
+        self.changed = threading.Condition(self.lock)
+        # id -> journal offset of the message without outcome
+        self.pending = OrderedDict()
+        self.ready = deque()  # ids not handed to a sender yet
+        self.next_id = 0
+        self.finished = 0  # outcomes in the journal
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.feeder = None  # thread that runs feed()
+        self.feed_error = None
+        self.stopped = False
+        self.recover()
+        self.open_journal()
+
+    def open_journal(self):
+        self.journal = open(self.path, 'ab')
+        self.reader = open(self.path, 'rb')
+        self.size = os.path.getsize(self.path)  # bytes written
+        self.synced = self.size  # bytes known to be on disk
+
+    def recover(self):
+        if not os.path.exists(self.path):
+            return
+        journal = open(self.path, 'rb')
+        good = 0  # end of the last complete record
+        try:
+            for line in journal:
+                if not line.endswith('\n'):
+                    # the last line was cut short by a crash
+                    logging.warning(u'Dropping broken spool record: %r'
+                                    % line)
+                    break
+                record = json.loads(line)
+                self.next_id = max(self.next_id, record['id'] + 1)
+                if record['op'] == ENQUEUE:
+                    self.pending[record['id']] = good
+                elif record['op'] == DONE:
+                    self.pending.pop(record['id'], None)
+                    self.finished += 1
+                good += len(line)
+        finally:
+            journal.close()
+        if good < os.path.getsize(self.path):
+            journal = open(self.path, 'r+b')
+            try:
+                journal.truncate(good)
+            finally:
+                journal.close()
+        self.ready.extend(self.pending)
+
+    def write(self, record):
+        # returns the journal offset of the record
+        offset = self.size
+        line = json.dumps(record) + '\n'
+        self.journal.write(line)
+        self.size += len(line)
+        self.unsynced += 1
+        if (self.unsynced >= self.sync_every or
+                time.time() - self.last_sync >= self.sync_interval):
+            self.sync()
+        return offset
+
+    def sync(self):
+        with self.lock:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.synced = self.size
+            self.unsynced = 0
+            self.last_sync = time.time()
+
+    def read_message(self, offset):
+        # the message of the ENQUEUE record at offset
+        if offset >= self.synced:
+            # nothing goes out before it is on disk
+            self.sync()
+        self.reader.seek(offset)
+        # JSON gives unicode back, the message goes out as it was given
+        return encode_utf8(json.loads(self.reader.readline())['message'])
+
+    def enqueue(self, message):
+        with self.lock:
+            message_id = self.next_id
+            self.next_id += 1
+            self.pending[message_id] = self.write(
+                {'op': ENQUEUE, 'id': message_id, 'message': message})
+            self.ready.append(message_id)
+            self.changed.notify_all()
+            return message_id
+
+    def feed(self, messages):
+        # enqueues messages in a background thread while take() hands them
+        # out; take() waits for the feeder and raises what it failed with
+        def run():
+            try:
+                for message in messages:
+                    if self.stopped:
+                        return
+                    self.enqueue(message)
+            except Exception:
+                self.feed_error = sys.exc_info()
+            finally:
+                with self.lock:
+                    self.feeder = None
+                    self.changed.notify_all()
+
+        with self.lock:
+            self.feeder = threading.Thread(target=run)
+            self.feeder.daemon = True
+            self.feeder.start()
+
+    def mark(self, message_id, status, error=None):
+        record = {'op': DONE, 'id': message_id, 'status': status}
+        if error is not None:
+            record['error'] = error
+        with self.lock:
+            self.write(record)
+            self.pending.pop(message_id, None)
+            self.finished += 1
+            if (self.finished >= self.compact_after and
+                    self.finished > len(self.pending)):
+                self.compact()
+
+    def take(self):
+        # yields pending messages (with their spool_id) that were not handed
+        # out yet, including ones enqueued while iterating and, while a
+        # feeder runs, the ones it is still to enqueue
+        while True:
+            with self.lock:
+                while not self.ready and self.feeder is not None:
+                    self.changed.wait()
+                if not self.ready:
+                    break
+                message_id = self.ready.popleft()
+                offset = self.pending.get(message_id)
+                if offset is None:
+                    continue
+                message = self.read_message(offset)
+            message['spool_id'] = message_id
+            yield message
+        if self.feed_error is not None:
+            error, self.feed_error = self.feed_error, None
+            raise error[0], error[1], error[2]
+
+    def track(self, outcomes):
+        # records the (message, result, error) outcomes of a sender such as
+        # delivery.send_many and passes them on; a message no recipient
+        # accepted counts as failed
+        try:
+            for message, result, error in outcomes:
+                if error is None and is_delivered(result):
+                    self.mark(message['spool_id'], SEND_COMPLETED)
+                elif error is None:
+                    self.mark(message['spool_id'], SEND_FAILED)
+                else:
+                    self.mark(message['spool_id'], SEND_FAILED,
+                              type(error).__name__)
+                yield message, result, error
+        finally:
+            self.sync()
+
+    def compact(self):
+        # rewrite the journal with the pending messages only
+        with self.lock:
+            compact_path = self.path + '.compact'
+            journal = open(compact_path, 'wb')
+            pending = OrderedDict()
+            try:
+                self.sync()
+                for message_id, offset in self.pending.iteritems():
+                    # the ENQUEUE records are copied as they are
+                    pending[message_id] = journal.tell()
+                    self.reader.seek(offset)
+                    journal.write(self.reader.readline())
+                journal.flush()
+                os.fsync(journal.fileno())
+            finally:
+                journal.close()
+            self.journal.close()
+            self.reader.close()
+            os.rename(compact_path, self.path)
+            self.pending = pending
+            self.open_journal()
+            self.finished = 0
+            self.unsynced = 0
+            self.last_sync = time.time()
+
+    def close(self):
+        with self.lock:
+            self.stopped = True
+            feeder = self.feeder
+        if feeder is not None:
+            feeder.join()
+        with self.lock:
+            self.sync()
+            self.journal.close()
+            self.reader.close()
@@ -0,0 +1,51 @@
+import re
+import string
+
+
+class Template():
+    # Mail-merge template in str.format syntax ('Hello {name}'), parsed once.
+    # The static text is kept as a list of segments with a placeholder for
+    # every field; rendering copies that list (references only, not the
+    # text), fills in the fields from a row dict and joins it once.
+    FIELD = None  # placeholder for a field in segments
+    NAME_REGEXP = re.compile('[^.[]*')
+
+    def __init__(self, text):
+        self.text = text
+        self.segments = []
+        self.fields = []  # (index in segments, name, format string or None)
+        for literal, name, spec, conversion in \
+                string.Formatter().parse(text):
+            if literal:
+                self.segments.append(literal)
+            if name is None:
+                continue
+            if not name or name[0].isdigit():
+                raise ValueError('Template fields must be named: %r' % text)
+            format_string = None
+            base = self.NAME_REGEXP.match(name).group(0)
+            if spec or conversion or base != name:
+                # attribute or index lookups, conversions and format specs
+                # are rare, leave them to str.format
+                format_string = '{0%s%s%s}' % (
+                    name[len(base):], '!' + conversion if conversion else '',
+                    ':' + spec if spec else '')
+                name = base
+            self.fields.append((len(self.segments), name, format_string))
+            self.segments.append(self.FIELD)
+
+    def render(self, row):
+        parts = self.segments[:]
+        for index, name, format_string in self.fields:
+            try:
+                value = row[name]
+            except KeyError:
+                raise ValueError('Template field is missing: %s' % name)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            if format_string is not None:
+                value = format_string.format(value)
+            elif not isinstance(value, str):
+                value = str(value)
+            parts[index] = value
+        return ''.join(parts)
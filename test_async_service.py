@@ -0,0 +1,115 @@
+import asyncore
+import socket
+from unittest import TestCase
+from exception import ConnectionRefusedException, NotAvailableException,\
+    RequestedActionAbortedException, SyntaxErrorException, TimeoutException
+from async_service import AsyncEmailService, send_all
+from sending_service import EmailService
+from smtp_sink import MEMORY, SmtpSink
+
+
+class TestAsyncEmailService(TestCase):
+    # AsyncEmailService against a sink in a background thread
+
+    def start(self, **kwargs):
+        kwargs.setdefault('capture', MEMORY)
+        sink = SmtpSink(**kwargs).start()
+        self.addCleanup(sink.stop)
+        return sink
+
+    def get_messages(self, count):
+        return [{'sender': 'from@example.com',
+                 'recipient': 'user%d@example.com' % i,
+                 'subject': 'hi', 'msg': 'line\n.dot line'}
+                for i in range(count)]
+
+    def send(self, port, messages):
+        # messages over one session; [(result, error)] in message order
+        socket_map = {}
+        results = {}
+        con = AsyncEmailService('127.0.0.1', port, map=socket_map,
+                                timeout=5)
+        for i, message in enumerate(messages):
+            def callback(result, error, i=i):
+                results[i] = (result, error)
+            con.send_email(message['sender'], message['recipient'],
+                           message['subject'], message['msg'], callback)
+        con.quit()
+        asyncore.loop(timeout=1, use_poll=True, map=socket_map)
+        return [results[i] for i in range(len(messages))]
+
+    def test_send_all(self):
+        sink = self.start()
+        results = send_all(self.get_messages(5), '127.0.0.1', sink.port,
+                           connections=2)
+        self.assertEqual(sorted(message['recipient'] for message, result,
+                                error in results),
+                         ['user%d@example.com' % i for i in range(5)])
+        self.assertEqual(set((result, error) for message, result, error
+                             in results),
+                         set([(EmailService.SEND_COMPLETED, None)]))
+        self.assertEqual(len(sink.messages), 5)
+        self.assertEqual(sink.messages[0][2],
+                         'Subject:hi\r\nline\r\n.dot line\r\n')
+
+    def test_many_recipients(self):
+        sink = self.start()
+        result, error = self.send(sink.port, [{
+            'sender': 'from@example.com', 'subject': 'hi', 'msg': 'x',
+            'recipient': ['a@example.com', 'b@example.com']}])[0]
+        self.assertEqual(error, None)
+        self.assertEqual(result, {'a@example.com': EmailService.COMPLETED,
+                                  'b@example.com': EmailService.COMPLETED})
+        self.assertEqual(sink.messages[0][1], ['a@example.com',
+                                               'b@example.com'])
+
+    def test_rcpt_request_aborted(self):
+        sink = self.start(codes={'RCPT': '451'})
+        results = self.send(sink.port, self.get_messages(2))
+        self.assertEqual([type(error) for result, error in results],
+                         [RequestedActionAbortedException] * 2)
+        self.assertEqual(sink.received.value, 0)
+
+    def test_rcpt_will_forward(self):
+        sink = self.start(codes={'RCPT': '251'})
+        results = self.send(sink.port, self.get_messages(1))
+        self.assertEqual(results, [(EmailService.SEND_COMPLETED, None)])
+        self.assertEqual(sink.received.value, 1)
+
+    def test_reset_between_messages(self):
+        # the refused transaction is reset before the next one, a failing
+        # RSET shows it was sent
+        sink = self.start(codes={'RCPT': '451', 'RSET': '500'})
+        results = self.send(sink.port, self.get_messages(2))
+        self.assertTrue(isinstance(results[0][1],
+                                   RequestedActionAbortedException))
+        self.assertTrue(isinstance(results[1][1], SyntaxErrorException))
+
+    def test_mail_service_not_available(self):
+        sink = self.start(codes={'MAIL': '421'})
+        results = self.send(sink.port, self.get_messages(2))
+        self.assertEqual([type(error) for result, error in results],
+                         [NotAvailableException] * 2)
+
+    def test_greeting_service_not_available(self):
+        sink = self.start(codes={'CONNECT': '421'})
+        results = self.send(sink.port, self.get_messages(2))
+        self.assertEqual([type(error) for result, error in results],
+                         [NotAvailableException] * 2)
+
+    def test_connection_refused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        results = send_all(self.get_messages(2), '127.0.0.1', port,
+                           connections=1)
+        self.assertEqual([type(error) for message, result, error in results],
+                         [ConnectionRefusedException] * 2)
+
+    def test_timeout(self):
+        sink = self.start(latency={'MAIL': 2})
+        results = send_all(self.get_messages(2), '127.0.0.1', sink.port,
+                           connections=1, timeout=0.2)
+        self.assertEqual([type(error) for message, result, error in results],
+                         [TimeoutException] * 2)
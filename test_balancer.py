@@ -0,0 +1,109 @@
+import socket
+from unittest import TestCase
+from exception import ConnectionRefusedException, NotAvailableException,\
+    SyntaxErrorException, TimeoutException
+from balancer import RelayBalancer, parse_relays
+from delivery import send_many
+from smtp_sink import MEMORY, SmtpSink
+
+
+class TestRelayBalancer(TestCase):
+
+    def test_parse_relays(self):
+        self.assertEqual(parse_relays('mx1.example.com, mx2:2525,', 25),
+                         [('mx1.example.com', 25), ('mx2', 2525)])
+
+    def test_prefers_fast_relay(self):
+        fast, slow = ('fast', 25), ('slow', 25)
+        balancer = RelayBalancer([fast, slow])
+        for i in range(5):
+            balancer.started(fast)
+            balancer.finished(fast, 0.01)
+            balancer.started(slow)
+            balancer.finished(slow, 0.5)
+        self.assertEqual(balancer.choose(), fast)
+        # busy enough, the fast one loses to the slow one
+        for i in range(60):
+            balancer.started(fast)
+        self.assertEqual(balancer.choose(), slow)
+
+    def test_failover(self):
+        balancer = RelayBalancer([('a', 25), ('b', 25)])
+        calls = []
+
+        def send(host, port):
+            calls.append(host)
+            if len(calls) == 1:
+                raise ConnectionRefusedException
+            return 'completed'
+
+        self.assertEqual(balancer.call(send), 'completed')
+        self.assertEqual(len(calls), 2)
+        self.assertNotEqual(calls[0], calls[1])
+        # the refusing relay is not chosen again while it cools down
+        self.assertEqual(balancer.choose(), (calls[1], 25))
+        self.assertTrue(balancer.get_summary()['%s:25' % calls[0]]['down'])
+
+    def test_avoids_failing_relay(self):
+        # timeouts do not fail over, the relay still has to lose its turn
+        balancer = RelayBalancer([('bad', 25), ('good', 25)])
+        calls = []
+
+        def send(host, port):
+            calls.append(host)
+            if host == 'bad':
+                raise TimeoutException
+            return 'completed'
+
+        for i in range(200):
+            try:
+                balancer.call(send)
+            except TimeoutException:
+                pass
+        self.assertTrue(calls.count('bad') <= 1)
+        self.assertEqual(balancer.choose(), ('good', 25))
+
+    def test_all_relays_fail(self):
+        balancer = RelayBalancer([('a', 25), ('b', 25)])
+
+        def send(host, port):
+            raise NotAvailableException(host)
+
+        self.assertRaises(NotAvailableException, balancer.call, send)
+
+    def test_message_errors_do_not_fail_over(self):
+        balancer = RelayBalancer([('a', 25), ('b', 25)])
+        calls = []
+
+        def send(host, port):
+            calls.append(host)
+            raise SyntaxErrorException
+
+        self.assertRaises(SyntaxErrorException, balancer.call, send)
+        self.assertEqual(len(calls), 1)
+
+
+class TestBalancedDelivery(TestCase):
+
+    def get_closed_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def test_send_many_fails_over(self):
+        sink = SmtpSink(capture=MEMORY).start()
+        self.addCleanup(sink.stop)
+        busy = SmtpSink(codes={'CONNECT': '421'}).start()
+        self.addCleanup(busy.stop)
+        balancer = RelayBalancer([('127.0.0.1', self.get_closed_port()),
+                                  ('127.0.0.1', busy.port),
+                                  ('127.0.0.1', sink.port)])
+        messages = [{'sender': 'from@example.com',
+                     'recipient': 'user%d@example.com' % i,
+                     'subject': 'hi', 'msg': 'x'} for i in range(10)]
+        errors = [error for message, result, error in
+                  send_many(messages, 2, balancer=balancer)]
+        self.assertEqual(errors, [None] * 10)
+        self.assertEqual(len(sink.messages), 10)
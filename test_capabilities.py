@@ -0,0 +1,28 @@
+from unittest import TestCase
+from capabilities import CapabilityCache, get_size
+
+
+class TestCapabilityCache(TestCase):
+
+    def test_parsed_once_while_fresh(self):
+        cache = CapabilityCache(ttl=60)
+        key = ('localhost', 25)
+        lines = ['mail.example.com', 'SIZE 35882577', 'PIPELINING',
+                 '8BITMIME', 'CHUNKING', 'STARTTLS']
+        extensions = cache.get_extensions(key, lines)
+        self.assertEqual(extensions, {'SIZE': '35882577', 'PIPELINING': '',
+                                      '8BITMIME': '', 'CHUNKING': '',
+                                      'STARTTLS': ''})
+        self.assertEqual(get_size(extensions), 35882577)
+        self.assertTrue(cache.get_extensions(key, list(lines)) is extensions)
+        # a changed reply is parsed again
+        self.assertEqual(cache.get_extensions(key, lines[:2]),
+                         {'SIZE': '35882577'})
+
+    def test_expired_entry(self):
+        cache = CapabilityCache(ttl=-1)
+        key = ('localhost', 25)
+        extensions = cache.get_extensions(key, ['mail.example.com', 'SIZE'])
+        self.assertEqual(get_size(extensions), None)
+        self.assertFalse(cache.get_extensions(key, ['mail.example.com',
+                                                    'SIZE']) is extensions)
@@ -0,0 +1,33 @@
+from unittest import TestCase
+from codec import DataEncoder, encode_data
+
+
+class TestDataEncoder(TestCase):
+
+    def encode_chunks(self, chunks, linesep='\r\n'):
+        encoder = DataEncoder(linesep)
+        return ''.join(encoder.encode(chunk) for chunk in chunks) + \
+            encoder.finish()
+
+    def test_dot_stuffing_and_line_endings(self):
+        msg = '.first\nsecond\r\n..third\rfourth\n.'
+        self.assertEqual(encode_data(msg),
+                         '..first\r\nsecond\r\n...third\r\nfourth\r\n..\r\n'
+                         '.\r\n')
+        self.assertEqual(encode_data(msg, '\n'),
+                         '..first\nsecond\n...third\nfourth\n..\n.\n')
+        self.assertEqual(encode_data(''), '.\r\n')
+        self.assertEqual(encode_data('text\r\n'), 'text\r\n.\r\n')
+
+    def test_same_result_for_any_chunk_boundary(self):
+        msg = 'a\r\n.b\r\r\n.\n\n.c.\rd\r'
+        expected = encode_data(msg)
+        for first in range(len(msg) + 1):
+            for second in range(first, len(msg) + 1):
+                chunks = [msg[:first], msg[first:second], msg[second:]]
+                self.assertEqual(self.encode_chunks(chunks), expected)
+
+    def test_line_endings_only(self):
+        encoder = DataEncoder(dot_stuffing=False)
+        self.assertEqual(encoder.encode('.a\nb\r') + encoder.encode('\n.c\r') +
+                         encoder.flush(), '.a\r\nb\r\n.c\r\n')
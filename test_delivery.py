@@ -0,0 +1,44 @@
+from unittest import TestCase
+from shared.testing.vmock.mockcontrol import MockControl
+from exception import RequestedActionAbortedException
+from pool import ConnectionPool
+from delivery import send_many
+
+
+class TestSendMany(TestCase):
+    COMPLETED = 'completed'
+
+    def setUp(self):
+        self.mc = MockControl()
+
+    def tearDown(self):
+        self.mc.tear_down()
+
+    def test_send_many(self):
+        first = {'sender': 'lenok@gmail.com', 'recipient': 'vovaxo@gmail.com',
+                 'subject': 'test letter', 'msg': 'some text'}
+        second = {'sender': 'lenok@gmail.com', 'recipient': 'nobody@gmail.com',
+                  'subject': 'test letter', 'msg': 'some text',
+                  'smtp_host': 'relay', 'smtp_port': 2525}
+        smtp_host = 'localhost'
+        smtp_port = 25
+        error = RequestedActionAbortedException()
+
+        pool_mock = self.mc.mock_class(ConnectionPool)
+
+        pool_mock.send_message(smtp_host, smtp_port, 'lenok@gmail.com',
+                               'vovaxo@gmail.com', 'test letter',
+                               'some text').returns(self.COMPLETED)
+        pool_mock.send_message('relay', 2525, 'lenok@gmail.com',
+                               'nobody@gmail.com', 'test letter',
+                               'some text').raises(error)
+
+        self.mc.replay()
+
+        results = list(send_many([first, second], workers=1,
+                                 smtp_host=smtp_host, smtp_port=smtp_port,
+                                 pool=pool_mock))
+        self.assertEqual([(first, self.COMPLETED, None),
+                          (second, None, error)], results)
+
+        self.mc.verify()
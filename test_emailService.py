@@ -3,8 +3,11 @@ from shared.testing.vmock.mockcontrol import MockControl
 import pexpect
 from exception import ConnectionRefusedException, NotAvailableException,\
     UnknownServiceException, RequestedActionAbortedException, \
-    TerminationConnectionException, SyntaxErrorException
+    TerminationConnectionException, SyntaxErrorException, TimeoutException
 from sending_service import EmailService
+from transport import SocketTransport
+from StringIO import StringIO
+import transport
 
 
 class TestEmailService(TestCase):
@@ -41,6 +44,7 @@ class TestEmailService(TestCase):
         spawn_ctor_mock = self.mc.mock_constructor(pexpect, 'spawn')
         mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
                                         'get_expect_smtp_reply_code')
+        mock_ehlo = self.mc.mock_method(EmailService, 'ehlo')
         spawn_ctor_mock(COMMAND).returns(spawn_mock)
 
         spawn_mock.expect([self.CONNECTION_REFUSED, self.CONNECT_TO,
@@ -49,10 +53,11 @@ class TestEmailService(TestCase):
         spawn_mock.expect([self.COMMAND_CODE_REGEXP, pexpect.EOF,
                            pexpect.TIMEOUT]).returns(0)
         mock_get_expect_smtp_reply_code(spawn_mock).returns(self.SERVICE_READY)
+        mock_ehlo(spawn_mock).returns({})
 
         self.mc.replay()
 
-        EmailService(smtp_host, smtp_port, path_log)
+        EmailService(smtp_host, smtp_port, path_log, EmailService.TELNET_TRANSPORT)
 
         self.mc.verify()
 
@@ -79,7 +84,8 @@ class TestEmailService(TestCase):
         self.mc.replay()
 
         self.assertRaises(ConnectionRefusedException, EmailService,
-                         smtp_host, smtp_port, path_log)
+                         smtp_host, smtp_port, path_log,
+                         EmailService.TELNET_TRANSPORT)
 
         self.mc.verify()
 
@@ -112,7 +118,8 @@ class TestEmailService(TestCase):
         self.mc.replay()
 
         self.assertRaises(NotAvailableException, EmailService,
-                          smtp_host, smtp_port, path_log)
+                          smtp_host, smtp_port, path_log,
+                          EmailService.TELNET_TRANSPORT)
 
         self.mc.verify()
 
@@ -140,7 +147,8 @@ class TestEmailService(TestCase):
         self.mc.replay()
 
         self.assertRaises(Exception, EmailService, smtp_host,
-                          smtp_port, path_log)
+                          smtp_port, path_log,
+                          EmailService.TELNET_TRANSPORT)
 
         self.mc.verify()
 
@@ -168,7 +176,8 @@ class TestEmailService(TestCase):
         self.mc.replay()
 
         self.assertRaises(Exception, EmailService, smtp_host, smtp_port,
-                          path_log)
+                          path_log,
+                          EmailService.TELNET_TRANSPORT)
 
         self.mc.verify()
 
@@ -195,7 +204,8 @@ class TestEmailService(TestCase):
         self.mc.replay()
 
         self.assertRaises(UnknownServiceException, EmailService, smtp_host,
-                          smtp_port, path_log)
+                          smtp_port, path_log,
+                          EmailService.TELNET_TRANSPORT)
 
         self.mc.verify()
 
@@ -221,7 +231,8 @@ class TestEmailService(TestCase):
         self.mc.replay()
 
         self.assertRaises(Exception, EmailService, smtp_host,smtp_port,
-                          path_log)
+                          path_log,
+                          EmailService.TELNET_TRANSPORT)
 
         self.mc.verify()
 
@@ -247,7 +258,56 @@ class TestEmailService(TestCase):
         self.mc.replay()
 
         self.assertRaises(Exception, EmailService, smtp_host, smtp_port,
-                          path_log)
+                          path_log,
+                          EmailService.TELNET_TRANSPORT)
+
+        self.mc.verify()
+
+    def test_establish_socket_connection(self):
+        smtp_host = 'localhost'
+        smtp_port = 25
+        path_log = ''
+
+        socket_mock = self.mc.mock_class(SocketTransport)
+        socket_ctor_mock = self.mc.mock_constructor(transport,
+                                                    'SocketTransport')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                        'get_expect_smtp_reply_code')
+        mock_ehlo = self.mc.mock_method(EmailService, 'ehlo')
+        socket_ctor_mock(smtp_host, smtp_port).returns(socket_mock)
+
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).\
+            returns(self.SERVICE_READY)
+        mock_ehlo(socket_mock).returns({})
+
+        self.mc.replay()
+
+        EmailService(smtp_host, smtp_port, path_log)
+
+        self.mc.verify()
+
+    def test_establish_socket_connection_service_not_available(self):
+        smtp_host = 'localhost'
+        smtp_port = 25
+        path_log = ''
+
+        socket_mock = self.mc.mock_class(SocketTransport)
+        socket_ctor_mock = self.mc.mock_constructor(transport,
+                                                    'SocketTransport')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                        'get_expect_smtp_reply_code')
+        socket_ctor_mock(smtp_host, smtp_port).returns(socket_mock)
+
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).\
+            returns(self.SERVICE_NOT_AVAILABLE)
+        socket_mock.close(True)
+
+        self.mc.replay()
+
+        self.assertRaises(NotAvailableException, EmailService,
+                          smtp_host, smtp_port, path_log)
 
         self.mc.verify()
 
@@ -281,7 +341,7 @@ class TestEmailService(TestCase):
         mock_get_expect_smtp_reply_code(spawn_mock).\
             returns(self.START_MAIL_INPUT)
         spawn_mock.sendline('Subject:test letter')
-        spawn_mock.sendline('some text\n.')
+        spawn_mock.send('some text\r\n.\r\n')
         spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
         mock_get_expect_smtp_reply_code(spawn_mock).returns(self.COMPLETED)
         spawn_mock.sendline('quit')
@@ -661,7 +721,7 @@ class TestEmailService(TestCase):
         mock_get_expect_smtp_reply_code(spawn_mock).\
             returns(self.START_MAIL_INPUT)
         spawn_mock.sendline('Subject:test letter')
-        spawn_mock.sendline('some text\n.')
+        spawn_mock.send('some text\r\n.\r\n')
         spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
         mock_get_expect_smtp_reply_code(spawn_mock).\
             returns(self.REQUEST_ABORTED)
@@ -704,7 +764,7 @@ class TestEmailService(TestCase):
         mock_get_expect_smtp_reply_code(spawn_mock).\
             returns(self.START_MAIL_INPUT)
         spawn_mock.sendline('Subject:test letter')
-        spawn_mock.sendline('some text\n.')
+        spawn_mock.send('some text\r\n.\r\n')
         spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
         mock_get_expect_smtp_reply_code(spawn_mock).returns('')
 
@@ -746,7 +806,7 @@ class TestEmailService(TestCase):
         mock_get_expect_smtp_reply_code(spawn_mock).\
             returns(self.START_MAIL_INPUT)
         spawn_mock.sendline('Subject:test letter')
-        spawn_mock.sendline('some text\n.')
+        spawn_mock.send('some text\r\n.\r\n')
         spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
         mock_get_expect_smtp_reply_code(spawn_mock).returns(self.COMPLETED)
         spawn_mock.sendline('quit')
@@ -792,7 +852,7 @@ class TestEmailService(TestCase):
         mock_get_expect_smtp_reply_code(spawn_mock).\
             returns(self.START_MAIL_INPUT)
         spawn_mock.sendline('Subject:test letter')
-        spawn_mock.sendline('some text\n.')
+        spawn_mock.send('some text\r\n.\r\n')
         spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
         mock_get_expect_smtp_reply_code(spawn_mock).returns(self.COMPLETED)
         spawn_mock.sendline('quit')
@@ -806,3 +866,419 @@ class TestEmailService(TestCase):
                           subject, msg)
 
         self.mc.verify()
+
+    def test_send_message_session(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+        path_log = '/home/lenok/PyCharmProjects/mylog.txt'
+
+        spawn_mock = self.mc.mock_class(pexpect.spawn)
+        mock_establish_connection = self.mc.mock_method(EmailService,
+                                              'establish_connection')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                            'get_expect_smtp_reply_code')
+
+        mock_establish_connection(smtp_host, path_log,
+                                  smtp_port).returns(spawn_mock)
+
+        for i in range(2):
+            spawn_mock.isalive().returns(True)
+            spawn_mock.sendline('mail from: lenok@gmail.com')
+            spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+            mock_get_expect_smtp_reply_code(spawn_mock).\
+                returns(self.COMPLETED)
+            spawn_mock.sendline('rcpt to: vovaxo@gmail.com')
+            spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+            mock_get_expect_smtp_reply_code(spawn_mock).\
+                returns(self.COMPLETED)
+            spawn_mock.sendline('DATA')
+            spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+            mock_get_expect_smtp_reply_code(spawn_mock).\
+                returns(self.START_MAIL_INPUT)
+            spawn_mock.sendline('Subject:test letter')
+            spawn_mock.send('some text\r\n.\r\n')
+            spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+            mock_get_expect_smtp_reply_code(spawn_mock).\
+                returns(self.COMPLETED)
+        spawn_mock.isalive().returns(True)
+        spawn_mock.sendline('quit')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(spawn_mock).\
+            returns(self.SERVICE_CLOSING)
+        spawn_mock.close(True)
+
+        self.mc.replay()
+
+        con = EmailService(smtp_host, smtp_port, path_log)
+        con.send_message(sender, recipient, subject, msg)
+        con.send_message(sender, recipient, subject, msg)
+        con.close()
+
+        self.mc.verify()
+
+    def test_send_message_reset_after_error(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+        path_log = '/home/lenok/PyCharmProjects/mylog.txt'
+
+        spawn_mock = self.mc.mock_class(pexpect.spawn)
+        mock_establish_connection = self.mc.mock_method(EmailService,
+                                              'establish_connection')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                            'get_expect_smtp_reply_code')
+
+        mock_establish_connection(smtp_host, path_log,
+                                  smtp_port).returns(spawn_mock)
+
+        spawn_mock.isalive().returns(True)
+        spawn_mock.sendline('mail from: lenok@gmail.com')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(spawn_mock).returns(self.COMPLETED)
+        spawn_mock.sendline('rcpt to: vovaxo@gmail.com')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(spawn_mock).\
+            returns(self.REQUEST_ABORTED)
+        spawn_mock.isalive().returns(True)
+        spawn_mock.sendline('rset')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(spawn_mock).returns(self.COMPLETED)
+        spawn_mock.sendline('mail from: lenok@gmail.com')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(spawn_mock).\
+            returns(self.SYNTAX_ERROR)
+
+        self.mc.replay()
+
+        con = EmailService(smtp_host, smtp_port, path_log)
+        self.assertRaises(RequestedActionAbortedException,
+                          con.send_message, sender, recipient, subject, msg)
+        self.assertRaises(SyntaxErrorException,
+                          con.send_message, sender, recipient, subject, msg)
+
+        self.mc.verify()
+
+    def test_send_message_pipelining(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+        path_log = '/home/lenok/PyCharmProjects/mylog.txt'
+
+        socket_mock = self.mc.mock_class(SocketTransport)
+        mock_establish_connection = self.mc.mock_method(EmailService,
+                                              'establish_connection')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                            'get_expect_smtp_reply_code')
+
+        mock_establish_connection(smtp_host, path_log,
+                                  smtp_port).returns(socket_mock)
+
+        socket_mock.isalive().returns(True)
+        socket_mock.send('mail from: lenok@gmail.com\r\n'
+                         'rcpt to: vovaxo@gmail.com\r\n'
+                         'DATA\r\n')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).\
+            returns(self.START_MAIL_INPUT)
+        socket_mock.sendline('Subject:test letter')
+        socket_mock.send('some text\r\n.\r\n')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+
+        self.mc.replay()
+
+        con = EmailService(smtp_host, smtp_port, path_log)
+        con.extensions = {'PIPELINING': ''}
+        con.send_message(sender, recipient, subject, msg)
+
+        self.mc.verify()
+
+    def test_send_message_pipelining_will_forward(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+        path_log = '/home/lenok/PyCharmProjects/mylog.txt'
+
+        socket_mock = self.mc.mock_class(SocketTransport)
+        mock_establish_connection = self.mc.mock_method(EmailService,
+                                              'establish_connection')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                            'get_expect_smtp_reply_code')
+
+        mock_establish_connection(smtp_host, path_log,
+                                  smtp_port).returns(socket_mock)
+
+        socket_mock.isalive().returns(True)
+        socket_mock.send('mail from: lenok@gmail.com\r\n'
+                         'rcpt to: vovaxo@gmail.com\r\n'
+                         'DATA\r\n')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns('251')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).\
+            returns(self.START_MAIL_INPUT)
+        socket_mock.sendline('Subject:test letter')
+        socket_mock.send('some text\r\n.\r\n')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+
+        self.mc.replay()
+
+        con = EmailService(smtp_host, smtp_port, path_log)
+        con.extensions = {'PIPELINING': ''}
+        self.assertEqual(con.send_message(sender, recipient, subject, msg),
+                         'completed')
+
+        self.mc.verify()
+
+    def test_send_message_pipelining_rcpt_request_aborted(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+        path_log = '/home/lenok/PyCharmProjects/mylog.txt'
+
+        socket_mock = self.mc.mock_class(SocketTransport)
+        mock_establish_connection = self.mc.mock_method(EmailService,
+                                              'establish_connection')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                            'get_expect_smtp_reply_code')
+
+        mock_establish_connection(smtp_host, path_log,
+                                  smtp_port).returns(socket_mock)
+
+        socket_mock.isalive().returns(True)
+        socket_mock.send('mail from: lenok@gmail.com\r\n'
+                         'rcpt to: vovaxo@gmail.com\r\n'
+                         'DATA\r\n')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).\
+            returns(self.REQUEST_ABORTED)
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns('554')
+
+        self.mc.replay()
+
+        con = EmailService(smtp_host, smtp_port, path_log)
+        con.extensions = {'PIPELINING': ''}
+        self.assertRaises(RequestedActionAbortedException,
+                          con.send_message, sender, recipient, subject, msg)
+
+        self.mc.verify()
+
+    def test_send_message_pipelining_service_not_available(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+        path_log = '/home/lenok/PyCharmProjects/mylog.txt'
+
+        socket_mock = self.mc.mock_class(SocketTransport)
+        mock_establish_connection = self.mc.mock_method(EmailService,
+                                              'establish_connection')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                            'get_expect_smtp_reply_code')
+
+        mock_establish_connection(smtp_host, path_log,
+                                  smtp_port).returns(socket_mock)
+
+        socket_mock.isalive().returns(True)
+        socket_mock.send('mail from: lenok@gmail.com\r\n'
+                         'rcpt to: vovaxo@gmail.com\r\n'
+                         'DATA\r\n')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).\
+            returns(self.SERVICE_NOT_AVAILABLE)
+        socket_mock.close(True)
+
+        self.mc.replay()
+
+        con = EmailService(smtp_host, smtp_port, path_log)
+        con.extensions = {'PIPELINING': ''}
+        self.assertRaises(NotAvailableException,
+                          con.send_message, sender, recipient, subject, msg)
+
+        self.mc.verify()
+
+    def test_send_message_telnet_timeout(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+        path_log = '/home/lenok/PyCharmProjects/mylog.txt'
+
+        spawn_mock = self.mc.mock_class(pexpect.spawn)
+        mock_establish_connection = self.mc.mock_method(EmailService,
+                                              'establish_connection')
+
+        mock_establish_connection(smtp_host, path_log,
+                                  smtp_port).returns(spawn_mock)
+
+        spawn_mock.isalive().returns(True)
+        spawn_mock.sendline('mail from: lenok@gmail.com')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).\
+            raises(pexpect.TIMEOUT('Timeout exceeded.'))
+        spawn_mock.close(True)
+
+        self.mc.replay()
+
+        con = EmailService(smtp_host, smtp_port, path_log)
+        self.assertRaises(TimeoutException,
+                          con.send_message, sender, recipient, subject, msg)
+
+        self.mc.verify()
+
+    def test_send_message_many_recipients(self):
+        sender = 'lenok@gmail.com'
+        recipients = ['vovaxo@gmail.com', 'nobody@gmail.com']
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+        path_log = '/home/lenok/PyCharmProjects/mylog.txt'
+
+        spawn_mock = self.mc.mock_class(pexpect.spawn)
+        mock_establish_connection = self.mc.mock_method(EmailService,
+                                              'establish_connection')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                            'get_expect_smtp_reply_code')
+
+        mock_establish_connection(smtp_host, path_log,
+                                  smtp_port).returns(spawn_mock)
+
+        spawn_mock.isalive().returns(True)
+        spawn_mock.sendline('mail from: lenok@gmail.com')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(spawn_mock).returns(self.COMPLETED)
+        spawn_mock.sendline('rcpt to: vovaxo@gmail.com')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(spawn_mock).returns(self.COMPLETED)
+        spawn_mock.sendline('rcpt to: nobody@gmail.com')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(spawn_mock).\
+            returns(self.REQUEST_ABORTED)
+        spawn_mock.sendline('DATA')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(spawn_mock).\
+            returns(self.START_MAIL_INPUT)
+        spawn_mock.sendline('Subject:test letter')
+        spawn_mock.send('some text\r\n.\r\n')
+        spawn_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(spawn_mock).returns(self.COMPLETED)
+
+        self.mc.replay()
+
+        con = EmailService(smtp_host, smtp_port, path_log)
+        result = con.send_message(sender, recipients, subject, msg)
+        self.assertEqual({'vovaxo@gmail.com': self.COMPLETED,
+                          'nobody@gmail.com': self.REQUEST_ABORTED}, result)
+
+        self.mc.verify()
+
+    def test_send_message_streamed_body(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = StringIO('some text\nmore text\r\nlast line')
+        smtp_port = 25
+        path_log = '/home/lenok/PyCharmProjects/mylog.txt'
+
+        socket_mock = self.mc.mock_class(SocketTransport)
+        mock_establish_connection = self.mc.mock_method(EmailService,
+                                              'establish_connection')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                            'get_expect_smtp_reply_code')
+
+        mock_establish_connection(smtp_host, path_log,
+                                  smtp_port).returns(socket_mock)
+
+        socket_mock.isalive().returns(True)
+        socket_mock.sendline('mail from: lenok@gmail.com')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+        socket_mock.sendline('rcpt to: vovaxo@gmail.com')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+        socket_mock.sendline('DATA')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).\
+            returns(self.START_MAIL_INPUT)
+        socket_mock.sendline('Subject:test letter')
+        socket_mock.send('some text\r\nmore text\r\nlast line\r\n.\r\n')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+
+        self.mc.replay()
+
+        con = EmailService(smtp_host, smtp_port, path_log)
+        con.send_message(sender, recipient, subject, msg)
+
+        self.mc.verify()
+
+    def test_send_message_chunked_body(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = StringIO('some text\r\n.last line\r\n')
+        smtp_port = 25
+        path_log = '/home/lenok/PyCharmProjects/mylog.txt'
+
+        socket_mock = self.mc.mock_class(SocketTransport)
+        mock_establish_connection = self.mc.mock_method(EmailService,
+                                              'establish_connection')
+        mock_get_expect_smtp_reply_code = self.mc.mock_method(EmailService,
+                                            'get_expect_smtp_reply_code')
+
+        mock_establish_connection(smtp_host, path_log,
+                                  smtp_port).returns(socket_mock)
+
+        socket_mock.isalive().returns(True)
+        socket_mock.sendline('mail from: lenok@gmail.com')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+        socket_mock.sendline('rcpt to: vovaxo@gmail.com')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+        socket_mock.send('bdat 44 last\r\nSubject:test letter\r\n')
+        socket_mock.send('some text\r\n.last line\r\n')
+        socket_mock.expect(self.COMMAND_CODE_REGEXP).returns(0)
+        mock_get_expect_smtp_reply_code(socket_mock).returns(self.COMPLETED)
+
+        self.mc.replay()
+
+        con = EmailService(smtp_host, smtp_port, path_log)
+        con.extensions = {'CHUNKING': ''}
+        con.send_message(sender, recipient, subject, msg)
+
+        self.mc.verify()
@@ -0,0 +1,50 @@
+from unittest import TestCase
+from exception import NotAvailableException
+import metrics
+import random
+
+
+class TestMetrics(TestCase):
+
+    def tearDown(self):
+        metrics.set_sink(None)
+
+    def test_histogram_precision(self):
+        histogram = metrics.Histogram()
+        for value in [0, 1, 255, 256, 257, 1000, 123456, 10 ** 9] + \
+                [random.randint(0, 10 ** 8) for i in range(1000)]:
+            index = histogram.get_index(value)
+            self.assertTrue(histogram.get_index(histogram.get_value(index))
+                            == index)
+            self.assertTrue(value <= histogram.get_value(index) <=
+                            value * (1 + 1 / 128.0))
+        for milliseconds in range(1, 101):
+            histogram.record(milliseconds / 1000.0)
+        summary = histogram.get_summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['p50'], 0.050, 3)
+        self.assertAlmostEqual(summary['p99'], 0.099, 3)
+        self.assertEqual(summary['max'], 0.1)
+
+    def test_sinks(self):
+        self.assertTrue(metrics.timer('mail') is metrics.NULL_TIMER)
+        sink = metrics.set_sink(metrics.HistogramSink())
+        with metrics.timer('rcpt') as phase:
+            phase.outcome = '550'
+        with metrics.timer('mail'):
+            pass
+        try:
+            with metrics.timer('mail'):
+                raise NotAvailableException
+        except NotAvailableException:
+            pass
+        summary = sink.get_summary()
+        self.assertEqual(summary['rcpt']['outcomes'], {'550': 1})
+        self.assertEqual(summary['mail']['outcomes'],
+                         {metrics.OK: 1, 'NotAvailableException': 1})
+
+        recorded = []
+        metrics.set_sink(metrics.CallbackSink(
+            lambda phase, seconds, outcome: recorded.append((phase, outcome))))
+        metrics.timed('quit')(lambda: None)()
+        self.assertEqual(recorded, [('quit', metrics.OK)])
@@ -0,0 +1,54 @@
+from unittest import TestCase
+from StringIO import StringIO
+from mime import MimeMessage, iter_base64, BASE64_LINE
+import base64
+import email
+import os
+import shutil
+import tempfile
+
+
+class ShortReads():
+    # file that never returns more than size bytes at once
+
+    def __init__(self, data, size):
+        self.data = StringIO(data)
+        self.size = size
+
+    def read(self, size):
+        return self.data.read(min(size, self.size))
+
+
+class TestMimeMessage(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_attachments(self):
+        path = os.path.join(self.dir, 'report.pdf')
+        data = os.urandom(200000)
+        with open(path, 'wb') as attachment:
+            attachment.write(data)
+        message = MimeMessage('Hello,\n.see the report\n')
+        message.attach(path)
+        text = ''.join(message)
+        self.assertEqual(text, ''.join(message))
+        self.assertTrue(max(len(line) for line in text.split('\r\n')) <= 76)
+
+        parsed = email.message_from_string(text)
+        text_part, attachment_part = parsed.get_payload()
+        self.assertEqual(text_part.get_payload(decode=True),
+                         'Hello,\n.see the report\n')
+        self.assertEqual(attachment_part.get_content_type(),
+                         'application/pdf')
+        self.assertEqual(attachment_part.get_filename(), 'report.pdf')
+        self.assertEqual(attachment_part.get_payload(decode=True), data)
+
+    def test_base64_with_short_reads(self):
+        data = os.urandom(BASE64_LINE * 10 + 5)
+        encoded = ''.join(iter_base64(ShortReads(data, 100)))
+        self.assertEqual(encoded, base64.encodestring(data).replace(
+            '\n', '\r\n'))
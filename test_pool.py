@@ -0,0 +1,172 @@
+from unittest import TestCase
+from shared.testing.vmock.mockcontrol import MockControl
+from exception import NotAvailableException, TerminationConnectionException
+from sending_service import EmailService
+from pool import ConnectionPool
+import time
+
+
+class TestConnectionPool(TestCase):
+    COMPLETED = 'completed'
+
+    def setUp(self):
+        self.mc = MockControl()
+
+    def tearDown(self):
+        self.mc.tear_down()
+
+    def test_send_message_reuses_connection(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+
+        con_mock = self.mc.mock_class(EmailService)
+        mock_connect = self.mc.mock_method(ConnectionPool, 'connect')
+
+        mock_connect(smtp_host, smtp_port).returns(con_mock)
+        con_mock.send_message(sender, recipient, subject, msg).\
+            returns(self.COMPLETED)
+        con_mock.send_message(sender, recipient, subject, msg).\
+            returns(self.COMPLETED)
+
+        self.mc.replay()
+
+        pool = ConnectionPool()
+        pool.send_message(smtp_host, smtp_port, sender, recipient, subject,
+                          msg)
+        pool.send_message(smtp_host, smtp_port, sender, recipient, subject,
+                          msg)
+
+        self.mc.verify()
+
+    def test_send_message_replaces_dead_connection(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+
+        con_mock = self.mc.mock_class(EmailService)
+        new_con_mock = self.mc.mock_class(EmailService)
+        mock_connect = self.mc.mock_method(ConnectionPool, 'connect')
+        mock_is_alive = self.mc.mock_method(ConnectionPool, 'is_alive')
+        mock_close_connection = self.mc.mock_method(ConnectionPool,
+                                                    'close_connection')
+
+        mock_connect(smtp_host, smtp_port).returns(con_mock)
+        con_mock.send_message(sender, recipient, subject, msg).\
+            returns(self.COMPLETED)
+        mock_is_alive(con_mock).returns(False)
+        mock_close_connection(con_mock, quit=False)
+        mock_connect(smtp_host, smtp_port).returns(new_con_mock)
+        new_con_mock.send_message(sender, recipient, subject, msg).\
+            returns(self.COMPLETED)
+
+        self.mc.replay()
+
+        pool = ConnectionPool(noop_after=-1)
+        pool.send_message(smtp_host, smtp_port, sender, recipient, subject,
+                          msg)
+        pool.send_message(smtp_host, smtp_port, sender, recipient, subject,
+                          msg)
+
+        self.mc.verify()
+
+    def test_send_message_retries_terminated_connection(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+
+        con_mock = self.mc.mock_class(EmailService)
+        new_con_mock = self.mc.mock_class(EmailService)
+        mock_connect = self.mc.mock_method(ConnectionPool, 'connect')
+        mock_close_connection = self.mc.mock_method(ConnectionPool,
+                                                    'close_connection')
+
+        mock_connect(smtp_host, smtp_port).returns(con_mock)
+        con_mock.send_message(sender, recipient, subject, msg).\
+            raises(TerminationConnectionException())
+        mock_close_connection(con_mock, False)
+        mock_connect(smtp_host, smtp_port).returns(new_con_mock)
+        new_con_mock.send_message(sender, recipient, subject, msg).\
+            returns(self.COMPLETED)
+
+        self.mc.replay()
+
+        pool = ConnectionPool()
+        result = pool.send_message(smtp_host, smtp_port, sender, recipient,
+                                   subject, msg)
+        self.assertEqual(self.COMPLETED, result)
+
+        self.mc.verify()
+
+    def test_send_message_keeps_connection_after_rejection(self):
+        sender = 'lenok@gmail.com'
+        recipient = 'vovaxo@gmail.com'
+        subject = 'test letter'
+        smtp_host = 'localhost'
+        msg = 'some text'
+        smtp_port = 25
+        rejected = Exception('Some another error', '550', '5.1.1',
+                             '5.1.1 User unknown')
+
+        con_mock = self.mc.mock_class(EmailService)
+        new_con_mock = self.mc.mock_class(EmailService)
+        mock_connect = self.mc.mock_method(ConnectionPool, 'connect')
+        mock_close_connection = self.mc.mock_method(ConnectionPool,
+                                                    'close_connection')
+
+        mock_connect(smtp_host, smtp_port).returns(con_mock)
+        con_mock.send_message(sender, recipient, subject, msg).\
+            raises(rejected)
+        con_mock.send_message(sender, recipient, subject, msg).\
+            raises(NotAvailableException('421', None, 'closing'))
+        mock_close_connection(con_mock, False)
+        mock_connect(smtp_host, smtp_port).returns(new_con_mock)
+        new_con_mock.send_message(sender, recipient, subject, msg).\
+            returns(self.COMPLETED)
+
+        self.mc.replay()
+
+        pool = ConnectionPool()
+        for error in (Exception, NotAvailableException):
+            self.assertRaises(error, pool.send_message, smtp_host, smtp_port,
+                              sender, recipient, subject, msg)
+        pool.send_message(smtp_host, smtp_port, sender, recipient, subject,
+                          msg)
+
+        self.mc.verify()
+
+    def test_release_closes_expired_idle_connection(self):
+        smtp_host = 'localhost'
+        smtp_port = 25
+
+        con_mock = self.mc.mock_class(EmailService)
+        new_con_mock = self.mc.mock_class(EmailService)
+        mock_connect = self.mc.mock_method(ConnectionPool, 'connect')
+        mock_close_connection = self.mc.mock_method(ConnectionPool,
+                                                    'close_connection')
+
+        mock_connect(smtp_host, smtp_port).returns(con_mock)
+        mock_connect(smtp_host, smtp_port).returns(new_con_mock)
+        mock_close_connection(con_mock, True)
+
+        self.mc.replay()
+
+        # the expired connection is not the one acquire would look at next
+        pool = ConnectionPool(idle_ttl=0.05, evict_interval=0)
+        con = pool.acquire(smtp_host, smtp_port)
+        new_con = pool.acquire(smtp_host, smtp_port)
+        pool.release(con)
+        time.sleep(0.1)
+        pool.release(new_con)
+        self.assertEqual(1, pool.opened[(smtp_host, smtp_port)])
+
+        self.mc.verify()
@@ -0,0 +1,105 @@
+import metrics
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+from delivery import send_many
+from ratelimit import BUCKET, RateLimiter, parse_limits
+from smtp_sink import SmtpSink
+
+
+def reserve_in_process(directory, results):
+    limiter = RateLimiter({'example.com': (100, 1)}, directory=directory)
+    results.put([limiter.reserve_recipients('user@example.com')
+                 for i in range(10)])
+
+
+class TestRateLimiter(TestCase):
+
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits(['Example.com=10:20,*=0.5', 'a.b=5']),
+                         {'example.com': (10.0, 20.0), '*': (0.5, 1.0),
+                          'a.b': (5.0, 5.0)})
+        self.assertRaises(ValueError, parse_limits, ['example.com'])
+        self.assertRaises(ValueError, parse_limits, ['example.com=0'])
+
+    def test_burst_then_rate(self):
+        limiter = RateLimiter({'example.com': (10, 2), '*': (1000, 1000)},
+                              {'mx.example.com': (1, 1)})
+        self.assertEqual(limiter.reserve_recipients('a@example.com'), 0)
+        self.assertEqual(limiter.reserve_recipients('b@example.com'), 0)
+        self.assertAlmostEqual(limiter.reserve_recipients('c@Example.com'),
+                               0.1, places=2)
+        # two recipients at the domain take two tokens
+        self.assertAlmostEqual(limiter.reserve_recipients(
+            ['d@example.com', 'e@example.com', 'f@other.com']), 0.3,
+            places=2)
+        self.assertEqual(limiter.reserve_recipients('g@other.com'), 0)
+        self.assertEqual(limiter.reserve_relay('mx.example.com', 25), 0)
+        self.assertAlmostEqual(limiter.reserve_relay('mx.example.com', 25),
+                               1, places=2)
+        self.assertEqual(limiter.reserve_relay('mx.example.com', 2525), 0)
+
+    def test_relay_case(self):
+        # limits from the config are lowercased, --host keeps its case
+        limiter = RateLimiter(
+            relay_limits=parse_limits(['MX.Example.com:2525=1:1']))
+        self.assertEqual(limiter.reserve_relay('Mx.example.COM', 2525), 0)
+        self.assertAlmostEqual(limiter.reserve_relay('mx.example.com', 2525),
+                               1, places=2)
+
+    def test_shared_between_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=reserve_in_process,
+                                             args=(directory, results))
+                     for i in range(2)]
+        for process in processes:
+            process.start()
+        waits = results.get(timeout=10) + results.get(timeout=10)
+        for process in processes:
+            process.join()
+        # 20 messages at 100 per second with a burst of one
+        self.assertAlmostEqual(max(waits), 0.19, delta=0.05)
+
+    def test_bucket_from_before_reboot(self):
+        # the monotonic clock went back since the bucket was written
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        bucket = open(os.path.join(directory, 'domain-example.com'), 'wb')
+        bucket.write(BUCKET.pack(1.0, metrics.monotonic() + 5 * 86400))
+        bucket.close()
+        limiter = RateLimiter({'example.com': (10, 1)}, directory=directory)
+        self.assertEqual(limiter.reserve_recipients('a@example.com'), 0)
+        self.assertAlmostEqual(limiter.reserve_recipients('b@example.com'),
+                               0.1, places=2)
+
+    def test_non_ascii_domain_in_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        limiter = RateLimiter({u'm\xfcller.de': (10, 1)}, directory=directory)
+        self.assertEqual(limiter.reserve_recipients(u'a@M\xfcller.de'), 0)
+        self.assertAlmostEqual(limiter.reserve_recipients(u'b@m\xfcller.de'),
+                               0.1, places=2)
+
+    def test_send_many_holds_back_limited_domain(self):
+        sink = SmtpSink().start()
+        self.addCleanup(sink.stop)
+        limiter = RateLimiter({'slow.com': (20, 1)})
+        messages = [{'sender': 'from@example.com',
+                     'recipient': 'user%d@%s' % (i, domain),
+                     'subject': 'hi', 'msg': 'x'}
+                    for domain in ('slow.com', 'fast.com') for i in range(5)]
+        start = time.time()
+        finished = {}
+        for message, result, error in send_many(messages, 2, '127.0.0.1',
+                                                sink.port, limiter=limiter):
+            self.assertEqual(error, None)
+            finished[message['recipient']] = time.time() - start
+        self.assertTrue(finished['user4@slow.com'] >= 0.19)
+        # the other domain is not stuck behind the limited one
+        self.assertTrue(max(seconds for recipient, seconds in finished.items()
+                            if recipient.endswith('fast.com')) < 0.1)
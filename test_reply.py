@@ -0,0 +1,52 @@
+from unittest import TestCase
+from exception import NotAvailableException, SyntaxErrorException
+from reply import Reply, ReplyParser, check_reply, get_error_code,\
+    parse_extensions
+
+
+class TestReplyParser(TestCase):
+
+    def test_replies_split_across_reads(self):
+        parser = ReplyParser()
+        data = ('250-mail.example.com\r\n250-SIZE 1000\r\n250 PIPELINING\r\n'
+                '550 5.1.1 User unknown\r\n354 go ahead\n')
+        replies = []
+        for start in range(0, len(data), 7):
+            replies.extend(parser.feed(data[start:start + 7]))
+        self.assertEqual([reply.code for reply in replies],
+                         ['250', '550', '354'])
+        self.assertEqual(replies[0].lines,
+                         ['mail.example.com', 'SIZE 1000', 'PIPELINING'])
+        self.assertEqual(parse_extensions(replies[0].lines),
+                         {'SIZE': '1000', 'PIPELINING': ''})
+        self.assertEqual(replies[0].enhanced_code, None)
+        self.assertEqual(replies[1].enhanced_code, '5.1.1')
+        self.assertEqual(replies[1].group('code'), '550')
+        self.assertEqual(replies[1].group(0), '550 5.1.1 User unknown')
+        self.assertEqual(parser.buffer, '')
+
+    def test_errors(self):
+        self.assertRaises(Exception, ReplyParser().feed, 'hello\r\n')
+        check_reply('250', '250')
+        self.assertRaises(NotAvailableException, check_reply, '421', '250')
+        self.assertRaises(SyntaxErrorException, check_reply, '500', '250')
+        try:
+            check_reply('550', '250')
+        except Exception, opt:
+            self.assertEqual(opt.args, ('Some another error', '550'))
+
+    def test_error_carries_reply(self):
+        try:
+            check_reply('550', '250', Reply('550', ['5.1.1 User unknown',
+                                                    'try another one']))
+        except Exception, opt:
+            self.assertEqual(opt.args, ('Some another error', '550', '5.1.1',
+                                        '5.1.1 User unknown\ntry another one'))
+            self.assertEqual(get_error_code(opt), '550')
+        try:
+            check_reply('421', '250', Reply('421', ['closing']))
+        except NotAvailableException, opt:
+            self.assertEqual(opt.args, ('421', None, 'closing'))
+            self.assertEqual(get_error_code(opt), '421')
+        self.assertEqual(get_error_code(Exception('Unexpected SMTP reply',
+                                                  'x')), None)
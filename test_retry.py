@@ -0,0 +1,131 @@
+from unittest import TestCase
+from exception import NotAvailableException, \
+    RequestedActionAbortedException, SyntaxErrorException
+from delivery import send_many
+from retry import RetryScheduler, is_transient, get_retry, send_with_retries
+from sharding import ShardedSender
+from smtp_sink import SmtpSink
+
+
+class TestRetry(TestCase):
+
+    def test_is_transient(self):
+        self.assertTrue(is_transient(NotAvailableException()))
+        self.assertTrue(is_transient(RequestedActionAbortedException()))
+        self.assertTrue(is_transient(Exception('Some another error', '452')))
+        self.assertFalse(is_transient(SyntaxErrorException()))
+        self.assertFalse(is_transient(Exception('Some another error', '550')))
+
+    def test_get_retry_deferred_recipients(self):
+        message = {'recipient': ['vovaxo@gmail.com', 'lenok@gmail.com']}
+        result = {'vovaxo@gmail.com': '250', 'lenok@gmail.com': '451'}
+        self.assertEqual({'recipient': ['lenok@gmail.com']},
+                         get_retry(message, result, None))
+        self.assertEqual(None, get_retry(message, 'completed', None))
+
+    def test_pop_due_in_order(self):
+        scheduler = RetryScheduler(base_delay=0)
+        scheduler.schedule({'recipient': 'first'})
+        scheduler.schedule({'recipient': 'second', 'attempt': 2})
+        self.assertEqual([{'recipient': 'first', 'attempt': 1},
+                          {'recipient': 'second', 'attempt': 3}],
+                         scheduler.pop_due())
+        self.assertEqual(0, len(scheduler))
+
+    def test_max_attempts(self):
+        scheduler = RetryScheduler(max_attempts=1)
+        self.assertFalse(scheduler.schedule({'attempt': 1}))
+        self.assertEqual(None, scheduler.next_due())
+
+    def test_send_with_retries(self):
+        failures = {'vovaxo@gmail.com': 2}
+
+        def send(messages):
+            for message in messages:
+                if failures.get(message['recipient']):
+                    failures[message['recipient']] -= 1
+                    yield message, None, NotAvailableException()
+                elif message['recipient'] == 'nobody@gmail.com':
+                    yield message, None, SyntaxErrorException()
+                else:
+                    yield message, 'completed', None
+
+        messages = [{'recipient': 'vovaxo@gmail.com'},
+                    {'recipient': 'nobody@gmail.com'}]
+        scheduler = RetryScheduler(base_delay=0)
+        outcomes = list(send_with_retries(messages, send, scheduler))
+        self.assertEqual(2, len(outcomes))
+        self.assertEqual('nobody@gmail.com', outcomes[0][0]['recipient'])
+        self.assertEqual(({'recipient': 'vovaxo@gmail.com', 'attempt': 2},
+                          'completed', None), outcomes[1])
+
+    def test_send_with_retries_deferred_recipients(self):
+        deferrals = {'lenok@gmail.com': 2, 'nobody@gmail.com': 10}
+
+        def send(messages):
+            for message in messages:
+                result = {}
+                for recipient in message['recipient']:
+                    if deferrals.get(recipient):
+                        deferrals[recipient] -= 1
+                        result[recipient] = '451'
+                    else:
+                        result[recipient] = '250'
+                yield message, result, None
+
+        message = {'recipient': ['vovaxo@gmail.com', 'lenok@gmail.com',
+                                 'nobody@gmail.com'], 'index': 1}
+        scheduler = RetryScheduler(base_delay=0, max_attempts=3)
+        outcomes = list(send_with_retries([message], send, scheduler))
+        # one outcome for the message, after the last retry
+        self.assertEqual([(message, {'vovaxo@gmail.com': '250',
+                                     'lenok@gmail.com': '250',
+                                     'nobody@gmail.com': '451'}, None)],
+                         outcomes)
+
+    def test_send_with_retries_one_send(self):
+        # the retries go through the same send_many and its connections
+        sink = SmtpSink(codes={'RCPT': ('451', 0.5)}, seed=1).start()
+        self.addCleanup(sink.stop)
+        calls = []
+
+        def send(messages):
+            calls.append(messages)
+            return send_many(messages, workers=2, smtp_host='127.0.0.1',
+                             smtp_port=sink.port)
+
+        messages = [{'sender': 'from@example.com', 'subject': 'hi',
+                     'recipient': 'to%d@example.com' % i, 'msg': 'x'}
+                    for i in range(30)]
+        scheduler = RetryScheduler(base_delay=0.01, max_attempts=20)
+        outcomes = list(send_with_retries(messages, send, scheduler))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(30, len(outcomes))
+        self.assertEqual([None] * 30, [error for message, result, error
+                                       in outcomes])
+        self.assertEqual(30, sink.received.value)
+
+    def test_send_with_retries_sharded(self):
+        # the shard processes keep sending while retries are outstanding
+        sink = SmtpSink(codes={'RCPT': ('451', 0.5)}, seed=1).start()
+        self.addCleanup(sink.stop)
+        sender = ShardedSender(2, '127.0.0.1', sink.port, workers=2)
+        calls = []
+
+        def send(messages):
+            calls.append(messages)
+            for shard, message, status, result in sender.send(messages):
+                if isinstance(result, Exception):
+                    yield message, None, result
+                else:
+                    yield message, result, None
+
+        messages = [{'sender': 'from@example.com', 'subject': 'hi',
+                     'recipient': 'to%d@example%d.com' % (i, i % 3),
+                     'msg': 'x'} for i in range(30)]
+        scheduler = RetryScheduler(base_delay=0.01, max_attempts=20)
+        outcomes = list(send_with_retries(messages, send, scheduler))
+        self.assertEqual(1, len(calls))
+        self.assertEqual([None] * 30, [error for message, result, error
+                                       in outcomes])
+        self.assertEqual(30, sink.received.value)
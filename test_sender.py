@@ -0,0 +1,212 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from sender import read_records, read_manifest, send_bulk, run_bulk,\
+    get_error_detail, SEND_COMPLETED, SEND_FAILED
+from smtp_sink import MEMORY, SmtpSink
+
+
+class TestManifest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        records_file = open(path, 'w')
+        records_file.write(text)
+        records_file.close()
+        return path
+
+    def test_read_records(self):
+        csv_path = self.write('records.csv', 'recipient,subject\n'
+                                             'a@example.com,hi\n')
+        json_path = self.write('records.jsonl',
+                               '{"recipient": "a@example.com"}\n\n'
+                               '{"recipient": "b@example.com"}\n')
+        self.assertEqual([{'recipient': 'a@example.com', 'subject': 'hi'}],
+                         list(read_records(csv_path)))
+        self.assertEqual([{'recipient': 'a@example.com'},
+                          {'recipient': 'b@example.com'}],
+                         list(read_records(json_path)))
+
+    def test_read_csv_manifest(self):
+        path = self.write('manifest.csv',
+                          'sender,recipient,subject,msg,msg_path,attachments\n'
+                          'f@example.com,a@example.com,hi,text,,\n'
+                          'f@example.com,"b@example.com, c@example.com",hi,,'
+                          'body.txt,"one.pdf, two.png"\n')
+        self.assertEqual([{'index': 0, 'sender': 'f@example.com',
+                           'recipient': 'a@example.com', 'subject': 'hi',
+                           'msg': 'text'},
+                          {'index': 1, 'sender': 'f@example.com',
+                           'recipient': ['b@example.com', 'c@example.com'],
+                           'subject': 'hi', 'msg_path': 'body.txt',
+                           'attachments': ['one.pdf', 'two.png']}],
+                         list(read_manifest(path)))
+
+    def test_read_json_manifest(self):
+        path = self.write('manifest.jsonl', json.dumps(
+            {'sender': 'f@example.com', 'recipient': ['a@example.com'],
+             'subject': 'hi', 'msg_path': 'body.txt',
+             'attachments': ['one.pdf']}) + '\n')
+        self.assertEqual([{'index': 0, 'sender': 'f@example.com',
+                           'recipient': ['a@example.com'], 'subject': 'hi',
+                           'msg_path': 'body.txt',
+                           'attachments': ['one.pdf']}],
+                         list(read_manifest(path)))
+
+    def test_read_json_manifest_non_ascii(self):
+        path = self.write('manifest.jsonl', json.dumps(
+            {'sender': 'f@example.com', 'recipient': u'm\xfcller@example.com',
+             'subject': u'Gr\xfc\xdfe', 'msg': u'\u20ac'}) + '\n')
+        message, = read_manifest(path)
+        self.assertEqual('Gr\xc3\xbc\xc3\x9fe', message['subject'])
+        self.assertEqual('m\xc3\xbcller@example.com', message['recipient'])
+        self.assertTrue(isinstance(message['msg'], str))
+
+
+class TestErrorDetail(TestCase):
+
+    def test_get_error_detail(self):
+        self.assertEqual(u'550 5.1.1 unknown',
+                         get_error_detail(Exception('550', '5.1.1', None,
+                                                    'unknown')))
+        self.assertEqual(u'bad address m\xfcller',
+                         get_error_detail(ValueError(u'bad address',
+                                                     u'm\xfcller')))
+        self.assertEqual(u'550 M\ufffdller',
+                         get_error_detail(Exception('550', 'M\xfcller')))
+
+
+
+class TestBulk(TestCase):
+    # send_bulk and run_bulk against sinks in background threads
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.results_path = os.path.join(self.dir, 'results.jsonl')
+
+    def start(self, **kwargs):
+        sink = SmtpSink(**kwargs).start()
+        self.addCleanup(sink.stop)
+        return sink
+
+    def read_results(self):
+        results_file = open(self.results_path)
+        try:
+            return sorted((json.loads(line) for line in results_file),
+                          key=lambda result: result['index'])
+        finally:
+            results_file.close()
+
+    def get_messages(self, recipients):
+        return [{'index': index, 'sender': 'f@example.com',
+                 'recipient': recipient, 'subject': 'hi', 'msg': 'x'}
+                for index, recipient in enumerate(recipients)]
+
+    def test_send_bulk(self):
+        sink = self.start(capture=MEMORY)
+        counters = send_bulk(self.get_messages(
+            ['a@example.com', ['b@example.com', 'c@example.com']]),
+            [('127.0.0.1', sink.port)], '', 'socket', 2, self.results_path)
+        self.assertEqual(2, counters[SEND_COMPLETED])
+        self.assertEqual(0, counters[SEND_FAILED])
+        self.assertEqual([{'index': 0, 'recipient': 'a@example.com',
+                           'status': SEND_COMPLETED},
+                          {'index': 1,
+                           'recipient': ['b@example.com', 'c@example.com'],
+                           'status': SEND_COMPLETED,
+                           'recipients': {'b@example.com': '250',
+                                          'c@example.com': '250'}}],
+                         self.read_results())
+        self.assertEqual(2, len(sink.messages))
+
+    def test_send_bulk_rejected(self):
+        sink = self.start(codes={'RCPT': '550'})
+        counters = send_bulk(self.get_messages(
+            ['a@example.com', ['b@example.com', 'c@example.com']]),
+            [('127.0.0.1', sink.port)], '', 'socket', 2, self.results_path)
+        self.assertEqual(0, counters[SEND_COMPLETED])
+        self.assertEqual(2, counters[SEND_FAILED])
+        rejected, all_rejected = self.read_results()
+        self.assertEqual(SEND_FAILED, rejected['status'])
+        self.assertEqual('Exception', rejected['error'])
+        self.assertTrue('550' in rejected['detail'])
+        # no recipient accepted: failed, with the reply of each one
+        self.assertEqual(SEND_FAILED, all_rejected['status'])
+        self.assertEqual({'b@example.com': '550', 'c@example.com': '550'},
+                         all_rejected['recipients'])
+
+    def test_run_bulk(self):
+        sink = self.start(capture=MEMORY)
+        manifest_path = os.path.join(self.dir, 'manifest.csv')
+        body_path = os.path.join(self.dir, 'body.txt')
+        for path, text in ((manifest_path,
+                            'sender,recipient,subject,msg,msg_path\n'
+                            'f@example.com,a@example.com,hi,,%s\n'
+                            'f@example.com,b@example.com,hi,inline,\n'
+                            % body_path),
+                           (body_path, 'from file\n')):
+            text_file = open(path, 'w')
+            text_file.write(text)
+            text_file.close()
+        run_bulk({'manifest': manifest_path,
+                  'smtp_host': '127.0.0.1:%d' % sink.port, 'workers': 2,
+                  'processes': 1, 'results_path': self.results_path})
+        self.assertEqual([SEND_COMPLETED] * 2,
+                         [result['status']
+                          for result in self.read_results()])
+        # the empty msg column does not hide msg_path
+        self.assertEqual(['from file', 'inline'],
+                         sorted(data.splitlines()[-1]
+                                for sender, recipients, data
+                                in sink.messages))
+
+    def test_run_bulk_json_manifest(self):
+        sink = self.start(capture=MEMORY)
+        manifest_path = os.path.join(self.dir, 'manifest.jsonl')
+        manifest = open(manifest_path, 'w')
+        for record in ({'sender': 'f@example.com', 'subject': u'Gr\xfc\xdfe',
+                        'recipient': 'a@example.com', 'msg': u'\u20ac 5'},
+                       {'sender': 'f@example.com', 'subject': 'no body',
+                        'recipient': 'b@example.com'}):
+            manifest.write(json.dumps(record) + '\n')
+        manifest.close()
+        run_bulk({'manifest': manifest_path,
+                  'smtp_host': '127.0.0.1:%d' % sink.port, 'workers': 2,
+                  'processes': 1, 'results_path': self.results_path})
+        completed, failed = self.read_results()
+        self.assertEqual(SEND_COMPLETED, completed['status'])
+        # the record without a body fails alone
+        self.assertEqual(SEND_FAILED, failed['status'])
+        self.assertEqual('ValueError', failed['error'])
+        self.assertEqual(1, len(sink.messages))
+
+    def test_run_bulk_template_without_sender(self):
+        sink = self.start(capture=MEMORY)
+        template_path = os.path.join(self.dir, 'template.txt')
+        data_path = os.path.join(self.dir, 'data.csv')
+        for path, text in ((template_path, 'Hello {name}\n'),
+                           (data_path, 'recipient,name,sender\n'
+                                       'a@example.com,Ann,f@example.com\n'
+                                       'b@example.com,Bob,\n')):
+            text_file = open(path, 'w')
+            text_file.write(text)
+            text_file.close()
+        run_bulk({'template': template_path, 'data': data_path,
+                  'subject': 'Hi {name}',
+                  'smtp_host': '127.0.0.1:%d' % sink.port, 'workers': 2,
+                  'processes': 1, 'results_path': self.results_path})
+        completed, failed = self.read_results()
+        self.assertEqual(SEND_COMPLETED, completed['status'])
+        # no sender column and no --sender: only that row fails
+        self.assertEqual(SEND_FAILED, failed['status'])
+        self.assertEqual('ValueError', failed['error'])
+        self.assertEqual([('f@example.com', ['a@example.com'])],
+                         [(sender, recipients) for sender, recipients, data
+                          in sink.messages])
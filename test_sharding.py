@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import threading
+from unittest import TestCase
+from sharding import ResultBatch, ShardedSender, SEND_COMPLETED, SEND_FAILED
+from smtp_sink import MEMORY, SmtpSink
+
+
+class ExitOnArrival(object):
+    # kills the shard process that takes it off its queue
+    def __reduce__(self):
+        return os._exit, (3,)
+
+
+class TestShardedSender(TestCase):
+    # two shard processes against sinks in background threads
+
+    def setUp(self):
+        self.sink = SmtpSink(capture=MEMORY).start()
+        self.addCleanup(self.sink.stop)
+        self.refusing = SmtpSink(codes={'RCPT': '451'}).start()
+        self.addCleanup(self.refusing.stop)
+        self.sender = ShardedSender(2, '127.0.0.1', self.sink.port, workers=2)
+
+    def get_messages(self, count, domains=('a.com', 'b.com', 'c.com')):
+        return [{'sender': 'from@example.com',
+                 'recipient': 'user%d@%s' % (i, domains[i % len(domains)]),
+                 'subject': 'hi', 'msg': 'x'} for i in range(count)]
+
+    def test_send(self):
+        messages = self.get_messages(30)
+        # every fifth message goes to the relay that refuses it
+        for message in messages[::5]:
+            message['smtp_host'] = '127.0.0.1'
+            message['smtp_port'] = self.refusing.port
+        results = list(self.sender.send(iter(messages)))
+        self.assertEqual(sorted(message['recipient'] for shard, message,
+                                status, result in results),
+                         sorted(message['recipient'] for message in messages))
+        shards = {}
+        for shard, message, status, result in results:
+            # all mail for one domain goes through one process
+            self.assertEqual(shards.setdefault(
+                message['recipient'].rpartition('@')[2], shard), shard)
+            self.assertEqual(status, SEND_FAILED if 'smtp_port' in message
+                             else SEND_COMPLETED)
+        self.assertEqual(len(self.sink.messages), 24)
+        self.assertEqual(self.sender.totals(),
+                         {SEND_COMPLETED: 24, SEND_FAILED: 6,
+                          'RequestedActionAbortedException': 6})
+
+    def test_all_recipients_rejected(self):
+        messages = self.get_messages(4)
+        for message in messages[:2]:
+            message['recipient'] = [message['recipient'], 'other@d.com']
+            message['smtp_host'] = '127.0.0.1'
+            message['smtp_port'] = self.refusing.port
+        results = list(self.sender.send(iter(messages)))
+        self.assertEqual(sorted((status, isinstance(result, dict))
+                                for shard, message, status, result in results),
+                         [(SEND_COMPLETED, False)] * 2 +
+                         [(SEND_FAILED, True)] * 2)
+        self.assertEqual(self.sender.totals(),
+                         {SEND_COMPLETED: 2, SEND_FAILED: 2})
+
+    def test_results_while_input_waits(self):
+        # a shard hands out what it delivered while its queue is empty
+        returned = threading.Event()
+
+        def get_messages():
+            messages = self.get_messages(3)
+            for message in messages[:2]:
+                yield message
+            # the rest only comes once a result is back
+            if not returned.wait(5):
+                raise Exception('No result while the input waits')
+            yield messages[2]
+
+        results = []
+        for result in self.sender.send(get_messages()):
+            returned.set()
+            results.append(result)
+        self.assertEqual(len(results), 3)
+
+    def test_get_shard_non_ascii_domain(self):
+        message = {'recipient': u'user@m\xfcller.de'}
+        shard = self.sender.get_shard(message)
+        self.assertTrue(shard in (0, 1))
+        self.assertEqual(self.sender.get_shard(
+            {'recipient': u'other@M\xfcller.de'}), shard)
+
+    def test_feed_error(self):
+        def read_messages():
+            for message in self.get_messages(5):
+                yield message
+            raise IOError('manifest is gone')
+
+        seen = []
+
+        def send():
+            for shard, message, status, result in self.sender.send(
+                    read_messages()):
+                seen.append(message)
+
+        self.assertRaises(IOError, send)
+        # what was read before the error is still delivered
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(self.sender.totals()[SEND_COMPLETED], 5)
+
+    def test_dead_shard(self):
+        messages = self.get_messages(4)
+        messages[0]['msg'] = ExitOnArrival()
+        try:
+            list(self.sender.send(iter(messages)))
+        except Exception, opt:
+            self.assertEqual(opt.args[0], 'Shard process died')
+            self.assertEqual(opt.args[2], 3)
+        else:
+            self.fail('Shard process died is not raised')
+
+
+class TestResultBatch(TestCase):
+
+    def test_sent_on_size_and_interval(self):
+        results = multiprocessing.Queue()
+        batch = ResultBatch(0, results, size=2, interval=0.1)
+        batch.add(1)
+        batch.add(2)
+        self.assertEqual(results.get(timeout=1), ('results', 0, [1, 2]))
+        # a lone result does not wait for the batch to fill up
+        batch.add(3)
+        self.assertEqual(results.get(timeout=1), ('results', 0, [3]))
+        batch.add(4)
+        batch.close()
+        self.assertEqual(results.get(timeout=1), ('results', 0, [4]))
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from StringIO import StringIO
+from codec import CrlfFile
+from exception import NotAvailableException, RequestedActionAbortedException
+from sending_service import EmailService
+from smtp_sink import MEMORY, SmtpSink, parse_codes
+
+
+class TestSmtpSink(TestCase):
+    # EmailService end to end against a sink in a background thread
+
+    def start(self, **kwargs):
+        kwargs.setdefault('capture', MEMORY)
+        sink = SmtpSink(**kwargs).start()
+        self.addCleanup(sink.stop)
+        return sink
+
+    def test_capture_in_memory(self):
+        sink = self.start()
+        con = EmailService('127.0.0.1', sink.port, '')
+        con.send_message('from@example.com', 'to@example.com', 'hello',
+                         'line\n.dot line\n')
+        con.send_message('from@example.com', ['a@example.com',
+                                              'b@example.com'], 'again', 'x')
+        self.assertEqual(con.quit(), EmailService.SEND_COMPLETED)
+        con.child.close(True)
+        self.assertEqual(sink.received.value, 2)
+        self.assertEqual(sink.messages[0],
+                         ('from@example.com', ['to@example.com'],
+                          'Subject:hello\r\nline\r\n.dot line\r\n'))
+        self.assertEqual(sink.messages[1][1], ['a@example.com',
+                                               'b@example.com'])
+
+    def test_chunked_body(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'body.eml')
+        body = open(path, 'wb')
+        body.write('line\r\n.dot line\r\n' * 1000)
+        body.close()
+        sink = self.start()
+        con = EmailService('127.0.0.1', sink.port, '')
+        msg = open(path, 'rb')
+        try:
+            con.send_email('from@example.com', 'to@example.com', 'file', msg)
+        finally:
+            msg.close()
+        self.assertEqual(sink.messages[0][2], 'Subject:file\r\n' +
+                         'line\r\n.dot line\r\n' * 1000)
+
+    def test_chunked_body_line_endings(self):
+        # bare LFs are sent as CRLF unless the body is marked as CRLF
+        sink = self.start()
+        con = EmailService('127.0.0.1', sink.port, '')
+        con.BDAT_CHUNK_SIZE = 8
+        con.send_message('from@example.com', 'to@example.com', 'file',
+                         StringIO('line\n.dot line\r\nlast\r'))
+        con.send_message('from@example.com', 'to@example.com', 'file',
+                         CrlfFile(StringIO('line\r\n.dot line\r\n')))
+        con.close()
+        self.assertEqual(sink.messages[0][2],
+                         'Subject:file\r\nline\r\n.dot line\r\nlast\r\n')
+        self.assertEqual(sink.messages[1][2],
+                         'Subject:file\r\nline\r\n.dot line\r\n')
+
+    def test_injected_code(self):
+        sink = self.start(codes={'RCPT': '451'})
+        con = EmailService('127.0.0.1', sink.port, '')
+        self.assertRaises(RequestedActionAbortedException, con.send_message,
+                          'from@example.com', 'to@example.com', 'hi', 'x')
+        con.close()
+        self.assertEqual(sink.received.value, 0)
+
+    def test_error_text(self):
+        sink = self.start(codes={'DATA': '554'})
+        con = EmailService('127.0.0.1', sink.port, '')
+        try:
+            con.send_message('from@example.com', 'to@example.com', 'hi', 'x')
+        except Exception, opt:
+            self.assertEqual(opt.args, ('Some another error', '554', None,
+                                        'injected error'))
+        else:
+            self.fail('Exception is not raised')
+        con.close()
+
+    def test_closing_code(self):
+        for command in ('MAIL', 'RCPT'):
+            for extensions in (('8BITMIME',), ('PIPELINING',)):
+                sink = self.start(codes={command: '421'},
+                                  extensions=extensions)
+                con = EmailService('127.0.0.1', sink.port, '')
+                self.assertRaises(NotAvailableException, con.send_message,
+                                  'from@example.com', 'to@example.com', 'hi',
+                                  'x')
+                con.child.close(True)
+
+    def test_maildir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        sink = self.start(capture=directory, latency=0.01)
+        con = EmailService('127.0.0.1', sink.port, '')
+        con.send_email('from@example.com', 'to@example.com', 'hi', 'x')
+        names = os.listdir(os.path.join(directory, 'new'))
+        self.assertEqual(len(names), 1)
+        self.assertEqual(os.listdir(os.path.join(directory, 'tmp')), [])
+        message = open(os.path.join(directory, 'new', names[0]), 'rb')
+        try:
+            self.assertEqual(message.read(), 'Return-Path: <from@example.com>'
+                             '\r\nSubject:hi\r\nx\r\n')
+        finally:
+            message.close()
+
+    def test_parse_codes(self):
+        self.assertEqual(parse_codes(['rcpt=451:0.1', 'DATA=554']),
+                         {'RCPT': ('451', 0.1), 'DATA': ('554', 1.0)})
+        self.assertRaises(ValueError, SmtpSink, codes={'SEND': '250'})
+
+    def test_will_forward_accepts_recipient(self):
+        sink = self.start(codes={'RCPT': '251'})
+        con = EmailService('127.0.0.1', sink.port, '')
+        self.assertEqual(con.send_message('from@example.com',
+                                          ['to@example.com'], 'hi', 'x'),
+                         {'to@example.com': EmailService.WILL_FORWARD})
+        con.child.close(True)
+        self.assertEqual(sink.received.value, 1)
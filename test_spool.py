@@ -0,0 +1,101 @@
+from unittest import TestCase
+from spool import Spool, SEND_COMPLETED
+import os
+import shutil
+import tempfile
+
+
+class TestSpool(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'spool.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resume_pending_messages(self):
+        spool = Spool(self.path)
+        for i in range(4):
+            spool.enqueue({'recipient': 'user%d@gmail.com' % i})
+        messages = list(spool.take())
+        spool.mark(messages[0]['spool_id'], SEND_COMPLETED)
+        spool.mark(messages[2]['spool_id'], SEND_COMPLETED)
+        spool.close()
+
+        spool = Spool(self.path)
+        self.assertEqual(['user1@gmail.com', 'user3@gmail.com'],
+                         [message['recipient']
+                          for message in spool.take()])
+        self.assertEqual(4, spool.enqueue({'recipient': 'new@gmail.com'}))
+        spool.close()
+
+    def test_drop_broken_record(self):
+        spool = Spool(self.path)
+        spool.enqueue({'recipient': 'vovaxo@gmail.com'})
+        spool.journal.write('{"op": "enq')
+        spool.close()
+
+        spool = Spool(self.path)
+        spool.enqueue({'recipient': 'lenok@gmail.com'})
+        spool.close()
+
+        spool = Spool(self.path)
+        self.assertEqual(['vovaxo@gmail.com', 'lenok@gmail.com'],
+                         [message['recipient']
+                          for message in spool.take()])
+        spool.close()
+
+    def test_compact(self):
+        spool = Spool(self.path, compact_after=2)
+        for i in range(3):
+            spool.enqueue({'recipient': 'user%d@gmail.com' % i})
+        messages = list(spool.take())
+        spool.mark(messages[0]['spool_id'], SEND_COMPLETED)
+        spool.mark(messages[1]['spool_id'], SEND_COMPLETED)
+        spool.close()
+
+        self.assertEqual(1, len(open(self.path).readlines()))
+        spool = Spool(self.path)
+        self.assertEqual(['user2@gmail.com'],
+                         [message['recipient']
+                          for message in spool.take()])
+        spool.close()
+
+    def test_feed_while_taking(self):
+        spool = Spool(self.path)
+        spool.enqueue({'recipient': 'old@gmail.com'})
+
+        def read_messages():
+            for i in range(3):
+                yield {'recipient': 'user%d@gmail.com' % i}
+            raise IOError('manifest is gone')
+
+        spool.feed(read_messages())
+        taken = []
+        try:
+            for message in spool.take():
+                taken.append(message['recipient'])
+                # only journal offsets are held for the pending messages
+                self.assertEqual(set(type(offset) for offset in
+                                     spool.pending.values()), set([int]))
+                spool.mark(message['spool_id'], SEND_COMPLETED)
+        except IOError:
+            pass
+        else:
+            self.fail('IOError is not raised')
+        self.assertEqual(['old@gmail.com', 'user0@gmail.com',
+                          'user1@gmail.com', 'user2@gmail.com'], taken)
+        spool.close()
+
+        spool = Spool(self.path)
+        self.assertEqual([], list(spool.take()))
+        spool.close()
+
+    def test_take_non_ascii_message(self):
+        spool = Spool(self.path)
+        spool.enqueue({'recipient': 'm\xc3\xbcller@gmail.com'})
+        message, = spool.take()
+        spool.close()
+        self.assertEqual('m\xc3\xbcller@gmail.com', message['recipient'])
+        self.assertTrue(isinstance(message['recipient'], str))
@@ -0,0 +1,22 @@
+from unittest import TestCase
+from template import Template
+
+
+class TestTemplate(TestCase):
+
+    def test_render_rows(self):
+        template = Template('Hello {name}, you owe {amount:.2f} '
+                            '{currency[code]}.\n{{not a field}}')
+        row = {'name': u'Ol\xe9na', 'amount': 12.5,
+               'currency': {'code': 'EUR'}}
+        self.assertEqual(template.render(row),
+                         'Hello Ol\xc3\xa9na, you owe 12.50 EUR.\n'
+                         '{not a field}')
+        self.assertEqual(template.render({'name': 'Ann', 'amount': 1,
+                                          'currency': {'code': 'USD'}}),
+                         'Hello Ann, you owe 1.00 USD.\n{not a field}')
+
+    def test_errors(self):
+        self.assertRaises(ValueError, Template, 'Hello {}')
+        self.assertRaises(ValueError, Template, 'Hello {0}')
+        self.assertRaises(ValueError, Template('Hello {name}').render, {})
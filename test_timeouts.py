@@ -0,0 +1,140 @@
+from unittest import TestCase
+from exception import TimeoutException
+from sending_service import EmailService
+from smtp_sink import SmtpSink
+from timeouts import Timeouts, BODY, COMMAND
+import metrics
+import time
+
+
+class TestTimeouts(TestCase):
+
+    def test_fixed(self):
+        timeouts = Timeouts(command=5, body=60)
+        key = ('localhost', 25)
+        timeouts.observe(key, COMMAND, 0.01)
+        self.assertEqual(timeouts.get(key, COMMAND), 5)
+        self.assertEqual(timeouts.get(key, BODY), 60)
+        self.assertEqual(timeouts.get(key, 'connect'), None)
+
+    def test_adaptive(self):
+        timeouts = Timeouts(command=30, adaptive=True, factor=4, minimum=0.5)
+        quick, slow = ('quick', 25), ('slow', 25)
+        for i in range(Timeouts.MIN_SAMPLES):
+            timeouts.observe(quick, COMMAND, 0.01)
+            timeouts.observe(slow, COMMAND, 2)
+        self.assertEqual(timeouts.get(quick, COMMAND), 0.5)
+        self.assertAlmostEqual(timeouts.get(slow, COMMAND), 8, places=1)
+        # never above the configured limit
+        timeouts.observe(slow, COMMAND, 60)
+        self.assertEqual(timeouts.get(slow, COMMAND), 30)
+        # not enough samples yet
+        timeouts.observe(('new', 25), COMMAND, 1)
+        self.assertEqual(timeouts.get(('new', 25), COMMAND), 30)
+
+    def test_adaptive_without_limits(self):
+        # the transport's timeout is the most it may adapt to
+        timeouts = Timeouts(adaptive=True, minimum=0.5)
+        key = ('slow', 25)
+        for i in range(Timeouts.MIN_SAMPLES):
+            timeouts.observe(key, COMMAND, 20)
+        self.assertEqual(timeouts.get(key, COMMAND), 80)
+        self.assertEqual(timeouts.get(key, COMMAND, 30), 30)
+        self.assertEqual(timeouts.get(('new', 25), COMMAND, 30), None)
+
+
+class TestEmailServiceTimeouts(TestCase):
+    # EmailService against a sink that is slow to answer
+
+    def start(self, latency):
+        sink = SmtpSink(latency=latency).start()
+        self.addCleanup(sink.stop)
+        return sink
+
+    def test_command_timeout(self):
+        sink = self.start({'RCPT': 1})
+        con = EmailService('127.0.0.1', sink.port, '',
+                           timeouts=Timeouts(command=0.1))
+        start = metrics.monotonic()
+        self.assertRaises(TimeoutException, con.send_message,
+                          'from@example.com', 'to@example.com', 'hi', 'x')
+        self.assertTrue(metrics.monotonic() - start < 0.5)
+        # the session is given up
+        self.assertFalse(con.child.isalive())
+
+    def test_transport_timeout(self):
+        # without configured timeouts the transport's own one counts, and
+        # the session is given up the same way
+        sink = self.start({'RCPT': 1})
+        con = EmailService('127.0.0.1', sink.port, '')
+        con.child.timeout = 0.1
+        self.assertRaises(TimeoutException, con.send_message,
+                          'from@example.com', 'to@example.com', 'hi', 'x')
+        self.assertFalse(con.child.isalive())
+
+    def test_message_deadline(self):
+        sink = self.start({'MAIL': 0.1, 'RCPT': 0.1, 'DATA': 0.1})
+        con = EmailService('127.0.0.1', sink.port, '',
+                           timeouts=Timeouts(command=1, message=0.15))
+        self.assertRaises(TimeoutException, con.send_message,
+                          'from@example.com', 'to@example.com', 'hi', 'x')
+        self.assertEqual(sink.received.value, 0)
+
+    def test_slow_but_in_time(self):
+        sink = self.start({'BODY': 0.1})
+        con = EmailService('127.0.0.1', sink.port, '',
+                           timeouts=Timeouts(command=0.05, body=1))
+        self.assertEqual(con.send_email('from@example.com', 'to@example.com',
+                                        'hi', 'x'),
+                         EmailService.SEND_COMPLETED)
+
+    def test_body_upload_does_not_adapt(self):
+        # quick final replies do not cut short an upload that takes longer
+        sink = self.start(None)
+        timeouts = Timeouts(body=600, adaptive=True, minimum=0.05)
+        for i in range(Timeouts.MIN_SAMPLES):
+            timeouts.observe(('127.0.0.1', sink.port), BODY, 0.001)
+        self.assertEqual(timeouts.get(('127.0.0.1', sink.port), BODY), 0.05)
+        con = EmailService('127.0.0.1', sink.port, '', timeouts=timeouts)
+        send = con.child.send
+
+        def slow_send(data):
+            time.sleep(0.1)
+            return send(data)
+
+        con.child.send = slow_send
+        self.assertEqual(con.send_message('from@example.com',
+                                          'to@example.com', 'hi', 'x'),
+                         EmailService.SEND_COMPLETED)
+        con.child.close(True)
+
+    def test_adaptive_without_limits(self):
+        # replies are recorded and adapt the timeouts although no limit is
+        # configured
+        sink = self.start(None)
+        timeouts = Timeouts(adaptive=True, minimum=0.05)
+        key = ('127.0.0.1', sink.port)
+        con = EmailService('127.0.0.1', sink.port, '', timeouts=timeouts)
+        for i in range(Timeouts.MIN_SAMPLES):
+            con.send_message('from@example.com', 'to@example.com', 'hi', 'x')
+        con.quit()
+        self.assertEqual(timeouts.get(key, COMMAND, 30), 0.05)
+        self.assertEqual(timeouts.get(key, BODY, 30), 0.05)
+
+    def test_body_write_keeps_transport_timeout(self):
+        # a command limit alone does not take the guard off body writes
+        sink = self.start(None)
+        con = EmailService('127.0.0.1', sink.port, '',
+                           timeouts=Timeouts(command=5))
+        send = con.child.send
+        timeouts = []
+
+        def send_with_timeout(data):
+            timeouts.append(con.child.timeout)
+            return send(data)
+
+        con.child.send = send_with_timeout
+        con.send_message('from@example.com', 'to@example.com', 'hi', 'x')
+        con.child.close(True)
+        self.assertTrue(timeouts)
+        self.assertFalse(None in timeouts)
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from sending_service import EmailService
+from smtp_sink import SmtpSink
+import transcript
+
+
+class TestTranscriptLogger(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'smtp.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_logger(self, **options):
+        logger = transcript.TranscriptLogger(self.path, **options)
+        self.addCleanup(logger.close)
+        return logger
+
+    def read_lines(self, path=None):
+        log = open(path or self.path)
+        try:
+            # without the time stamp
+            return [line.split(' ', 2)[2] for line in log.read().splitlines()]
+        finally:
+            log.close()
+
+    def test_session_entries(self):
+        logger = self.get_logger()
+        session = logger.open_session()
+        session.sent.write('EHLO host\r\n')
+        session.received.write('250-host\r\n250 SIZE 100\r\n')
+        session.next_message()
+        session.sent.write('MAIL FROM:<a@example.com>\r\n')
+        logger.flush()
+        session_id = session.session_id
+        self.assertEqual(self.read_lines(), [
+            session_id + ' > EHLO host',
+            session_id + ' < 250-host',
+            session_id + ' < 250 SIZE 100',
+            session_id + '/1 > MAIL FROM:<a@example.com>'])
+
+    def test_redacted_body(self):
+        logger = self.get_logger(redact_body=True)
+        session = logger.open_session()
+        session.next_message()
+        session.start_body()
+        session.sent.write('Subject:secret\r\n')
+        session.sent.write('secret text\r\n.\r\n')
+        session.end_body()
+        session.received.write('250 ok\r\n')
+        logger.flush()
+        tag = session.session_id + '/1'
+        self.assertEqual(self.read_lines(), [
+            tag + ' > [32 bytes of body redacted]', tag + ' < 250 ok'])
+
+    def test_sampling(self):
+        logger = self.get_logger(sample_rate=0.0)
+        self.assertTrue(logger.open_session() is transcript.NULL_SESSION)
+
+    def test_rotation(self):
+        logger = self.get_logger(max_bytes=100, backup_count=2)
+        session = logger.open_session()
+        for i in range(3):
+            session.sent.write('x' * 100 + '\r\n')
+            logger.flush()
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['smtp.log', 'smtp.log.1', 'smtp.log.2',
+                          'smtp.log.lock'])
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(len(self.read_lines(self.path + '.2')), 1)
+
+    def test_rotated_by_another_logger(self):
+        # a forked process has a logger of its own on the same path; the
+        # other one follows its rotation instead of writing to path.1
+        first = self.get_logger(max_bytes=100, backup_count=2)
+        second = self.get_logger(max_bytes=100, backup_count=2)
+        second.open_session().sent.write('before\r\n')
+        second.flush()
+        first.open_session().sent.write('x' * 100 + '\r\n')
+        first.flush()
+        session = second.open_session()
+        session.sent.write('after\r\n')
+        second.flush()
+        self.assertEqual(self.read_lines(), [session.session_id + ' > after'])
+        self.assertEqual(len(self.read_lines(self.path + '.1')), 2)
+
+    def test_write_error(self):
+        # the writer thread goes on after a failed write and reports what
+        # was lost
+        logger = self.get_logger()
+        write = logger.write
+
+        def fail(entries):
+            raise IOError(28, 'No space left on device')
+
+        logger.write = fail
+        session = logger.open_session()
+        session.sent.write('lost\r\n')
+        logger.flush()
+        logger.write = write
+        session.sent.write('kept\r\n')
+        logger.flush()
+        self.assertEqual(self.read_lines(), [
+            '- ! 1 entries dropped', session.session_id + ' > kept'])
+
+    def test_email_service_transcript(self):
+        sink = SmtpSink().start()
+        self.addCleanup(sink.stop)
+        transcript.configure(redact_body=True)
+        self.addCleanup(transcript.configure, **transcript.DEFAULT_OPTIONS)
+        con = EmailService('127.0.0.1', sink.port, self.path)
+        con.send_email('from@example.com', 'to@example.com', 'hi', 'secret')
+        transcript.get_logger(self.path).flush()
+        lines = self.read_lines()
+        self.assertTrue(lines[-4].endswith('/1 > [23 bytes of body redacted]'))
+        self.assertFalse([line for line in lines if 'secret' in line])
+        self.assertTrue(lines[-1].endswith(' < 221 bye'))
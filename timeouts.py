@@ -0,0 +1,87 @@
+import threading
+import metrics
+
+
+CONNECT = 'connect'
+GREETING = 'greeting'
+COMMAND = 'command'
+BODY = 'body'
+PHASES = (CONNECT, GREETING, COMMAND, BODY)
+
+
+class Timeouts():
+    # How long EmailService waits in each phase: connect, greeting, every
+    # command reply and the body upload (with its final reply), in seconds;
+    # message is a deadline for a whole MAIL transaction. None leaves the
+    # transport's own timeout in place.
+    #
+    # With adaptive set the wait for a reply also follows what was seen
+    # from the same host: once there are MIN_SAMPLES replies it is factor
+    # times their percentile latency, at least minimum and never more than
+    # the configured value, or than the transport's own timeout when no
+    # value is configured. A host that is always slow keeps its long
+    # timeouts, a session that hangs on a usually quick host gives up soon.
+    # For the body only the wait for the final reply adapts; the upload
+    # itself takes as long as the size needs, so its deadline is always
+    # the configured one (get_limit).
+    MIN_SAMPLES = 20
+    PERCENTILE = 99
+    FACTOR = 4
+    MINIMUM = 1.0
+
+    def __init__(self, connect=None, greeting=None, command=None, body=None,
+                 message=None, adaptive=False, percentile=PERCENTILE,
+                 factor=FACTOR, minimum=MINIMUM):
+        self.limits = {CONNECT: connect, GREETING: greeting,
+                       COMMAND: command, BODY: body}
+        self.message = message
+        self.adaptive = adaptive
+        self.percentile = percentile
+        self.factor = factor
+        self.minimum = minimum
+        self.histograms = {}  # (host key, phase) -> metrics.Histogram
+        self.lock = threading.Lock()
+
+    def get_limit(self, phase):
+        return self.limits[phase]
+
+    def get(self, host_key, phase, default=None):
+        # default is the transport's timeout, it caps the adaptive timeout
+        # of a phase without a configured limit
+        limit = self.limits[phase]
+        if not self.adaptive:
+            return limit
+        with self.lock:
+            histogram = self.histograms.get((host_key, phase))
+            if histogram is None or histogram.count < self.MIN_SAMPLES:
+                return limit
+            latency = histogram.get_percentile(self.percentile)
+        timeout = max(self.minimum, latency * self.factor)
+        if limit is None:
+            limit = default
+        return timeout if limit is None else min(limit, timeout)
+
+    def observe(self, host_key, phase, seconds):
+        if not self.adaptive:
+            return
+        with self.lock:
+            histogram = self.histograms.get((host_key, phase))
+            if histogram is None:
+                histogram = self.histograms[(host_key, phase)] = \
+                    metrics.Histogram()
+            histogram.record(seconds)
+
+
+# used by every EmailService that is not given its own; None keeps the
+# transport defaults
+default_timeouts = None
+
+
+def set_default_timeouts(new_timeouts):
+    global default_timeouts
+    default_timeouts = new_timeouts
+    return new_timeouts
+
+
+def get_default_timeouts():
+    return default_timeouts
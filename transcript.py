@@ -0,0 +1,259 @@
+# SMTP transcripts: what was sent to and read from the server, written to a
+# log file by a background thread so the sending threads never wait for the
+# disk. Every connection is a session with its own id; entries look like
+#     2026-10-16 12:00:00.123 4711-3/2 > MAIL FROM:<a@example.com>
+# for session 3 of process 4711, its second message, sent to the server
+# ('<' is read from it). Sessions can be sampled and message bodies
+# redacted, so logging can stay on at high volume.
+import atexit
+import fcntl
+import itertools
+import os
+import Queue
+import random
+import threading
+import time
+
+
+SENT = '>'
+RECEIVED = '<'
+DEFAULT_OPTIONS = {
+    'max_bytes': 10 * 1024 * 1024,  # rotate at this size, 0 never rotates
+    'backup_count': 5,  # keep path.1 ... path.N after rotating
+    'sample_rate': 1.0,  # share of sessions that are logged
+    'redact_body': False,  # log only the size of message bodies
+}
+QUEUE_SIZE = 100000  # entries; when it is full new entries are dropped
+BATCH_SIZE = 1000  # entries written at once
+FLUSH_INTERVAL = 0.2  # seconds an entry may wait for more to batch with
+
+
+class TranscriptLogger():
+    # one log file and its writer thread, shared by all the sessions that
+    # log to it. The file is opened here, so an unusable path raises IOError
+    # right away instead of in the thread. Forked processes have loggers of
+    # their own on the same path: they write and rotate under a lock on
+    # path.lock and reopen the path when another process rotated it.
+
+    def __init__(self, path, max_bytes=DEFAULT_OPTIONS['max_bytes'],
+                 backup_count=DEFAULT_OPTIONS['backup_count'],
+                 sample_rate=DEFAULT_OPTIONS['sample_rate'],
+                 redact_body=DEFAULT_OPTIONS['redact_body']):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.sample_rate = sample_rate
+        self.redact_body = redact_body
+        self.file = open(path, 'a')
+        self.lock_file = open(path + '.lock', 'a')
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        self.dropped = 0  # entries lost to a full queue
+        self.random = random.Random()
+        self.sessions = itertools.count(1)
+        self.thread = threading.Thread(target=self.write_batches)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open_session(self):
+        # a TranscriptSession for a new connection, or NULL_SESSION when the
+        # connection is not sampled
+        if self.sample_rate < 1.0 and \
+                self.random.random() >= self.sample_rate:
+            return NULL_SESSION
+        return TranscriptSession(self, '%d-%d' % (os.getpid(),
+                                                  next(self.sessions)))
+
+    def log(self, session_id, direction, data):
+        try:
+            self.queue.put_nowait((time.time(), session_id, direction, data))
+        except Queue.Full:
+            self.dropped += 1
+
+    # writer thread
+
+    def write_batches(self):
+        while True:
+            entries = [self.queue.get()]
+            deadline = time.time() + FLUSH_INTERVAL
+            while entries[-1] is not None and len(entries) < BATCH_SIZE:
+                try:
+                    entries.append(self.queue.get(
+                        timeout=max(0, deadline - time.time())))
+                except Queue.Empty:
+                    break
+            stop = entries[-1] is None
+            if stop:
+                entries.pop()
+            try:
+                self.write(entries)
+            except (IOError, OSError):
+                # a full disk or a path that went away must not stop the
+                # thread, the batch is counted as dropped
+                self.dropped += len(entries)
+            finally:
+                for i in range(len(entries) + stop):
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def write(self, entries):
+        lines = []
+        dropped = self.dropped
+        if dropped:
+            lines.append('%s - ! %d entries dropped\n' % (
+                format_time(time.time()), dropped))
+        for created, session_id, direction, data in entries:
+            prefix = '%s %s %s ' % (format_time(created), session_id,
+                                    direction)
+            lines.extend(prefix + line + '\n'
+                         for line in data.splitlines() or [''])
+        if not lines:
+            return
+        fcntl.lockf(self.lock_file, fcntl.LOCK_EX)
+        try:
+            if self.is_rotated():
+                self.file.close()
+                self.file = open(self.path, 'a')
+            self.file.write(''.join(lines))
+            self.file.flush()
+            self.dropped -= dropped
+            if self.max_bytes and \
+                    os.fstat(self.file.fileno()).st_size >= self.max_bytes:
+                self.rotate()
+        finally:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_UN)
+
+    def is_rotated(self):
+        # True when the open file is no longer the one at path
+        if self.file.closed:
+            return True
+        try:
+            return os.stat(self.path).st_ino != \
+                os.fstat(self.file.fileno()).st_ino
+        except OSError:
+            return True
+
+    def rotate(self):
+        # path -> path.1 -> path.2 ..., the oldest one is removed
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '%s.%d' % (self.path, i)
+            if os.path.exists(source):
+                os.rename(source, '%s.%d' % (self.path, i + 1))
+        if self.backup_count:
+            os.rename(self.path, self.path + '.1')
+        self.file = open(self.path, 'w')
+
+    def flush(self):
+        # wait until everything logged so far is written
+        self.queue.join()
+
+    def close(self):
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.lock_file.close()
+
+
+def format_time(created):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created)) + \
+        '.%03d' % (created % 1 * 1000)
+
+
+class TranscriptWriter():
+    # file-like end of a session for one direction, what pexpect and
+    # SocketTransport take as logfile_send or logfile_read
+    def __init__(self, session, direction):
+        self.session = session
+        self.direction = direction
+
+    def write(self, data):
+        self.session.write(self.direction, data)
+
+    def flush(self):
+        pass
+
+
+class TranscriptSession():
+    # transcript of one connection; EmailService numbers its messages and
+    # marks where a body is sent, which is left out when redacting
+    def __init__(self, logger, session_id):
+        self.logger = logger
+        self.session_id = session_id
+        self.message = 0
+        self.tag = session_id
+        self.in_body = False
+        self.body_size = 0
+        self.sent = TranscriptWriter(self, SENT)
+        self.received = TranscriptWriter(self, RECEIVED)
+
+    def next_message(self):
+        self.message += 1
+        self.tag = '%s/%d' % (self.session_id, self.message)
+
+    def start_body(self):
+        self.in_body = self.logger.redact_body
+        self.body_size = 0
+
+    def end_body(self):
+        if self.in_body:
+            self.in_body = False
+            self.logger.log(self.tag, SENT, '[%d bytes of body redacted]' %
+                            self.body_size)
+
+    def write(self, direction, data):
+        if self.in_body and direction == SENT:
+            self.body_size += len(data)
+            return
+        self.logger.log(self.tag, direction, data)
+
+
+class NullSession():
+    # stands in for a session that is not logged
+    sent = received = None
+
+    def next_message(self):
+        pass
+
+    def start_body(self):
+        pass
+
+    def end_body(self):
+        pass
+
+
+NULL_SESSION = NullSession()
+
+# loggers by (path, process id), so the connections of a process share one
+# file and thread and a forked process gets its own thread
+loggers = {}
+loggers_lock = threading.Lock()
+options = dict(DEFAULT_OPTIONS)
+
+
+def configure(**new_options):
+    # options for the loggers get_logger creates from now on
+    for name in new_options:
+        if name not in DEFAULT_OPTIONS:
+            raise ValueError('Unknown transcript option: %s' % name)
+    options.update(new_options)
+
+
+def get_logger(path):
+    key = (os.path.abspath(path), os.getpid())
+    with loggers_lock:
+        logger = loggers.get(key)
+        if logger is None:
+            logger = loggers[key] = TranscriptLogger(path, **options)
+        return logger
+
+
+@atexit.register
+def close_loggers():
+    with loggers_lock:
+        for key, logger in loggers.items():
+            if key[1] == os.getpid():
+                logger.close()
+        loggers.clear()
@@ -0,0 +1,135 @@
+from exception import ConnectionRefusedException, UnknownServiceException,\
+    TerminationConnectionException, TimeoutException
+from reply import ReplyParser
+import metrics
+from collections import deque
+import errno
+import select
+import socket
+
+
+class SocketTransport():
+    # Speaks SMTP over a plain TCP socket. It offers the same small part of
+    # the pexpect.spawn interface that EmailService uses (sendline, expect,
+    # match, before, isalive, close and the logfiles), so the reply handling
+    # in EmailService works the same for the socket and the telnet transport.
+    # Replies are framed by reply.ReplyParser instead of a pattern, and
+    # match is the reply.Reply that was read.
+    LINESEP = '\r\n'
+    CONNECT_TIMEOUT = 30
+    TIMEOUT = 30
+    RECV_SIZE = 65536
+
+    def __init__(self, smtp_host, smtp_port, timeout=CONNECT_TIMEOUT):
+        self.logfile = None
+        self.logfile_read = None  # only what is read
+        self.logfile_send = None  # only what is sent
+        self.match = None
+        self.before = ''
+        self.parser = ReplyParser()
+        self.replies = deque()  # read but not expected yet (pipelining)
+        # seconds a send or an expect without a timeout of its own may
+        # take, like pexpect.spawn.timeout
+        self.timeout = self.TIMEOUT
+        try:
+            self.sock = socket.create_connection((smtp_host, smtp_port),
+                                                 timeout)
+        except socket.gaierror:
+            raise UnknownServiceException
+        except socket.timeout:
+            raise TimeoutException('TIMEOUT error. Could not connect to',
+                                   smtp_host, smtp_port)
+        except socket.error, opt:
+            if opt.errno == errno.ECONNREFUSED:
+                raise ConnectionRefusedException
+            raise TerminationConnectionException(opt)
+        self.sock_timeout = self.TIMEOUT
+        self.sock.settimeout(self.TIMEOUT)
+        # commands are small writes followed by a wait for the reply, do not
+        # let Nagle's algorithm hold them back
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def set_sock_timeout(self, timeout):
+        if timeout != self.sock_timeout:
+            self.sock.settimeout(timeout)
+            self.sock_timeout = timeout
+
+    def send(self, data):
+        try:
+            self.set_sock_timeout(self.timeout)
+            self.sock.sendall(data)
+        except socket.timeout:
+            self.close(True)
+            raise TimeoutException('TIMEOUT error. Could not send to SMTP '
+                                   'server in %s s' % self.timeout)
+        except socket.error, opt:
+            self.close(True)
+            raise TerminationConnectionException(opt)
+        if self.logfile is not None or self.logfile_send is not None:
+            # BDAT chunks may come as memoryviews
+            if not isinstance(data, str):
+                data = data.tobytes()
+            for logfile in (self.logfile, self.logfile_send):
+                if logfile is not None:
+                    logfile.write(data)
+        return len(data)
+
+    def sendline(self, line=''):
+        return self.send(line + self.LINESEP)
+
+    def recv(self, timeout):
+        try:
+            self.set_sock_timeout(timeout)
+            data = self.sock.recv(self.RECV_SIZE)
+        except socket.timeout:
+            raise TimeoutException('TIMEOUT error. Here is what SMTP said:',
+                                   self.parser.buffer)
+        except socket.error, opt:
+            self.close(True)
+            raise TerminationConnectionException(opt)
+        if not data:
+            self.close(True)
+            raise TerminationConnectionException('Connection closed by '
+                                                 'remote host')
+        for logfile in (self.logfile, self.logfile_read):
+            if logfile is not None:
+                logfile.write(data)
+        return data
+
+    def expect(self, pattern=None, timeout=-1):
+        # take the next whole (possibly multiline) reply within timeout
+        # seconds (-1 is self.timeout, None waits for ever); the pattern is
+        # accepted for pexpect compatibility only
+        if timeout == -1:
+            timeout = self.timeout
+        deadline = None if timeout is None else metrics.monotonic() + timeout
+        while not self.replies:
+            if deadline is not None:
+                timeout = deadline - metrics.monotonic()
+                if timeout <= 0:
+                    raise TimeoutException('TIMEOUT error. Here is what SMTP '
+                                           'said:', self.parser.buffer)
+            self.replies.extend(self.parser.feed(self.recv(timeout)))
+        self.match = reply = self.replies.popleft()
+        self.before = reply.get_before() if len(reply.lines) > 1 else ''
+        return 0
+
+    def isalive(self):
+        if self.sock is None:
+            return False
+        # a readable socket that has nothing to read was closed by the peer
+        readable = select.select([self.sock], [], [], 0)[0]
+        if not readable:
+            return True
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK) != ''
+        except socket.error:
+            return False
+
+    def close(self, force=True):
+        if self.sock is None:
+            return
+        try:
+            self.sock.close()
+        finally:
+            self.sock = None